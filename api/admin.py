@@ -1,3 +1,6 @@
 from django.contrib import admin
+from .models import ImageJob
 
 # Register your models here.
+
+admin.site.register(ImageJob)
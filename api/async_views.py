@@ -0,0 +1,308 @@
+# async_views.py
+import json
+import uuid
+import asyncio
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import RequestDataTooBig
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.settings import api_settings
+
+from authentication.ratelimit import PlanRateThrottle
+
+from .compute import compute_pool, client_key, PoolSaturated, ClientSaturated
+from .cost import probe_base64, admit_upload, admit_operation, REJECT, QUEUE, DOWNSCALE
+from .image_store import image_store, image_owner, ImageTooLarge
+from .operations import OPERATIONS, InvalidParameters, decode_upload, run_operation, compute_operation, render_result, operation_pixels
+from .jobs import job_runner
+from .metrics import stage
+from .scheduler import scheduling, request_plan
+from .views import job_accepted
+from .singleflight import single_flight
+from .supersede import latest_wins, parse_sequence, Superseded
+
+
+# Async variants of the image endpoints. The CPU work is handed to the bounded compute
+# pool and awaited, so the event loop keeps serving light requests while images are
+# being processed, and a full pool answers 503/429 with Retry-After instead of queueing.
+
+
+
+
+def _authenticate(request):
+
+    """
+    Runs The DRF Authentication Classes On a Plain Django Request and Sets request.user
+    """
+
+    request.user = AnonymousUser()
+
+    for authentication_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+
+        user_auth_tuple = authentication_class().authenticate(request)
+
+        if user_auth_tuple is not None:
+            request.user = user_auth_tuple[0]
+            return
+
+
+
+def _error(message, status_code, retry_after=None):
+
+    response = JsonResponse({"error": message}, status=status_code)
+
+    if retry_after is not None:
+        response["Retry-After"] = str(retry_after)
+
+    return response
+
+
+
+async def _prepare(request, throttle_scope=None):
+
+    """
+    Authenticates and Parses The JSON Body. Returns (data, None) or (None, error response)
+    """
+
+    try:
+        await sync_to_async(_authenticate)(request)
+    except AuthenticationFailed as e:
+        return None, _error(str(e.detail), status.HTTP_401_UNAUTHORIZED)
+
+    throttle = PlanRateThrottle()
+
+    if not throttle.allow(request, throttle_scope):
+        return None, _error("Request was throttled", status.HTTP_429_TOO_MANY_REQUESTS, throttle.wait())
+
+    try:
+        with stage("parse"):
+            data = json.loads(request.body or b"{}")
+    except RequestDataTooBig:
+        return None, _error("Request body is too large", status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    except ValueError:
+        return None, _error("Request body must be JSON", status.HTTP_400_BAD_REQUEST)
+
+    if not isinstance(data, dict):
+        return None, _error("Request body must be a JSON object", status.HTTP_400_BAD_REQUEST)
+
+    return data, None
+
+
+
+async def _run_in_pool(request, fn, *args, coalesce_key=None, pixels=0):
+
+    """
+    Awaits fn(*args) On The Compute Pool, in The Lane of The User's Plan. Returns (result, None)
+    or (None, error response). With a coalesce_key, identical concurrent requests await a single computation
+    """
+
+    def submit():
+        return compute_pool.submit(fn, *args, client=client_key(request), **scheduling(request.user, pixels))
+
+    try:
+        if coalesce_key is not None:
+            return await single_flight.arun(coalesce_key, submit), None
+
+        future = submit()
+    except PoolSaturated as e:
+        return None, _error(str(e), status.HTTP_503_SERVICE_UNAVAILABLE, compute_pool.retry_after)
+    except ClientSaturated as e:
+        return None, _error(str(e), status.HTTP_429_TOO_MANY_REQUESTS, compute_pool.retry_after)
+
+    return await asyncio.wrap_future(future), None
+
+
+
+
+@csrf_exempt
+@require_POST
+async def upload_image(request):
+
+    data, error = await _prepare(request)
+
+    if error is not None:
+        return error
+
+    image_base64 = data.get("image_base64")
+
+    if not image_base64:
+        return _error("image_base64 is required", status.HTTP_400_BAD_REQUEST)
+
+    try:
+        # Sized from the header before anything is decoded, see api/cost.py
+        header = probe_base64(image_base64)
+        decision = admit_upload(request_plan(request.user), header)
+
+        if decision.action == REJECT:
+            return _rejected(decision)
+
+        img, error = await _run_in_pool(request, decode_upload, image_base64, decision.size, pixels=decision.estimate.pixels)
+
+    except ValueError:
+        return _error("Invalid base64 image", status.HTTP_400_BAD_REQUEST)
+
+    if error is not None:
+        return error
+
+    image_id = str(uuid.uuid4())
+
+    try:
+        image_store.set(f"original:{image_id}", img, owner=image_owner(request))
+    except ImageTooLarge:
+        return _error("Image is too large to be processed", status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    payload = {"image_id": image_id}
+
+    if decision.action == DOWNSCALE:
+        payload["downscaled_to"] = list(img.size)
+
+    return JsonResponse(payload, status=status.HTTP_201_CREATED)
+
+
+
+def _rejected(decision):
+
+    return JsonResponse(
+        {"error": decision.reason, "estimate": decision.estimate.as_dict()},
+        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    )
+
+
+
+async def _run_latest_wins(request, name, original_img, params, scope, seq):
+
+    """
+    Computes and Renders as Two Pool Stages, Dropping The Request if It Gets Superseded
+    """
+
+    if not latest_wins.advance(scope, seq):
+        return _superseded(seq)
+
+    pixels = operation_pixels(name, original_img, params)
+
+    try:
+        # The guard is called at every stage boundary of the kernel, like in the sync view
+        result, error = await _run_in_pool(
+            request, partial(compute_operation, name, progress=latest_wins.guard(scope, seq)), original_img, params, pixels=pixels,
+        )
+    except Superseded:
+        return _superseded(seq)
+
+    if error is not None:
+        return error
+
+    # Nothing newer arrived while computing? Then it is worth encoding
+    if latest_wins.is_superseded(scope, seq):
+        return _superseded(seq)
+
+    payload, error = await _run_in_pool(request, render_result, result, pixels=pixels)
+
+    if error is not None:
+        return error
+
+    return _ok(payload)
+
+
+
+def _ok(payload):
+
+    # The JSON is serialized right here, the "render" stage of Server-Timing
+    with stage("render"):
+        return JsonResponse(payload, status=status.HTTP_200_OK)
+
+
+
+def _superseded(seq):
+
+    return JsonResponse({"error": "Superseded by a newer request", "seq": seq}, status=status.HTTP_409_CONFLICT)
+
+
+
+def operation_view(name, coalesce=False, latest=False):
+
+    """
+    Builds The Async View For One of The Operations in api/operations.py
+    """
+
+    operation = OPERATIONS[name]
+
+    @csrf_exempt
+    @require_POST
+    async def view(request):
+
+        # Slider moves are rate limited like the sync view, see ApplyImageAdjustments
+        data, error = await _prepare(request, "interactive" if latest else None)
+
+        if error is not None:
+            return error
+
+        image_id = data.get("image_id", None)
+
+        if not image_id:
+            return _error("image_id is required", status.HTTP_400_BAD_REQUEST)
+
+        try:
+            params = operation.parse(data)
+        except InvalidParameters as e:
+            return _error(str(e), status.HTTP_400_BAD_REQUEST)
+
+        original_img = image_store.get(f"original:{image_id}")
+
+        if original_img is None:
+            return _error("Image expired or not found", status.HTTP_404_NOT_FOUND)
+
+        # Predicted from the size and parameters before any work, see api/cost.py
+        decision = admit_operation(request_plan(request.user), name, original_img, params)
+
+        if decision.action == REJECT:
+            return _rejected(decision)
+
+        # Work too long to hold the request for runs as a job, like with "mode": "job"
+        if data.get("mode") == "job" or decision.action == QUEUE:
+
+            user = request.user if request.user.is_authenticated else None
+
+            try:
+                job = await sync_to_async(job_runner.submit)(name, original_img, params, user=user, client=client_key(request))
+            except PoolSaturated as e:
+                return _error(str(e), status.HTTP_503_SERVICE_UNAVAILABLE, compute_pool.retry_after)
+            except ClientSaturated as e:
+                return _error(str(e), status.HTTP_429_TOO_MANY_REQUESTS, compute_pool.retry_after)
+
+            return JsonResponse(await sync_to_async(job_accepted)(job, decision), status=status.HTTP_202_ACCEPTED)
+
+        sequence = parse_sequence(data, image_id) if latest else None
+
+        if sequence is not None:
+            return await _run_latest_wins(request, name, original_img, params, *sequence)
+
+        coalesce_key = single_flight.key(image_id, name, params) if coalesce else None
+
+        pixels = operation_pixels(name, original_img, params)
+
+        payload, error = await _run_in_pool(
+            request, run_operation, name, original_img, params, coalesce_key=coalesce_key, pixels=pixels,
+        )
+
+        if error is not None:
+            return error
+
+        return _ok(payload)
+
+    view.__name__ = name
+
+    return view
+
+
+
+apply_adjustments = operation_view("apply_adjustments", coalesce=True, latest=True)
+resize_image = operation_view("resize_image")
+modify_geometry = operation_view("modify_geometry")
+edge_detection = operation_view("edge_detection", coalesce=True)
+channel_analysis = operation_view("channel_analysis")
@@ -0,0 +1,245 @@
+# compute.py
+import os
+import math
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from authentication.views import get_client_ip
+
+from .metrics import carry_timings
+from .profiling import profiled
+from .scheduler import PlanScheduler, INTERACTIVE, scheduler_config
+
+
+DEFAULT_IMAGE_COMPUTE = {
+    "EXECUTOR": "thread",        # The kernels release the GIL, "process" isolates them at a pickling cost
+    "WORKERS": os.cpu_count() or 1,
+    "MAX_QUEUE_DEPTH": 32,       # Work waiting for a worker before we answer 503, shared out to the lanes by weight
+    "MAX_IN_FLIGHT_PER_CLIENT": 4,  # Work a single client may have queued or running before 429
+    "RETRY_AFTER": 2,            # Seconds, sent back in the Retry-After header
+}
+
+
+
+class PoolSaturated(Exception):
+
+    """
+    Raised when the pool queue is past its configured depth. Maps to 503
+    """
+
+
+
+class ClientSaturated(Exception):
+
+    """
+    Raised when a single client already has too much work in the pool. Maps to 429
+    """
+
+
+
+class ComputePool:
+
+    """
+    Bounded pool for CPU heavy image work.
+
+    The pool counts work that is queued or running and refuses new work instead of letting
+    the backlog grow without limit. Admitted work is queued by plan in api/scheduler.py,
+    whose workers run it in their own thread or hand it to a process pool.
+
+    Every lane is admitted on its own: it may have as much work in flight as there are
+    workers, plus its share of MAX_QUEUE_DEPTH by weight. A capped lane with a backlog is
+    then refused on its own, it doesn't take the places other plans are admitted to.
+    """
+
+    def __init__(self, executor, workers, max_queue_depth, max_in_flight_per_client, retry_after):
+
+        self.executor_kind = executor
+        self.workers = workers
+        self.max_queue_depth = max_queue_depth
+        self.max_in_flight_per_client = max_in_flight_per_client
+        self.retry_after = retry_after
+
+        self._executor = None
+        self._scheduler = None
+        self._in_flight = 0
+        self._per_client = {}
+        self._per_lane = {}
+        self._lane_capacity = {}
+        self._lock = threading.Lock()
+
+
+    @property
+    def in_flight(self):
+
+        return self._in_flight
+
+
+    def submit(self, fn, *args, client=None, plan="", priority=INTERACTIVE, pixels=0):
+
+        """
+        Submits The Work To The Lane of The Plan and Returns a concurrent.futures.Future.
+        pixels is what the work costs its lane, see api/scheduler.py
+        """
+
+        scheduler = self._get_scheduler()
+
+        lane = scheduler.lane_for(plan).name
+
+        with self._lock:
+
+            if self._per_lane.get(lane, 0) >= self._lane_capacity[lane]:
+                raise PoolSaturated("Image workers are busy")
+
+            if client is not None and self._per_client.get(client, 0) >= self.max_in_flight_per_client:
+                raise ClientSaturated("Too many image requests in progress")
+
+            self._in_flight += 1
+            self._per_lane[lane] = self._per_lane.get(lane, 0) + 1
+
+            if client is not None:
+                self._per_client[client] = self._per_client.get(client, 0) + 1
+
+        # Stages timed and profiles taken on a worker thread belong to the submitting request,
+        # a process can't report back
+        if self.executor_kind == "thread":
+            fn = carry_timings(profiled(fn))
+
+        try:
+            future = scheduler.submit(fn, *args, plan=plan, priority=priority, pixels=pixels)
+        except Exception:
+            self._release(client, lane)
+            raise
+
+        future.add_done_callback(lambda _: self._release(client, lane))
+
+        return future
+
+
+    def _release(self, client, lane):
+
+        with self._lock:
+
+            self._in_flight -= 1
+            self._per_lane[lane] -= 1
+
+            if client is not None:
+
+                remaining = self._per_client.get(client, 1) - 1
+
+                if remaining > 0:
+                    self._per_client[client] = remaining
+                else:
+                    self._per_client.pop(client, None)
+
+
+    def stats(self):
+
+        lanes = self._scheduler.stats() if self._scheduler is not None else {}
+
+        for name, lane_stats in lanes.items():
+            lane_stats["in_flight"] = self._per_lane.get(name, 0)
+            lane_stats["capacity"] = self._lane_capacity[name]
+
+        return {
+            "in_flight": self._in_flight,
+            "capacity": sum(self._lane_capacity.values()),
+            "lanes": lanes,
+        }
+
+
+    def _run_in_thread(self, fn, args):
+
+        try:
+            return fn(*args)
+        finally:
+            # Job progress is written from here, the workers look after their own connections
+            close_old_connections()
+
+
+    def _run_in_process(self, fn, args):
+
+        return self._executor.submit(fn, *args).result()
+
+
+    def _get_scheduler(self):
+
+        # Created on first use so every server worker process gets its own pool after forking
+        if self._scheduler is None:
+
+            with self._lock:
+
+                if self._scheduler is None:
+
+                    config = scheduler_config()
+
+                    run_task = self._run_in_thread
+
+                    if self.executor_kind != "thread":
+                        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                        run_task = self._run_in_process
+
+                    scheduler = PlanScheduler(
+                        workers=self.workers,
+                        lanes=config["LANES"],
+                        default_lane=config["DEFAULT_LANE"],
+                        burst_seconds=config["BURST_SECONDS"],
+                        min_cost=config["MIN_COST"],
+                        run_task=run_task,
+                    )
+
+                    self._lane_capacity = lane_capacities(scheduler.lanes.values(), self.workers, self.max_queue_depth)
+                    self._scheduler = scheduler
+
+        return self._scheduler
+
+
+
+
+def lane_capacities(lanes, workers, max_queue_depth):
+
+    """
+    Work Each Lane May Have Queued or Running: Every Worker, Plus Its Share of The Queue by Weight
+    """
+
+    total_weight = sum(lane.weight for lane in lanes)
+
+    return {
+        lane.name: workers + max(1, math.ceil(max_queue_depth * lane.weight / total_weight))
+        for lane in lanes
+    }
+
+
+
+
+def client_key(request):
+
+    """
+    Key a Request's Work Is Counted Under For MAX_IN_FLIGHT_PER_CLIENT
+    """
+
+    user = getattr(request, "user", None)
+
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+
+    return f"ip:{get_client_ip(request)}"
+
+
+
+def _build_pool():
+
+    config = {**DEFAULT_IMAGE_COMPUTE, **getattr(settings, "IMAGE_COMPUTE", {})}
+
+    return ComputePool(
+        executor=config["EXECUTOR"],
+        workers=config["WORKERS"],
+        max_queue_depth=config["MAX_QUEUE_DEPTH"],
+        max_in_flight_per_client=config["MAX_IN_FLIGHT_PER_CLIENT"],
+        retry_after=config["RETRY_AFTER"],
+    )
+
+
+compute_pool = _build_pool()
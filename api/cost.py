@@ -0,0 +1,288 @@
+# cost.py
+import base64
+import binascii
+from io import BytesIO
+from typing import NamedTuple
+
+from PIL import Image
+from django.conf import settings
+
+from .image_store import mode_bytes_per_pixel
+from .imaging import native_mode
+from .metrics import timed
+from .operations import operation_pixels
+
+
+# Admission control from predicted cost.
+#
+# Uploads are sized from the image header alone, decoding only the first few KB of the
+# base64 payload, and operations from the cached original's size and the parameters.
+# Every kernel has calibrated coefficients (seconds per megapixel and peak bytes per pixel
+# of the pixels it works through, see the bench_kernels command), and the prediction is
+# held against the budgets of the user's plan and of the node before anything is allocated.
+# The coefficients are measured on RGB images. The kernels that work on every channel scale
+# them by the bytes per pixel of the image's mode, a grayscale image costs a third.
+
+
+DEFAULT_IMAGE_COST = {
+    "KERNELS": {
+        # FIXED_SECONDS + SECONDS_PER_MEGAPIXEL * megapixels, BYTES_PER_PIXEL * pixels at the peak,
+        # both for the compute and the PNG encoding of the result
+        "decode": {"FIXED_SECONDS": 0.001, "SECONDS_PER_MEGAPIXEL": 0.05, "BYTES_PER_PIXEL": 7},
+        "apply_adjustments": {"FIXED_SECONDS": 0.002, "SECONDS_PER_MEGAPIXEL": 0.035, "BYTES_PER_PIXEL": 16},
+        "resize_image": {"FIXED_SECONDS": 0.002, "SECONDS_PER_MEGAPIXEL": 0.28, "BYTES_PER_PIXEL": 13},
+        "modify_geometry": {"FIXED_SECONDS": 0.002, "SECONDS_PER_MEGAPIXEL": 0.2, "BYTES_PER_PIXEL": 6},
+        "edge_detection": {"FIXED_SECONDS": 0.002, "SECONDS_PER_MEGAPIXEL": 0.1, "BYTES_PER_PIXEL": 11},
+        "channel_analysis": {"FIXED_SECONDS": 0.002, "SECONDS_PER_MEGAPIXEL": 1.6, "BYTES_PER_PIXEL": 12},
+    },
+    "PLANS": {
+        # MAX_PIXELS: largest image worked on, MAX_PEAK_BYTES: memory one request may need,
+        # MAX_SYNC_SECONDS: longer work is queued as a job instead of holding the request
+        "anonymous": {"MAX_PIXELS": 12_000_000, "MAX_PEAK_BYTES": 256 * 1024 * 1024, "MAX_SYNC_SECONDS": 2},
+        "": {"MAX_PIXELS": 25_000_000, "MAX_PEAK_BYTES": 512 * 1024 * 1024, "MAX_SYNC_SECONDS": 5},
+        "free": {"MAX_PIXELS": 25_000_000, "MAX_PEAK_BYTES": 512 * 1024 * 1024, "MAX_SYNC_SECONDS": 5},
+        "pro": {"MAX_PIXELS": 100_000_000, "MAX_PEAK_BYTES": 2 * 1024 * 1024 * 1024, "MAX_SYNC_SECONDS": 15},
+    },
+    "DEFAULT_PLAN": "",
+    "NODE_MAX_PEAK_BYTES": 2 * 1024 * 1024 * 1024,   # No single request may need more, whatever the plan
+    "DOWNSCALE_UPLOADS": True,   # Oversized JPEGs are decoded at a reduced size instead of being rejected
+    "PROBE_BYTES": 64 * 1024,    # Decoded bytes the header is looked for in before decoding it all
+}
+
+
+def cost_config():
+
+    configured = getattr(settings, "IMAGE_COST", {})
+
+    return {
+        **DEFAULT_IMAGE_COST,
+        **configured,
+        "KERNELS": {**DEFAULT_IMAGE_COST["KERNELS"], **configured.get("KERNELS", {})},
+        "PLANS": {**DEFAULT_IMAGE_COST["PLANS"], **configured.get("PLANS", {})},
+    }
+
+
+
+# Admission decisions
+ADMIT = "admit"
+QUEUE = "queue"
+DOWNSCALE = "downscale"
+REJECT = "reject"
+
+
+
+
+class ImageHeader(NamedTuple):
+
+    width: int
+    height: int
+    mode: str
+    format: str
+
+    @property
+    def pixels(self):
+
+        return self.width * self.height
+
+
+
+class Estimate(NamedTuple):
+
+    kernel: str
+    pixels: int
+    seconds: float
+    peak_bytes: int
+
+    def as_dict(self):
+
+        return {
+            "kernel": self.kernel,
+            "megapixels": round(self.pixels / 1_000_000, 2),
+            "seconds": round(self.seconds, 3),
+            "peak_bytes": self.peak_bytes,
+        }
+
+
+
+class Decision(NamedTuple):
+
+    action: str
+    reason: str = ""
+    estimate: Estimate = None
+    size: tuple = None          # (width, height) to downscale to
+
+
+
+
+def _base64_payload(image_base64):
+
+    if "," in image_base64:
+        return image_base64.split(",", 1)[1]
+
+    return image_base64
+
+
+
+@timed("admit")
+def probe_base64(image_base64, probe_bytes=None):
+
+    """
+    Reads The Dimensions of a Base64 Image From Its Header Without Decoding The Pixels.
+    Only a prefix is base64-decoded, the whole payload only when the header lies further in
+    (a JPEG with a large EXIF block). Raises ValueError
+    """
+
+    probe_bytes = probe_bytes or cost_config()["PROBE_BYTES"]
+
+    payload = _base64_payload(image_base64)
+
+    # 4 base64 characters per 3 bytes, cut on a 4 character boundary
+    prefix = payload[:(probe_bytes // 3) * 4]
+
+    for data in (prefix, payload) if len(prefix) < len(payload) else (payload,):
+
+        try:
+            decoded = base64.b64decode(data)
+        except (binascii.Error, ValueError):
+            raise ValueError("Invalid base64 data")
+
+        try:
+            # Image.open only parses the header, the pixels are decoded on load()
+            with Image.open(BytesIO(decoded)) as img:
+                return ImageHeader(img.width, img.height, img.mode, img.format)
+        except Exception:
+            continue
+
+    raise ValueError("Invalid image file")
+
+
+
+# Kernels working on every channel of the native image, the others convert it to L or RGB first
+PER_CHANNEL_KERNELS = {"decode", "apply_adjustments", "resize_image", "modify_geometry"}
+
+RGB_BYTES_PER_PIXEL = 3
+
+
+
+def mode_factor(kernel, mode):
+
+    """
+    How Much a Kernel Costs on an Image in mode Compared To RGB
+    """
+
+    if mode is None or kernel not in PER_CHANNEL_KERNELS:
+        return 1.0
+
+    return mode_bytes_per_pixel(native_mode(mode)) / RGB_BYTES_PER_PIXEL
+
+
+
+def estimate(kernel, pixels, config=None, mode=None):
+
+    config = config or cost_config()
+
+    coefficients = config["KERNELS"][kernel]
+    factor = mode_factor(kernel, mode)
+
+    return Estimate(
+        kernel=kernel,
+        pixels=pixels,
+        seconds=coefficients["FIXED_SECONDS"] + coefficients["SECONDS_PER_MEGAPIXEL"] * factor * pixels / 1_000_000,
+        peak_bytes=int(coefficients["BYTES_PER_PIXEL"] * factor * pixels),
+    )
+
+
+
+def plan_budget(plan, config=None):
+
+    config = config or cost_config()
+
+    return config["PLANS"].get(plan) or config["PLANS"][config["DEFAULT_PLAN"]]
+
+
+
+def _peak_limit(budget, config):
+
+    return min(budget["MAX_PEAK_BYTES"], config["NODE_MAX_PEAK_BYTES"])
+
+
+
+def _over_budget(prediction, budget, config):
+
+    """
+    Returns Why The Prediction Doesn't Fit, or None
+    """
+
+    if prediction.pixels > budget["MAX_PIXELS"]:
+        return f"The image would be {prediction.pixels / 1_000_000:.1f} MP, the limit is {budget['MAX_PIXELS'] / 1_000_000:.1f} MP"
+
+    peak_limit = _peak_limit(budget, config)
+
+    if prediction.peak_bytes > peak_limit:
+        return f"The request would need {prediction.peak_bytes // (1024 * 1024)} MB, the limit is {peak_limit // (1024 * 1024)} MB"
+
+    return None
+
+
+
+@timed("admit")
+def admit_upload(plan, header):
+
+    """
+    Decides on an Upload From Its Header: Admit, Downscale (JPEG only, decoded reduced) or Reject
+    """
+
+    config = cost_config()
+    budget = plan_budget(plan, config)
+
+    prediction = estimate("decode", header.pixels, config, header.mode)
+
+    reason = _over_budget(prediction, budget, config)
+
+    if reason is None:
+        return Decision(ADMIT, estimate=prediction)
+
+    # JPEG decoders scale by 1/2, 1/4 or 1/8 while decoding, so the full size is never allocated
+    if config["DOWNSCALE_UPLOADS"] and header.format == "JPEG":
+
+        scale = min(1.0, (budget["MAX_PIXELS"] / header.pixels) ** 0.5)
+
+        size = (max(1, int(header.width * scale)), max(1, int(header.height * scale)))
+
+        # The largest reduction that still covers the size is what the decoder allocates
+        reduction = next(
+            factor for factor in (8, 4, 2, 1)
+            if factor == 1 or (header.width // factor >= size[0] and header.height // factor >= size[1])
+        )
+
+        reduced = estimate("decode", header.pixels // (reduction * reduction), config, header.mode)
+
+        # It is scaled down to the pixel limit right after, only its memory has to fit
+        if reduced.peak_bytes <= _peak_limit(budget, config):
+            return Decision(DOWNSCALE, reason, reduced, size)
+
+    return Decision(REJECT, reason, prediction)
+
+
+
+@timed("admit")
+def admit_operation(plan, name, original_img, params):
+
+    """
+    Decides on an Operation Over a Cached Original: Admit, Queue as a Job or Reject
+    """
+
+    config = cost_config()
+    budget = plan_budget(plan, config)
+
+    prediction = estimate(name, operation_pixels(name, original_img, params), config, original_img.mode)
+
+    reason = _over_budget(prediction, budget, config)
+
+    if reason is not None:
+        return Decision(REJECT, reason, prediction)
+
+    if prediction.seconds > budget["MAX_SYNC_SECONDS"]:
+        return Decision(QUEUE, f"The request would take about {prediction.seconds:.1f} s", prediction)
+
+    return Decision(ADMIT, estimate=prediction)
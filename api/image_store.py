@@ -0,0 +1,274 @@
+# image_store.py
+import time
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+from django.conf import settings
+
+from authentication.views import get_client_ip
+
+from .metrics import timed
+
+
+DEFAULT_IMAGE_STORE = {
+    "TTL": 60 * 10,                            # Sliding, refreshed on every access
+    "MAX_BYTES": 1024 * 1024 * 1024,           # Global budget for all cached images
+    "MAX_BYTES_PER_USER": 256 * 1024 * 1024,   # Budget for a single user, or anonymous client IP
+}
+
+
+# Bytes used by a single band for the PIL modes we deal with
+BYTES_PER_BAND = {
+    "1": 1,
+    "L": 1,
+    "P": 1,
+    "I;16": 2,
+    "I;16B": 2,
+    "I;16L": 2,
+    "I": 4,
+    "F": 4,
+}
+
+
+class ImageTooLarge(Exception):
+
+    """
+    Raised when a single image is bigger than the per-user budget and can never fit
+    """
+
+
+
+class _Entry:
+
+    __slots__ = ("value", "owner", "nbytes", "expires_at")
+
+    def __init__(self, value, owner, nbytes, expires_at):
+
+        self.value = value
+        self.owner = owner
+        self.nbytes = nbytes
+        self.expires_at = expires_at
+
+
+
+class ImageStore:
+
+    """
+    In-process store for decoded images.
+
+    Entries are kept in LRU order with a sliding TTL. Every entry records its byte cost
+    and the user who owns it, so a user going over their budget only evicts their own
+    images, and the global budget evicts the least recently used images of anyone.
+    """
+
+    def __init__(self, ttl, max_bytes, max_bytes_per_user):
+
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_bytes_per_user = max_bytes_per_user
+
+        self._entries = OrderedDict()
+        self._user_bytes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+
+    @timed("cache_get")
+    def get(self, key):
+
+        """
+        Returns The Image Stored Under The Key and Refreshes Its TTL, or None
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry.expires_at <= now:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            entry.expires_at = now + self.ttl
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return entry.value
+
+
+    @timed("cache_set")
+    def set(self, key, value, owner=None):
+
+        """
+        Stores The Image Under The Key, Evicting Older Images To Stay Within Budget
+        """
+
+        nbytes = image_nbytes(value)
+
+        if nbytes > self.max_bytes_per_user or nbytes > self.max_bytes:
+            raise ImageTooLarge(f"Image needs {nbytes} bytes, more than the allowed budget")
+
+        with self._lock:
+
+            if key in self._entries:
+                self._remove(key)
+
+            self._purge_expired()
+
+            # First make room within the owner's own budget
+            while self._user_bytes.get(owner, 0) + nbytes > self.max_bytes_per_user:
+                self._evict_oldest(owner=owner)
+
+            # Then within the global budget
+            while self._bytes + nbytes > self.max_bytes:
+                self._evict_oldest()
+
+            self._entries[key] = _Entry(value, owner, nbytes, time.monotonic() + self.ttl)
+            self._user_bytes[owner] = self._user_bytes.get(owner, 0) + nbytes
+            self._bytes += nbytes
+
+
+    def delete(self, key):
+
+        with self._lock:
+
+            if key in self._entries:
+                self._remove(key)
+
+
+    def clear(self):
+
+        with self._lock:
+
+            self._entries.clear()
+            self._user_bytes.clear()
+            self._bytes = 0
+
+
+    def stats(self):
+
+        """
+        Returns The Counters of The Store as a Dictionary
+        """
+
+        with self._lock:
+
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "max_bytes_per_user": self.max_bytes_per_user,
+                "users": len(self._user_bytes),
+                "top_users": sorted(
+                    ({"owner": str(owner), "bytes": used} for owner, used in self._user_bytes.items()),
+                    key=lambda item: item["bytes"],
+                    reverse=True,
+                )[:10],
+            }
+
+
+    def _remove(self, key):
+
+        entry = self._entries.pop(key)
+
+        self._bytes -= entry.nbytes
+
+        remaining = self._user_bytes[entry.owner] - entry.nbytes
+
+        if remaining > 0:
+            self._user_bytes[entry.owner] = remaining
+        else:
+            del self._user_bytes[entry.owner]
+
+
+    def _evict_oldest(self, owner=None):
+
+        # Entries are in LRU order, so the first match is the least recently used
+        for key, entry in self._entries.items():
+
+            if owner is None or entry.owner == owner:
+                self._remove(key)
+                self.evictions += 1
+                return
+
+        raise ImageTooLarge("Nothing left to evict")
+
+
+    def _purge_expired(self):
+
+        now = time.monotonic()
+
+        expired = [key for key, entry in self._entries.items() if entry.expires_at <= now]
+
+        for key in expired:
+            self._remove(key)
+            self.expirations += 1
+
+
+
+
+def image_nbytes(img):
+
+    """
+    Returns The Number of Bytes a Decoded PIL Image Holds In Memory
+    """
+
+    return img.width * img.height * mode_bytes_per_pixel(img.mode)
+
+
+
+def mode_bytes_per_pixel(mode):
+
+    """
+    Returns The Number of Bytes a Pixel Takes in a PIL Mode
+    """
+
+    return Image.getmodebands(mode) * BYTES_PER_BAND.get(mode, 1)
+
+
+
+def image_owner(request):
+
+    """
+    Returns The Key That Image Quotas Are Counted Against For The Request.
+    Anonymous uploads are counted per client IP, so one heavy uploader only evicts its own images
+    """
+
+    user = getattr(request, "user", None)
+
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+
+    return f"ip:{get_client_ip(request)}"
+
+
+
+def _build_store():
+
+    config = {**DEFAULT_IMAGE_STORE, **getattr(settings, "IMAGE_STORE", {})}
+
+    return ImageStore(
+        ttl=config["TTL"],
+        max_bytes=config["MAX_BYTES"],
+        max_bytes_per_user=config["MAX_BYTES_PER_USER"],
+    )
+
+
+image_store = _build_store()
@@ -0,0 +1,734 @@
+# imaging.py
+import base64
+from io import BytesIO
+import numpy as np
+import math
+
+from PIL import Image
+
+from .memory import memory_ledger
+from .metrics import stage
+from .strips import run_strips
+
+
+
+def base64_to_image(base64_string):
+    """
+    Convert a base64 string (with data:image/...) into a PIL Image.
+    Raises ValueError if invalid.
+    """
+    if "," in base64_string:
+        _, base64_data = base64_string.split(",", 1)
+    else:
+        base64_data = base64_string
+
+    try:
+
+        decoded = base64.b64decode(base64_data)
+
+    except Exception:
+
+        raise ValueError("Invalid base64 data")
+
+    try:
+
+        img = Image.open(BytesIO(decoded))
+        img.verify()   # verify first
+        img = Image.open(BytesIO(decoded))  # re-open after verify()
+        return img
+    
+    except Exception:
+
+        raise ValueError("Invalid image file")
+
+
+
+def image_to_base64(pil_image, fmt="PNG"):
+    """
+    Convert a PIL Image to a Base64 data URL.
+    """
+    buffer = BytesIO()
+
+    with stage("encode"):
+        pil_image.save(buffer, format=fmt)
+
+    with stage("base64"):
+        encoded = base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+    return f"data:image/{fmt.lower()};base64,{encoded}"
+
+
+
+# Modes images are kept and processed in. Grayscale stays one channel, alpha and 16 bits are kept
+NATIVE_MODES = ("L", "LA", "RGB", "RGBA", "I;16")
+
+# The native mode other modes PIL decodes to are converted to, RGB for anything not listed
+NATIVE_CONVERSIONS = {
+    "1": "L",
+    "F": "L",
+    "La": "LA",
+    "PA": "RGBA",
+    "RGBa": "RGBA",
+    "I": "I;16",
+    "I;16B": "I;16",
+    "I;16L": "I;16",
+    "I;16N": "I;16",
+}
+
+
+
+def native_mode(mode, transparency=False):
+
+    """
+    The Native Mode an Image in mode Is Kept In. Palette Images With Transparency Keep It as RGBA
+    """
+
+    if mode in NATIVE_MODES:
+        return mode
+
+    if mode == "P":
+        return "RGBA" if transparency else "RGB"
+
+    return NATIVE_CONVERSIONS.get(mode, "RGB")
+
+
+
+def to_native(img):
+
+    """
+    Converts a PIL Image To Its Native Mode, Only When It Isn't in One Already
+    """
+
+    mode = native_mode(img.mode, "transparency" in img.info)
+
+    return img if mode == img.mode else img.convert(mode)
+
+
+
+def split_alpha(pixels):
+
+    """
+    Returns (color, alpha) of an Array in a Native Layout, alpha Is None Without an Alpha Channel.
+    The Color of a Gray and Alpha Array Is (H, W)
+    """
+
+    if pixels.ndim == 3 and pixels.shape[2] in (2, 4):
+        return (pixels[:, :, 0] if pixels.shape[2] == 2 else pixels[:, :, :3]), pixels[:, :, -1]
+
+    return pixels, None
+
+
+
+def to_8bit(pixels):
+
+    """
+    uint16 Pixels Scaled Down To uint8, Rounded. uint8 Pixels Are Returned As They Are
+    """
+
+    if pixels.dtype == np.uint8:
+        return pixels
+
+    return ((pixels.astype(np.uint32) * 255 + 32767) // 65535).astype(np.uint8)
+
+
+
+def report_progress(progress, fraction):
+
+    """
+    Calls The Optional Progress Callback of a Kernel With a Fraction Between 0 and 1
+    """
+
+    if progress is not None:
+        progress(min(max(fraction, 0.0), 1.0))
+
+
+
+# Bytes per pixel and channel adjust_pixels allocates (float32 copies, HSV), measured with tracemalloc
+ADJUSTMENT_SCRATCH_BYTES = 28
+
+
+
+def apply_adjustments(img, brightness=0, saturation=1, gamma=1.0, contrast=1, progress=None, threads=None):
+
+    """
+    Applies The Adjustments Band by Band, In Parallel For Large Images
+    """
+
+    src = np.asarray(img)
+    channels = src.shape[2] if src.ndim == 3 else 1
+
+    def band(start, stop):
+        out[start:stop] = adjust_pixels(src[start:stop], brightness, saturation, gamma, contrast)
+
+    with memory_ledger.reserve(src.nbytes):
+
+        out = np.empty(src.shape, dtype=src.dtype)
+
+        run_strips(
+            band, src.shape[0], src.shape[1], threads=threads, progress=progress,
+            scratch_per_pixel=ADJUSTMENT_SCRATCH_BYTES * channels,
+        )
+
+    return Image.fromarray(out)
+
+
+
+def adjust_pixels(pixels, brightness=0, saturation=1, gamma=1.0, contrast=1):
+
+    """
+    Per Pixel Adjustments of an (H, W) Gray, (H, W, 2) Gray and Alpha, (H, W, 3) RGB or (H, W, 4)
+    RGBA Array of uint8 or uint16. Returns a New Array of The Same Shape and dtype, Alpha Untouched.
+    The Parameters Are in 8-bit Units and Scaled For 16-bit Pixels
+    """
+
+    color, alpha = split_alpha(pixels)
+
+    if alpha is not None:
+
+        out = np.empty_like(pixels)
+        out[:, :, :-1] = adjust_pixels(color, brightness, saturation, gamma, contrast).reshape(out.shape[:2] + (-1,))
+        out[:, :, -1] = alpha
+
+        return out
+
+    maximum = float(np.iinfo(pixels.dtype).max)
+    scale = maximum / 255
+
+    arr = pixels.astype(np.float32)
+
+    # Brightness
+
+    if brightness != 0:
+        arr = np.clip(arr + float(brightness) * scale, 0, maximum)
+
+    
+    if contrast != 1:
+        
+        arr = np.clip((arr - 128.0 * scale) * contrast + 128.0 * scale, 0, maximum)
+
+    # Gamma correction
+    if gamma != 1.0:
+        arr = np.clip(maximum * ((arr / maximum) ** (1 / gamma)), 0, maximum)
+
+    # Saturatoin, gray pixels have none
+    if saturation != 0 and arr.ndim == 3:
+
+        # Imported on first use, matplotlib takes longer to import than the rest of the app
+        import matplotlib.colors as mcolors
+
+        hsv_array = mcolors.rgb_to_hsv(arr / maximum)
+        hsv_array[:,:,1] = np.clip(hsv_array[:,:,1] * saturation, 0, 1)
+        arr = mcolors.hsv_to_rgb(hsv_array) * maximum
+
+    return arr.astype(pixels.dtype)
+
+
+
+def apply_adjustments_reference(img, brightness=0, saturation=1, gamma=1.0, contrast=1):
+
+    """
+    Whole-Array Implementation of The Original Endpoint, For 8-bit RGB. Kept To Check apply_adjustments Against
+    """
+
+    import matplotlib.colors as mcolors
+
+    arr = np.array(img).astype(np.float32)
+
+    # Brightness
+
+    if brightness != 0:
+        arr = np.clip(arr + float(brightness), 0, 255)
+
+    
+    if contrast != 1:
+        
+        arr = np.clip((arr - 128.0) * contrast + 128.0, 0, 255)
+
+    # Gamma correction
+    if gamma != 1.0:
+        arr = np.clip(255 * ((arr / 255) ** (1 / gamma)), 0, 255)
+
+    # Saturatoin
+    if saturation != 0:
+        
+        hsv_array = mcolors.rgb_to_hsv(arr.astype(np.float32) / 255.0)
+        hsv_array[:,:,1] = np.clip(hsv_array[:,:,1] * saturation, 0, 1)
+        arr = mcolors.hsv_to_rgb(hsv_array)*255
+
+    return Image.fromarray(arr.astype(np.uint8))
+
+
+
+
+
+# Bytes per output pixel and channel of a bl_resize band (gathered rows, float64 blends), measured with tracemalloc
+RESIZE_SCRATCH_BYTES = 40
+
+
+
+def bl_resize(original_img, new_h, new_w, progress=None, threads=None):
+    """
+    Resize an image using Bilinear Interpolation.
+
+    Vectorized per band of output rows, computing exactly what bl_resize_reference does.
+
+    Parameters:
+        original_img (numpy.ndarray): (H, W, C) or (H, W) image, uint8 or uint16
+        new_h (int): desired height
+        new_w (int): desired width
+        progress (callable): optional, called with the fraction of rows done
+        threads (int): optional, overrides the strip pool size
+
+    Returns:
+        numpy.ndarray: resized image (new_h, new_w, C) or (new_h, new_w)
+    """
+
+    if new_h <= 0 or new_w <= 0:
+        raise ValueError("new_h and new_w must be positive integers")
+
+    squeeze = original_img.ndim == 2
+
+    if squeeze:
+        original_img = original_img[:, :, np.newaxis]
+
+    old_h, old_w, c = original_img.shape
+
+    x0, x1, x_fraction = bilinear_axis(old_h, new_h)
+    y0, y1, y_fraction = bilinear_axis(old_w, new_w)
+
+    dx = x_fraction[:, np.newaxis, np.newaxis]
+    dy = y_fraction[np.newaxis, :, np.newaxis]
+
+    def band(start, stop):
+        resized[start:stop] = bilinear_blend(original_img[x0[start:stop]], original_img[x1[start:stop]], y0, y1, dy, dx[start:stop])
+
+    with memory_ledger.reserve(new_h * new_w * c * original_img.itemsize):
+
+        resized = np.empty((new_h, new_w, c), dtype=original_img.dtype)
+
+        run_strips(band, new_h, new_w, threads=threads, progress=progress, scratch_per_pixel=RESIZE_SCRATCH_BYTES * c)
+
+    return resized[:, :, 0] if squeeze else resized
+
+
+
+def bilinear_axis(old, new):
+
+    """
+    Source Neighbours and Blend Weights Along One Axis: (lower index, upper index, distance
+    to the lower one) For Every Output Position, Pixel Centers Mapped Then Indices Clamped
+    """
+
+    position = (np.arange(new) + 0.5) * (old / new) - 0.5
+
+    lower = np.clip(np.floor(position).astype(np.intp), 0, old - 1)
+    upper = np.clip(np.floor(position).astype(np.intp) + 1, 0, old - 1)
+
+    # Distances use the clamped index
+    return lower, upper, position - lower
+
+
+
+def bilinear_blend(top_rows, bottom_rows, y0, y1, dy, dx):
+
+    """
+    Blends The Gathered Source Rows Above and Below a Band of Output Rows Into Pixels of
+    Their dtype, uint8 or uint16
+    """
+
+    top = top_rows[:, y0] * (1 - dy) + top_rows[:, y1] * dy
+    bottom = bottom_rows[:, y0] * (1 - dy) + bottom_rows[:, y1] * dy
+
+    pixel = top * (1 - dx) + bottom * dx
+
+    # Same float32 rounding as the reference before clipping and truncating
+    return np.clip(pixel.astype(np.float32), 0, np.iinfo(top_rows.dtype).max).astype(top_rows.dtype)
+
+
+
+def bl_resize_reference(original_img, new_h, new_w, progress=None):
+    """
+    Resize an image using Bilinear Interpolation.
+
+    Pixel by pixel reference implementation, kept to check bl_resize against.
+
+    Parameters:
+        original_img (numpy.ndarray): (H, W, C) image
+        new_h (int): desired height
+        new_w (int): desired width
+        progress (callable): optional, called with the fraction of rows done
+
+    Returns:
+        numpy.ndarray: resized image (new_h, new_w, C)
+    """
+
+    old_h, old_w, c = original_img.shape
+
+    if new_h <= 0 or new_w <= 0:
+        raise ValueError("new_h and new_w must be positive integers")
+
+    # Create output image
+    resized = np.zeros((new_h, new_w, c), dtype=np.float32)
+
+    # Scaling factors
+    h_scale = old_h / new_h
+    w_scale = old_w / new_w
+
+    for i in range(new_h):
+        for j in range(new_w):
+
+            # Map pixel centers
+            x = (i + 0.5) * h_scale - 0.5
+            y = (j + 0.5) * w_scale - 0.5
+
+            # Neighbor pixel indices
+            x0 = int(math.floor(x))
+            y0 = int(math.floor(y))
+            x1 = x0 + 1
+            y1 = y0 + 1
+
+            # Clamp indices
+            x0 = max(0, min(x0, old_h - 1))
+            x1 = max(0, min(x1, old_h - 1))
+            y0 = max(0, min(y0, old_w - 1))
+            y1 = max(0, min(y1, old_w - 1))
+
+            # Distances
+            dx = x - x0
+            dy = y - y0
+
+            # Four neighboring pixels
+            p00 = original_img[x0, y0]
+            p01 = original_img[x0, y1]
+            p10 = original_img[x1, y0]
+            p11 = original_img[x1, y1]
+
+            # Bilinear interpolation
+            top = p00 * (1 - dy) + p01 * dy
+            bottom = p10 * (1 - dy) + p11 * dy
+            pixel = top * (1 - dx) + bottom * dx
+
+            resized[i, j] = pixel
+
+        report_progress(progress, (i + 1) / new_h)
+
+    # Clip and convert to uint8
+    resized = np.clip(resized, 0, 255)
+    return resized.astype(np.uint8)
+
+
+
+
+GEOMETRY_OPERATIONS = {
+    'r': lambda x: np.rot90(x, k=1),
+    '-r': lambda x: np.rot90(x, k=3),
+    'vf': np.flipud,
+    'hf': np.fliplr,
+}
+
+
+
+def change_geometry(original_array: np.ndarray, change: str) -> np.ndarray | None:
+
+    operation = GEOMETRY_OPERATIONS.get(change)
+    if not operation:
+        return None
+
+    return operation(original_array)
+
+
+
+def change_geometry_reference(original_array, change):
+
+    """
+    Reference Implementation Mapping Every Output Pixel To Its Source Index, Kept To Check change_geometry Against
+    """
+
+    h, w = original_array.shape[:2]
+
+    if change in ('r', '-r'):
+        # Output is (w, h), row i and column j of it come from column w - 1 - i (left) or i (right)
+        i, j = np.arange(w)[:, None], np.arange(h)[None, :]
+        return original_array[j, w - 1 - i] if change == 'r' else original_array[h - 1 - j, i]
+
+    i, j = np.arange(h)[:, None], np.arange(w)[None, :]
+
+    if change == 'vf':
+        return original_array[h - 1 - i, j]
+
+    if change == 'hf':
+        return original_array[i, w - 1 - j]
+
+    return None
+
+
+
+
+# Bytes per pixel of a Sobel band (float32 padded copy, gradients, temporaries), measured with tracemalloc
+SOBEL_SCRATCH_BYTES = 32
+
+
+
+def sobel_edge_detection(grayscale_image_array, progress=None, threads=None):
+
+    """
+    Sobel Edge Detection, Vectorized per Band of Rows With a One Row Halo.
+
+    The gradient magnitudes are kept for the normalization when memory allows, otherwise
+    they are computed twice, once for the global maximum and once to normalize
+    """
+
+    h, w = grayscale_image_array.shape
+
+    def gradient(start, stop):
+
+        # The band with one row above and below and a column either side, edges repeated
+        rows = np.clip(np.arange(start - 1, stop + 1), 0, h - 1)
+        p = np.pad(grayscale_image_array[rows].astype(np.float32), ((0, 0), (1, 1)), mode="edge")
+
+        return sobel_magnitude(p)
+
+    # The edges must fit, the magnitudes only when there is room for them
+    with memory_ledger.reserve(h * w), memory_ledger.reserve(h * w * 4, minimum=0) as keep:
+
+        edges = np.zeros((h, w), dtype=np.uint8)
+
+        if keep.nbytes:
+            normalize = _sobel_from_magnitudes(gradient, h, w, threads, progress)
+        else:
+            normalize = _sobel_recomputed(gradient, h, w, threads, progress)
+
+        # Normalize to 0-255 against the global maximum
+        if normalize is not None:
+            run_strips(lambda start, stop: normalize(edges, start, stop), h, w, threads=threads, scratch_per_pixel=SOBEL_SCRATCH_BYTES)
+
+    return Image.fromarray(edges)
+
+
+
+def sobel_magnitude(p):
+
+    """
+    Gradient Magnitudes of a float32 Block Padded With One Pixel on Every Side, For Its Interior
+    """
+
+    # Sobel X: [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]]
+    gx = (p[:-2, 2:] - p[:-2, :-2]) + 2 * (p[1:-1, 2:] - p[1:-1, :-2]) + (p[2:, 2:] - p[2:, :-2])
+
+    # Sobel Y: [[-1, -2, -1], [0, 0, 0], [1, 2, 1]]
+    gy = (p[2:, :-2] - p[:-2, :-2]) + 2 * (p[2:, 1:-1] - p[:-2, 1:-1]) + (p[2:, 2:] - p[:-2, 2:])
+
+    return np.sqrt(gx * gx + gy * gy)
+
+
+
+def _sobel_from_magnitudes(gradient, h, w, threads, progress):
+
+    magnitude = np.empty((h, w), dtype=np.float32)
+
+    def band(start, stop):
+        magnitude[start:stop] = gradient(start, stop)
+
+    run_strips(band, h, w, threads=threads, progress=progress, scratch_per_pixel=SOBEL_SCRATCH_BYTES)
+
+    peak = magnitude.max()
+
+    if peak == 0:
+        return None
+
+    def normalize(edges, start, stop):
+        edges[start:stop] = ((magnitude[start:stop] / peak) * 255).astype(np.uint8)
+
+    return normalize
+
+
+
+def _sobel_recomputed(gradient, h, w, threads, progress):
+
+    maxima = []
+
+    def band(start, stop):
+        maxima.append(gradient(start, stop).max())
+
+    run_strips(band, h, w, threads=threads, progress=progress, scratch_per_pixel=SOBEL_SCRATCH_BYTES)
+
+    peak = max(maxima)
+
+    if peak == 0:
+        return None
+
+    def normalize(edges, start, stop):
+        edges[start:stop] = ((gradient(start, stop) / peak) * 255).astype(np.uint8)
+
+    return normalize
+
+
+
+def sobel_edge_detection_reference(grayscale_image_array, progress=None):
+
+    """
+    Pixel by Pixel Reference Implementation, Kept To Check sobel_edge_detection Against
+    """
+
+    img_array = grayscale_image_array.astype(np.float32)
+
+    # Define Sobel kernels
+    sobel_x = np.array([[-1, 0, 1],
+                        [-2, 0, 2],
+                        [-1, 0, 1]], dtype=np.float32)
+
+    sobel_y = np.array([[-1, -2, -1],
+                        [0, 0, 0],
+                        [1, 2, 1]], dtype=np.float32)
+
+    # Apply convolution
+    # Create padded image to handle borders during convolution
+    padded_img = np.pad(img_array, 1, mode='edge')
+    
+    gradient_x = np.zeros_like(img_array)
+    gradient_y = np.zeros_like(img_array)
+
+    for i in range(img_array.shape[0]):
+        for j in range(img_array.shape[1]):
+            # Extract 3x3 window
+            window = padded_img[i:i+3, j:j+3]
+            gradient_x[i, j] = np.sum(window * sobel_x)
+            gradient_y[i, j] = np.sum(window * sobel_y)
+
+        report_progress(progress, (i + 1) / img_array.shape[0])
+
+    # Calculate magnitude of the gradient
+    magnitude = np.sqrt(gradient_x**2 + gradient_y**2)
+
+    # Normalize to 0-255 and convert to uint8 for saving
+    magnitude = (magnitude / magnitude.max()) * 255
+    edge_image = Image.fromarray(magnitude.astype(np.uint8))
+
+    return edge_image
+
+
+
+
+def sobel_edge_detection_vectorized(grayscale_image_array):
+    # Convert to float
+    img = grayscale_image_array.astype(np.float32)
+
+    # Sobel kernels
+    sobel_x = np.array([[-1, 0, 1],
+                        [-2, 0, 2],
+                        [-1, 0, 1]], dtype=np.float32)
+
+    sobel_y = np.array([[-1, -2, -1],
+                        [ 0,  0,  0],
+                        [ 1,  2,  1]], dtype=np.float32)
+
+    # Pad image
+    padded = np.pad(img, 1, mode="edge")
+
+    # Extract shifted windows (vectorized convolution)
+    gx = (
+        sobel_x[0,0] * padded[:-2, :-2] + sobel_x[0,1] * padded[:-2, 1:-1] + sobel_x[0,2] * padded[:-2, 2:] +
+        sobel_x[1,0] * padded[1:-1, :-2] + sobel_x[1,1] * padded[1:-1, 1:-1] + sobel_x[1,2] * padded[1:-1, 2:] +
+        sobel_x[2,0] * padded[2:, :-2] + sobel_x[2,1] * padded[2:, 1:-1] + sobel_x[2,2] * padded[2:, 2:]
+    )
+
+    gy = (
+        sobel_y[0,0] * padded[:-2, :-2] + sobel_y[0,1] * padded[:-2, 1:-1] + sobel_y[0,2] * padded[:-2, 2:] +
+        sobel_y[1,0] * padded[1:-1, :-2] + sobel_y[1,1] * padded[1:-1, 1:-1] + sobel_y[1,2] * padded[1:-1, 2:] +
+        sobel_y[2,0] * padded[2:, :-2] + sobel_y[2,1] * padded[2:, 1:-1] + sobel_y[2,2] * padded[2:, 2:]
+    )
+
+    # Gradient magnitude
+    magnitude = np.sqrt(gx**2 + gy**2)
+
+    # Normalize
+    magnitude = (magnitude / magnitude.max()) * 255
+
+    return Image.fromarray(magnitude.astype(np.uint8))
+
+
+
+
+def channel_splitting(original_image_array):
+
+    """
+    Takes a numpy array and Returns Red, Green & Blue Only Channel Images and also Returns the Channel Contribution of R,G,B
+    """
+
+    # Extract the R, G, B Arrays
+
+    R = original_image_array[:,:,0]
+    G = original_image_array[:,:,1]
+    B = original_image_array[:,:,2]
+
+    
+    # One zeroed array of the same shape (H,W,C) for all three images, each channel is filled in
+    # for its image and zeroed again after, so only one full-size copy is ever allocated
+    with memory_ledger.reserve(original_image_array.nbytes):
+
+        zeros_original = np.zeros_like(original_image_array)
+
+        # Image from Red Channel
+        zeros_original[:,:,0] = R # Fill in the Values for Red Channel and Kepp all others Zero
+        red_only_image = image_to_base64(Image.fromarray(zeros_original)) # Form an Image from Three Channels, but only Red will dominate because all other channels are Zero
+        zeros_original[:,:,0] = 0
+
+        # Image from Green Channel
+        zeros_original[:,:,1] = G # Fill in the Values for Green Channel and Kepp all others Zero
+        green_only_image = image_to_base64(Image.fromarray(zeros_original))
+        zeros_original[:,:,1] = 0
+
+        # Image from Blue Channel
+        zeros_original[:,:,2] = B # Fill in the Values for Blue Channel and Kepp all others Zero
+        blue_only_image = image_to_base64(Image.fromarray(zeros_original))
+
+
+    # Now Checking the Contribution of Each Channel
+
+    total_sum = np.sum(original_image_array) # Calculate The Sum of All the Channels of Image
+
+    # Calculate Sum of Individual Channels
+    red_channel_sum = np.sum(R)
+    green_channel_sum = np.sum(G)
+    blue_channel_sum = np.sum(B)
+
+    # Calculate The Ratio And Get the Percentage Contribution of Each Channel
+    red_channel_contribution = ((red_channel_sum / total_sum) * 100).round(2)
+    green_channel_contribution = ((green_channel_sum / total_sum) * 100).round(2)
+    blue_channel_contribution = ((blue_channel_sum / total_sum) * 100).round(2)
+
+
+    return [(red_only_image,green_only_image,blue_only_image),(red_channel_contribution,green_channel_contribution,blue_channel_contribution)]
+
+
+
+
+def channel_splitting_reference(original_image_array):
+
+    """
+    Implementation of The Original Endpoint, a Full-Size Copy Per Channel. Kept To Check channel_splitting Against
+    """
+
+    R = original_image_array[:,:,0]
+    G = original_image_array[:,:,1]
+    B = original_image_array[:,:,2]
+
+    zeros_original = np.zeros_like(original_image_array)
+    zeros_original[:,:,0] = R
+    red_only_image = image_to_base64(Image.fromarray(zeros_original))
+
+    zeros_original = np.zeros_like(original_image_array)
+    zeros_original[:,:,1] = G
+    green_only_image = image_to_base64(Image.fromarray(zeros_original))
+
+    zeros_original = np.zeros_like(original_image_array)
+    zeros_original[:,:,2] = B
+    blue_only_image = image_to_base64(Image.fromarray(zeros_original))
+
+    total_sum = np.sum(original_image_array)
+
+    red_channel_contribution = ((np.sum(R) / total_sum) * 100).round(2)
+    green_channel_contribution = ((np.sum(G) / total_sum) * 100).round(2)
+    blue_channel_contribution = ((np.sum(B) / total_sum) * 100).round(2)
+
+    return [(red_only_image,green_only_image,blue_only_image),(red_channel_contribution,green_channel_contribution,blue_channel_contribution)]
@@ -0,0 +1,310 @@
+# jobs.py
+import os
+import time
+import socket
+import logging
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, models
+from django.utils import timezone
+
+from .compute import compute_pool, PoolSaturated, ClientSaturated
+from .models import ImageJob
+from .operations import run_operation, operation_pixels
+from .scheduler import EXPORT, scheduling
+
+
+logger = logging.getLogger(__name__)
+
+_PROCESS_STARTED = timezone.now()
+
+
+DEFAULT_IMAGE_JOBS = {
+    "WORKERS": 2,
+    "MAX_PENDING": 8,             # Jobs queued or running in this process, each holds its decoded original
+    "MAX_PENDING_PER_CLIENT": 2,  # Of those, how many one user or IP address may have
+    "PROGRESS_INTERVAL": 0.5,     # Seconds between progress writes to the database
+    "RESULT_TTL": 60 * 60,        # Seconds a finished job is kept before it is pruned
+    "EVENTS_POLL_INTERVAL": 0.5,  # Seconds between checks of a job streamed over SSE
+    "EVENTS_TIMEOUT": 60 * 10,    # Seconds an SSE stream is held open at most
+}
+
+
+def jobs_config():
+
+    return {**DEFAULT_IMAGE_JOBS, **getattr(settings, "IMAGE_JOBS", {})}
+
+
+
+
+class JobProgress:
+
+    """
+    Progress Callback Handed to The Kernels, Writes To The Job Row At Most Once Per Interval
+    """
+
+    def __init__(self, job_id, interval):
+
+        self.job_id = job_id
+        self.interval = interval
+        self._last_write = 0.0
+
+    def __call__(self, fraction):
+
+        now = time.monotonic()
+
+        if now - self._last_write < self.interval and fraction < 1.0:
+            return
+
+        self._last_write = now
+
+        ImageJob.objects.filter(pk=self.job_id).update(progress=round(fraction, 4), updated_at=timezone.now())
+
+
+
+
+class JobRunner:
+
+    """
+    Runs Image Jobs On a Local Thread Pool, Keeping Their State in The ImageJob Table.
+    The computation itself goes through the compute pool as export work of the user's plan
+    """
+
+    def __init__(self, workers, progress_interval, result_ttl, max_pending, max_pending_per_client):
+
+        self.workers = workers
+        self.progress_interval = progress_interval
+        self.result_ttl = result_ttl
+        self.max_pending = max_pending
+        self.max_pending_per_client = max_pending_per_client
+
+        # Jobs are run by this process only, the row remembers which one
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._recovered = False
+
+        self._pending = 0
+        self._per_client = {}
+
+
+    def submit(self, name, original_img, params, user=None, client=None):
+
+        """
+        Creates The Job and Queues It. Returns The ImageJob Immediately.
+        Raises PoolSaturated or ClientSaturated When Too Many Jobs Are Pending
+        """
+
+        self.recover()
+        self.prune()
+
+        client = client or (f"user:{user.pk}" if user is not None else "anonymous")
+
+        with self._lock:
+
+            if self._pending >= self.max_pending:
+                raise PoolSaturated("Too many image jobs are pending")
+
+            if self._per_client.get(client, 0) >= self.max_pending_per_client:
+                raise ClientSaturated("Too many of your image jobs are pending")
+
+            self._pending += 1
+            self._per_client[client] = self._per_client.get(client, 0) + 1
+
+        try:
+            job = ImageJob.objects.create(user=user, operation=name, worker=self.worker_id)
+            self._get_executor().submit(self._run, job.pk, name, original_img, params, user, client)
+        except BaseException:
+            self._release(client)
+            raise
+
+        return job
+
+
+    def recover(self):
+
+        """
+        Fails The Unfinished Jobs of Workers on This Host That Are Gone, Once Per Process.
+        Their threads died with them, so nothing would ever finish those jobs
+        """
+
+        if self._recovered:
+            return
+
+        self._recovered = True
+
+        hostname = socket.gethostname()
+
+        unfinished = ImageJob.objects.filter(
+            status__in=[ImageJob.STATUS_QUEUED, ImageJob.STATUS_RUNNING],
+            worker__startswith=f"{hostname}:",
+        ).exclude(worker=self.worker_id)
+
+        gone = [
+            worker for worker in unfinished.values_list("worker", flat=True).distinct()
+            if not _process_alive(worker.rsplit(":", 1)[1])
+        ]
+
+        # A restarted container can hand this process the pid of its predecessor
+        stale_self = models.Q(worker=self.worker_id, created_at__lt=_PROCESS_STARTED)
+
+        count = ImageJob.objects.filter(
+            models.Q(worker__in=gone) | stale_self,
+            status__in=[ImageJob.STATUS_QUEUED, ImageJob.STATUS_RUNNING],
+        ).update(status=ImageJob.STATUS_FAILED, error="Interrupted by a restart", updated_at=timezone.now())
+
+        if count:
+            logger.warning("Failed %s image jobs interrupted by a restart", count)
+
+
+    def prune(self):
+
+        """
+        Deletes Finished Jobs Older Than The Result TTL
+        """
+
+        threshold = timezone.now() - timedelta(seconds=self.result_ttl)
+
+        ImageJob.objects.filter(
+            status__in=[ImageJob.STATUS_DONE, ImageJob.STATUS_FAILED],
+            updated_at__lte=threshold,
+        ).delete()
+
+
+    def pending(self):
+
+        with self._lock:
+            return self._pending
+
+
+    def _release(self, client):
+
+        with self._lock:
+
+            self._pending -= 1
+            self._per_client[client] -= 1
+
+            if not self._per_client[client]:
+                del self._per_client[client]
+
+
+    def _run(self, job_id, name, original_img, params, user, client):
+
+        close_old_connections()
+
+        try:
+
+            ImageJob.objects.filter(pk=job_id).update(status=ImageJob.STATUS_RUNNING, updated_at=timezone.now())
+
+            progress = JobProgress(job_id, self.progress_interval)
+
+            payload = self._compute(
+                scheduling(user, operation_pixels(name, original_img, params), priority=EXPORT),
+                run_operation, name, original_img, params, progress,
+            )
+
+            ImageJob.objects.filter(pk=job_id).update(
+                status=ImageJob.STATUS_DONE,
+                progress=1.0,
+                result=payload,
+                updated_at=timezone.now(),
+            )
+
+        except Exception as e:
+
+            logger.exception("Image job %s failed", job_id)
+
+            ImageJob.objects.filter(pk=job_id).update(
+                status=ImageJob.STATUS_FAILED,
+                error=str(e)[:255],
+                updated_at=timezone.now(),
+            )
+
+        finally:
+
+            self._release(client)
+            close_old_connections()
+
+
+    def _compute(self, schedule, fn, *args):
+
+        # A job has already been accepted, so it waits for room in the pool instead of failing
+        while True:
+
+            try:
+                future = compute_pool.submit(fn, *args, **schedule)
+            except PoolSaturated:
+                time.sleep(compute_pool.retry_after)
+                continue
+
+            return future.result()
+
+
+    def _get_executor(self):
+
+        if self._executor is None:
+
+            with self._lock:
+
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-job")
+
+        return self._executor
+
+
+
+
+def _process_alive(pid):
+
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+
+def job_status(job, include_result=True):
+
+    """
+    Returns The Public Representation of a Job
+    """
+
+    data = {
+        "job_id": str(job.pk),
+        "operation": job.operation,
+        "status": job.status,
+        "progress": job.progress,
+    }
+
+    if job.status == ImageJob.STATUS_FAILED:
+        data["error"] = job.error
+
+    if include_result and job.status == ImageJob.STATUS_DONE:
+        data["result"] = job.result
+
+    return data
+
+
+
+def _build_runner():
+
+    config = jobs_config()
+
+    return JobRunner(
+        workers=config["WORKERS"],
+        progress_interval=config["PROGRESS_INTERVAL"],
+        result_ttl=config["RESULT_TTL"],
+        max_pending=config["MAX_PENDING"],
+        max_pending_per_client=config["MAX_PENDING_PER_CLIENT"],
+    )
+
+
+job_runner = _build_runner()
@@ -0,0 +1,456 @@
+# live.py
+import json
+import asyncio
+import logging
+import threading
+from io import BytesIO
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from PIL import Image
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .compute import compute_pool, PoolSaturated, ClientSaturated
+from .image_store import image_store
+from .memory import memory_ledger
+from .imaging import adjust_pixels, bl_resize, split_alpha, to_8bit
+from .operations import InvalidParameters, parse_adjustments
+from .scheduler import INTERACTIVE
+
+
+logger = logging.getLogger(__name__)
+
+
+# Live preview over a WebSocket, served at /api/live?image_id=<id> by image_processing/asgi.py.
+#
+# The session decodes the original once and keeps it, with a pyramid of smaller copies, in
+# this worker for as long as the socket is open. The client streams adjustment parameters
+# as JSON text messages, and for the newest one the server answers with a JSON header
+# ({"seq", "width", "height", "format"}) followed by the encoded preview as a binary frame.
+# Parameters that arrive while a frame is being rendered replace each other, so only the
+# latest one is ever rendered.
+#
+# A session is counted like HTTP work: per user, or per IP address when anonymous, against
+# MAX_SESSIONS_PER_CLIENT and the compute pool's per-client limits. The pyramid it pins is
+# reserved in the memory ledger (api/memory.py) for as long as the socket is open, and a
+# session that doesn't fit is refused. The auth cookie is SameSite=None, so browsers send
+# it to this socket from any site; the Origin must be one of ALLOWED_ORIGINS.
+
+
+DEFAULT_IMAGE_LIVE_PREVIEW = {
+    "PATH": "/api/live",
+    "MIN_LEVEL_SIDE": 128,       # The pyramid stops halving below this side
+    "DEFAULT_MAX_SIDE": 1024,    # Preview size when the client doesn't ask for one
+    "FORMAT": "JPEG",
+    "QUALITY": 80,
+    "MAX_SESSIONS_PER_CLIENT": 2,
+    "ALLOWED_ORIGINS": None,     # None allows CORS_ALLOWED_ORIGINS, and the server's own host
+}
+
+
+# Close codes sent to the client
+CLOSE_NOT_FOUND = 4404
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_FORBIDDEN = 4403
+CLOSE_TOO_MANY = 4429
+CLOSE_UNAVAILABLE = 4503
+
+
+def live_config():
+
+    return {**DEFAULT_IMAGE_LIVE_PREVIEW, **getattr(settings, "IMAGE_LIVE_PREVIEW", {})}
+
+
+
+
+def build_pyramid(original_array, min_side):
+
+    """
+    Returns [full, half, quarter, ...] Copies of The Image, The Last One Close To min_side
+    """
+
+    levels = [original_array]
+
+    while max(levels[-1].shape[:2]) // 2 >= min_side:
+
+        h, w = levels[-1].shape[:2]
+        levels.append(bl_resize(levels[-1], new_h=max(1, h // 2), new_w=max(1, w // 2)))
+
+    return levels
+
+
+
+def image_pyramid(original_img, min_side):
+
+    """
+    Decodes The Image Into an Array and Builds Its Pyramid. Module level so it can run in a worker process
+    """
+
+    return build_pyramid(np.array(original_img), min_side)
+
+
+
+def pyramid_nbytes(original_img):
+
+    """
+    Upper Bound of What The Pyramid of an Image Holds: The Full Copy, Then a Quarter, a Sixteenth...
+    """
+
+    width, height = original_img.size
+
+    return width * height * len(original_img.getbands()) * (2 if original_img.mode.startswith("I;16") else 1) * 4 // 3
+
+
+
+def pick_level(levels, max_side):
+
+    """
+    Returns The Smallest Level That Is Still At Least max_side Pixels Along Its Longest Side
+    """
+
+    for level in reversed(levels):
+
+        if max(level.shape[:2]) >= max_side:
+            return level
+
+    return levels[0]
+
+
+
+def render_preview(level, params, fmt, quality):
+
+    """
+    Adjusts and Encodes One Preview Frame. Returns (bytes, width, height)
+    """
+
+    pixels = adjust_pixels(level, **params)
+
+    # Frames are for a screen, 8 bits are enough, and JPEG has no alpha channel
+    pixels = to_8bit(pixels)
+
+    if fmt.upper() == "JPEG":
+        pixels, _ = split_alpha(pixels)
+
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format=fmt, quality=quality)
+
+    return buffer.getvalue(), pixels.shape[1], pixels.shape[0]
+
+
+
+
+class LivePreviewSession:
+
+    def __init__(self, scope, receive, send):
+
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        self.config = live_config()
+
+        self.levels = None
+        self.client = None
+        self.plan = "anonymous"
+
+        self._pending = None
+        self._wakeup = asyncio.Event()
+        self._closed = False
+
+
+    async def run(self):
+
+        message = await self.receive()
+
+        if message["type"] != "websocket.connect":
+            return
+
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        image_id = (query.get("image_id") or [None])[0]
+
+        if not origin_allowed(self.scope, self.config["ALLOWED_ORIGINS"]):
+            await self.close(CLOSE_FORBIDDEN)
+            return
+
+        user_id, plan, authenticated = await sync_to_async(authenticate_scope)(self.scope)
+
+        if not authenticated:
+            await self.close(CLOSE_UNAUTHORIZED)
+            return
+
+        original_img = image_store.get(f"original:{image_id}") if image_id else None
+
+        if original_img is None:
+            await self.close(CLOSE_NOT_FOUND)
+            return
+
+        # Counted like HTTP work, see compute.client_key
+        self.client = f"user:{user_id}" if user_id is not None else f"ip:{scope_client_ip(self.scope)}"
+        self.plan = plan
+
+        if not sessions.open(self.client, self.config["MAX_SESSIONS_PER_CLIENT"]):
+            await self.close(CLOSE_TOO_MANY)
+            return
+
+        try:
+            await self.serve(image_id, original_img)
+        finally:
+            sessions.close(self.client)
+
+
+    async def serve(self, image_id, original_img):
+
+        # The pyramid stays pinned while the socket is open
+        reservation = memory_ledger.try_reserve(pyramid_nbytes(original_img))
+
+        if reservation is None:
+            await self.close(CLOSE_UNAVAILABLE)
+            return
+
+        with reservation:
+
+            # Decode once and keep the pyramid for the whole session
+            try:
+                future = compute_pool.submit(
+                    image_pyramid, original_img, self.config["MIN_LEVEL_SIDE"],
+                    client=self.client,
+                    plan=self.plan,
+                    priority=INTERACTIVE,
+                    pixels=original_img.size[0] * original_img.size[1],
+                )
+            except PoolSaturated:
+                await self.close(CLOSE_UNAVAILABLE)
+                return
+            except ClientSaturated:
+                await self.close(CLOSE_TOO_MANY)
+                return
+
+            self.levels = await asyncio.wrap_future(future)
+
+            await self.stream(image_id)
+
+
+    async def stream(self, image_id):
+
+        await self.send({"type": "websocket.accept"})
+        await self.send_json({"image_id": image_id, "levels": [list(level.shape[:2]) for level in self.levels]})
+
+        renderer = asyncio.create_task(self.render_loop())
+
+        try:
+            await self.receive_loop()
+        finally:
+            self._closed = True
+            self._wakeup.set()
+            await renderer
+
+
+    async def receive_loop(self):
+
+        while True:
+
+            message = await self.receive()
+
+            if message["type"] == "websocket.disconnect":
+                return
+
+            if message["type"] != "websocket.receive" or message.get("text") is None:
+                continue
+
+            data = None
+
+            try:
+                data = json.loads(message["text"])
+                params = parse_adjustments(data)
+                max_side = int(data.get("max_size", self.config["DEFAULT_MAX_SIDE"]))
+            except (ValueError, TypeError, AttributeError, InvalidParameters) as e:
+                seq = data.get("seq") if isinstance(data, dict) else None
+                await self.send_json({"seq": seq, "error": str(e) or "Invalid parameters"})
+                continue
+
+            # Replaces whatever was waiting, only the newest parameters are rendered
+            self._pending = (data.get("seq"), params, max_side)
+            self._wakeup.set()
+
+
+    async def render_loop(self):
+
+        while True:
+
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            if self._closed:
+                return
+
+            pending, self._pending = self._pending, None
+
+            if pending is None:
+                continue
+
+            seq, params, max_side = pending
+
+            level = pick_level(self.levels, max_side)
+
+            try:
+                future = compute_pool.submit(
+                    render_preview, level, params, self.config["FORMAT"], self.config["QUALITY"],
+                    client=self.client,
+                    plan=self.plan,
+                    priority=INTERACTIVE,
+                    pixels=level.shape[0] * level.shape[1],
+                )
+            except (PoolSaturated, ClientSaturated) as e:
+                await self.send_json({"seq": seq, "error": str(e), "retry_after": compute_pool.retry_after})
+                continue
+
+            try:
+                frame, width, height = await asyncio.wrap_future(future)
+            except Exception as e:
+                # One bad frame must not end the session, the next parameters still get rendered
+                logger.exception("Live preview frame %s failed", seq)
+                await self.send_json({"seq": seq, "error": str(e) or "Rendering failed"})
+                continue
+
+            if self._closed:
+                return
+
+            await self.send_json({"seq": seq, "width": width, "height": height, "format": self.config["FORMAT"].lower()})
+            await self.send({"type": "websocket.send", "bytes": frame})
+
+
+    async def send_json(self, data):
+
+        await self.send({"type": "websocket.send", "text": json.dumps(data)})
+
+
+    async def close(self, code):
+
+        await self.send({"type": "websocket.close", "code": code})
+
+
+
+
+class LiveSessions:
+
+    """
+    Open Sessions Per Client, Shared by Every Event Loop in The Process
+    """
+
+    def __init__(self):
+
+        self._open = {}
+        self._lock = threading.Lock()
+
+
+    def open(self, client, limit):
+
+        with self._lock:
+
+            if self._open.get(client, 0) >= limit:
+                return False
+
+            self._open[client] = self._open.get(client, 0) + 1
+
+        return True
+
+
+    def close(self, client):
+
+        with self._lock:
+
+            self._open[client] -= 1
+
+            if not self._open[client]:
+                del self._open[client]
+
+
+    def count(self, client):
+
+        with self._lock:
+            return self._open.get(client, 0)
+
+
+sessions = LiveSessions()
+
+
+
+
+def scope_header(scope, name):
+
+    for key, value in scope.get("headers", []):
+
+        if key == name:
+            return value.decode("latin-1")
+
+    return None
+
+
+
+def scope_client_ip(scope):
+
+    """
+    The Client IP Address of a Scope, Like authentication.views.get_client_ip Does For Requests
+    """
+
+    x_forwarded_for = scope_header(scope, b"x-forwarded-for")
+
+    if x_forwarded_for:
+        return x_forwarded_for.split(",")[0]
+
+    return (scope.get("client") or [None])[0]
+
+
+
+def origin_allowed(scope, allowed_origins=None):
+
+    """
+    Whether The Origin of a WebSocket Handshake Is One The Auth Cookie May Be Used From.
+    Clients other than browsers send no Origin, and no one else's cookie either
+    """
+
+    origin = scope_header(scope, b"origin")
+
+    if origin is None:
+        return True
+
+    if allowed_origins is None:
+        allowed_origins = getattr(settings, "CORS_ALLOWED_ORIGINS", [])
+
+    if origin in allowed_origins:
+        return True
+
+    # Same origin, the page was served by this host
+    return urlsplit(origin).netloc == scope_header(scope, b"host")
+
+
+
+
+def authenticate_scope(scope):
+
+    """
+    Validates The "access" Cookie of a WebSocket Scope. Returns (user_id, plan, ok).
+    Anonymous sessions are allowed like on the HTTP endpoints, invalid tokens are not.
+    The plan comes from the token claims, see USER_TOKEN_CLAIMS
+    """
+
+    cookies = SimpleCookie()
+    cookies.load(scope_header(scope, b"cookie") or "")
+
+    if "access" not in cookies:
+        return None, "anonymous", True
+
+    try:
+        token = AccessToken(cookies["access"].value)
+    except Exception:
+        return None, "anonymous", False
+
+    return token["user_id"], token.get("user_plan") or "", True
+
+
+
+async def live_preview_application(scope, receive, send):
+
+    await LivePreviewSession(scope, receive, send).run()
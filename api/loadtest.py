@@ -0,0 +1,373 @@
+# loadtest.py
+import base64
+import json
+import random
+import statistics
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+import requests
+from PIL import Image
+
+
+# Replayable load tests for the image and auth endpoints, driven by `manage.py loadtest`.
+#
+# A session is one virtual user: an optional login, an upload, then a few operations on
+# the uploaded image with think time in between. Sessions are kept one per line in a JSONL
+# file, either synthesized here or written by hand, and are replayed concurrently against
+# a running server. Images are described by size and seed and generated before the run,
+# so session files stay small and replays send identical bytes. Values captured from a
+# response (the image_id of the upload) are substituted into later steps as {name}.
+# Every virtual user comes from the same address, so the per-IP rate limits answer 429 at
+# some point. Those are reported apart from errors, raise RATE_LIMITS to load past them.
+
+
+LOADTEST_PASSWORD = "loadtest-password"
+
+
+def loadtest_email(index):
+
+    return f"loadtest{index}@example.com"
+
+
+
+# Operations a session picks from, with their weights and parameters
+OPERATION_MIX = [
+    ("apply_adjustments", 6, lambda rng: {"brightness": rng.randint(-40, 40), "contrast": rng.choice([0, 10, 20]), "saturation": rng.choice([0, 0.2]), "gamma": rng.choice([1.0, 1.2])}),
+    ("resize_image", 2, lambda rng: {"resize_scale": rng.choice([0.25, 0.5, 0.75, 1.5])}),
+    ("edge_detection", 2, lambda rng: {}),
+]
+
+
+
+
+# -----------------------------------------------------------------------------
+# Sessions
+
+
+def synthesize_sessions(count, seed=0, megapixels=(0.25, 1, 4), login_ratio=0.3, users=50, prefix="/api/", operations=(2, 6), think_ms=(100, 800)):
+
+    """
+    Generates Realistic Sessions: Some Users Log in First, Everyone Uploads an Image and
+    Works On It With a Burst of Operations, Mostly Slider Adjustments
+    """
+
+    rng = random.Random(seed)
+
+    names = [name for name, _, _ in OPERATION_MIX]
+    weights = [weight for _, weight, _ in OPERATION_MIX]
+    params = {name: make_params for name, _, make_params in OPERATION_MIX}
+
+    sessions = []
+
+    for index in range(count):
+
+        steps = []
+
+        if rng.random() < login_ratio:
+            steps.append({
+                "name": "user_login",
+                "method": "POST",
+                "path": "/authentication/user_login",
+                "json": {"email": loadtest_email(rng.randrange(users)), "password": LOADTEST_PASSWORD},
+            })
+
+        size = rng.choice(megapixels)
+
+        steps.append({
+            "name": "upload_image",
+            "method": "POST",
+            "path": f"{prefix}upload_image",
+            "image": {"megapixels": size, "seed": rng.randrange(8)},
+            "capture": {"image_id": "image_id"},
+        })
+
+        for _ in range(rng.randint(*operations)):
+
+            name = rng.choices(names, weights)[0]
+
+            steps.append({
+                "name": name,
+                "method": "POST",
+                "path": f"{prefix}{name}",
+                "json": {"image_id": "{image_id}", **params[name](rng)},
+                "think_ms": rng.randint(*think_ms),
+            })
+
+        sessions.append({"session": index, "steps": steps})
+
+    return sessions
+
+
+
+def write_sessions(path, sessions):
+
+    with open(path, "w") as f:
+        for session in sessions:
+            f.write(json.dumps(session) + "\n")
+
+
+
+def read_sessions(path):
+
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+
+def synthetic_jpeg(megapixels, seed):
+
+    """
+    A Photo-Like JPEG as a Base64 Data URL: Smooth Gradients With Some Noise
+    """
+
+    w = max(1, int((megapixels * 1_000_000 * 4 / 3) ** 0.5))
+    h = max(1, int(megapixels * 1_000_000 // w))
+
+    rng = np.random.default_rng(seed)
+
+    y = np.linspace(0, 255, h, dtype=np.float32)[:, None]
+    x = np.linspace(0, 255, w, dtype=np.float32)[None, :]
+
+    rgb = np.empty((h, w, 3), dtype=np.uint8)
+    rgb[:, :, 0] = np.clip(x + rng.normal(0, 6, (h, w)), 0, 255)
+    rgb[:, :, 1] = np.clip(y + rng.normal(0, 6, (h, w)), 0, 255)
+    rgb[:, :, 2] = np.clip((x + y) / 2 + rng.normal(0, 6, (h, w)), 0, 255)
+
+    buffer = BytesIO()
+    Image.fromarray(rgb).save(buffer, format="JPEG", quality=90)
+
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+
+
+# -----------------------------------------------------------------------------
+# Replay
+
+
+class Replay:
+
+    """
+    Replays Sessions With a Fixed Number of Concurrent Virtual Users Against a Server
+    """
+
+    def __init__(self, base_url, sessions, concurrency, think_scale=1.0, timeout=60):
+
+        self.base_url = base_url.rstrip("/")
+        self.sessions = sessions
+        self.concurrency = concurrency
+        self.think_scale = think_scale
+        self.timeout = timeout
+
+        self.samples = []     # (step name, status or None, seconds)
+        self._lock = threading.Lock()
+        self._next = 0
+
+        self.images = {}
+
+
+    def prepare(self):
+
+        for session in self.sessions:
+            for step in session["steps"]:
+
+                image = step.get("image")
+
+                if image is not None:
+                    key = (image["megapixels"], image["seed"])
+
+                    if key not in self.images:
+                        self.images[key] = synthetic_jpeg(*key)
+
+
+    def run(self):
+
+        self.prepare()
+
+        threads = [threading.Thread(target=self._user, name=f"loadtest-{index}") for index in range(self.concurrency)]
+
+        started = time.perf_counter()
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        return summarize(self.samples, time.perf_counter() - started)
+
+
+    def _take(self):
+
+        with self._lock:
+
+            if self._next >= len(self.sessions):
+                return None
+
+            session = self.sessions[self._next]
+            self._next += 1
+
+            return session
+
+
+    def _user(self):
+
+        while True:
+
+            session = self._take()
+
+            if session is None:
+                return
+
+            # A fresh client per session, like a new visitor: its own cookies and connection
+            with requests.Session() as client:
+                self._play(client, session)
+
+
+    def _play(self, client, session):
+
+        captured = {}
+
+        for step in session["steps"]:
+
+            if step.get("think_ms") and self.think_scale:
+                time.sleep(step["think_ms"] / 1000 * self.think_scale)
+
+            body = substitute(step.get("json", {}), captured)
+
+            image = step.get("image")
+
+            if image is not None:
+                body["image_base64"] = self.images[(image["megapixels"], image["seed"])]
+
+            start = time.perf_counter()
+
+            try:
+                response = client.request(step.get("method", "POST"), self.base_url + step["path"], json=body, timeout=self.timeout)
+                status = response.status_code
+            except requests.RequestException:
+                response, status = None, None
+
+            seconds = time.perf_counter() - start
+
+            with self._lock:
+                self.samples.append((step["name"], status, seconds))
+
+            if response is None or status >= 400:
+                # The rest of the session depends on this step
+                if step.get("capture"):
+                    return
+                continue
+
+            # The auth cookies are Secure, a plain HTTP test server would never get them back
+            for cookie in response.cookies:
+                client.cookies.set(cookie.name, cookie.value)
+
+            if step.get("capture"):
+
+                data = response.json()
+
+                for name, field in step["capture"].items():
+                    captured[name] = data.get(field)
+
+
+
+def substitute(value, captured):
+
+    """
+    Replaces "{name}" Strings With Values Captured From Earlier Responses
+    """
+
+    if isinstance(value, dict):
+        return {key: substitute(item, captured) for key, item in value.items()}
+
+    if isinstance(value, list):
+        return [substitute(item, captured) for item in value]
+
+    if isinstance(value, str) and value.startswith("{") and value.endswith("}") and value[1:-1] in captured:
+        return captured[value[1:-1]]
+
+    return value
+
+
+
+
+# -----------------------------------------------------------------------------
+# Reports
+
+
+def percentile(sorted_values, fraction):
+
+    if not sorted_values:
+        return 0.0
+
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+
+def summarize(samples, elapsed):
+
+    """
+    Latency Percentiles (ms), Error Rates and Throughput Per Step Name and Overall
+    """
+
+    def stats(rows):
+
+        timings = sorted(seconds * 1000 for _, _, seconds in rows)
+
+        errors = sum(1 for _, status, _ in rows if status is None or status >= 500)
+        rejected = sum(1 for _, status, _ in rows if status in (413, 429))
+
+        return {
+            "requests": len(rows),
+            "throughput": round(len(rows) / elapsed, 2) if elapsed else 0.0,
+            "error_rate": round(errors / len(rows), 4) if rows else 0.0,
+            "rejected_rate": round(rejected / len(rows), 4) if rows else 0.0,
+            "p50": round(percentile(timings, 0.50), 2),
+            "p90": round(percentile(timings, 0.90), 2),
+            "p99": round(percentile(timings, 0.99), 2),
+            "mean": round(statistics.fmean(timings), 2) if timings else 0.0,
+        }
+
+    endpoints = {}
+
+    for name in sorted({name for name, _, _ in samples}):
+        endpoints[name] = stats([row for row in samples if row[0] == name])
+
+    return {
+        "elapsed": round(elapsed, 3),
+        "overall": stats(samples),
+        "endpoints": endpoints,
+    }
+
+
+
+def compare(result, baseline, max_latency_regression=0.2, max_throughput_regression=0.2, max_error_rate_increase=0.01):
+
+    """
+    Returns The Regressions Against a Baseline Result as Messages, Empty When There Are None
+    """
+
+    failures = []
+
+    for name, current in {"overall": result["overall"], **result["endpoints"]}.items():
+
+        before = baseline["overall"] if name == "overall" else baseline["endpoints"].get(name)
+
+        if before is None:
+            continue
+
+        for key in ("p50", "p99"):
+            if before[key] and current[key] > before[key] * (1 + max_latency_regression):
+                failures.append(f"{name}: {key} went from {before[key]} ms to {current[key]} ms")
+
+        if before["throughput"] and current["throughput"] < before["throughput"] * (1 - max_throughput_regression):
+            failures.append(f"{name}: throughput went from {before['throughput']} to {current['throughput']} req/s")
+
+        if current["error_rate"] > before["error_rate"] + max_error_rate_increase:
+            failures.append(f"{name}: error rate went from {before['error_rate']:.2%} to {current['error_rate']:.2%}")
+
+    return failures
@@ -0,0 +1,374 @@
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from api.imaging import (
+    apply_adjustments,
+    apply_adjustments_reference,
+    base64_to_image,
+    bl_resize,
+    bl_resize_reference,
+    change_geometry,
+    change_geometry_reference,
+    channel_splitting,
+    channel_splitting_reference,
+    image_to_base64,
+    sobel_edge_detection,
+    sobel_edge_detection_reference,
+)
+from api.operations import OPERATIONS, render_result
+
+
+ADJUSTMENTS = {"brightness": 12, "saturation": 1.2, "gamma": 1.1, "contrast": 1.1}
+
+OPERATION_PARAMS = {
+    "apply_adjustments": ADJUSTMENTS,
+    "resize_image": {"resize_scale": 1.0},
+    "modify_geometry": {"change_to_be_made": ["r"]},
+    "edge_detection": {},
+    "channel_analysis": {},
+}
+
+
+def as_array(result):
+
+    """
+    The Pixels of a Kernel Result, as int32 So Differences Don't Wrap Around. channel_splitting
+    Results Are Its Three Decoded Images, Followed by The Contributions in Hundredths of a Percent
+    """
+
+    if isinstance(result, list):
+
+        images, contributions = result
+
+        return np.concatenate([
+            *(np.asarray(base64_to_image(image), dtype=np.int32).ravel() for image in images),
+            np.round(np.asarray(contributions, dtype=np.float64) * 100).astype(np.int32),
+        ])
+
+    return np.asarray(result, dtype=np.int32)
+
+
+
+# name: (input mode, fast path, reference or None, max absolute difference allowed). The references
+# are the whole-array or pixel by pixel implementations in api/imaging.py, never the fast path's own parts
+KERNELS = {
+    "apply_adjustments": (
+        "RGB",
+        lambda img, arr: apply_adjustments(img, **ADJUSTMENTS),
+        lambda img, arr: apply_adjustments_reference(img, **ADJUSTMENTS),
+        0,
+    ),
+    "bl_resize": (
+        "RGB",
+        lambda img, arr: bl_resize(arr, new_h=arr.shape[0] * 3 // 4, new_w=arr.shape[1] * 3 // 4),
+        lambda img, arr: bl_resize_reference(arr, new_h=arr.shape[0] * 3 // 4, new_w=arr.shape[1] * 3 // 4),
+        0,
+    ),
+    "sobel_edge_detection": (
+        "L",
+        lambda img, arr: sobel_edge_detection(arr),
+        lambda img, arr: sobel_edge_detection_reference(arr),
+        1,   # float32 sums in another order can round a pixel the other way
+    ),
+    "change_geometry": (
+        "RGB",
+        lambda img, arr: np.ascontiguousarray(change_geometry(arr, "r")),   # Rotations are views until copied
+        lambda img, arr: change_geometry_reference(arr, "r"),
+        0,
+    ),
+    "channel_splitting": (
+        "RGB",
+        lambda img, arr: channel_splitting(arr),
+        lambda img, arr: channel_splitting_reference(arr),
+        0,
+    ),
+}
+
+
+def synthetic_image(megapixels, mode, seed=0):
+
+    """
+    A Deterministic Photo-Like Test Image: Smooth Gradients With Some Noise, in The Given Mode
+    """
+
+    side = int((megapixels * 1_000_000) ** 0.5)
+    h, w = side, side * 4 // 3 if megapixels >= 1 else side
+    h = max(1, int(megapixels * 1_000_000 // w))
+
+    rng = np.random.default_rng(seed)
+
+    y = np.linspace(0, 255, h, dtype=np.float32)[:, None]
+    x = np.linspace(0, 255, w, dtype=np.float32)[None, :]
+
+    rgb = np.empty((h, w, 3), dtype=np.uint8)
+    rgb[:, :, 0] = np.clip(x + rng.normal(0, 8, (h, w)), 0, 255)
+    rgb[:, :, 1] = np.clip(y + rng.normal(0, 8, (h, w)), 0, 255)
+    rgb[:, :, 2] = np.clip((x + y) / 2 + rng.normal(0, 8, (h, w)), 0, 255)
+
+    img = Image.fromarray(rgb)
+
+    if mode == "I;16":
+        # PIL has no conversion from RGB, the gray levels are scaled up to 16 bits
+        return Image.fromarray(np.asarray(img.convert("L")).astype(np.uint16) * 257)
+
+    return img.convert(mode)
+
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Benchmarks every image kernel, the end to end operations and the encode/decode helpers across "
+        "image sizes and modes, checks the fast kernels against their reference implementations, and "
+        "writes the results as JSON for regression tracking"
+    )
+
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("--sizes", nargs="+", type=float, default=[0.25, 1, 4, 12, 25, 50], help="Megapixels")
+        parser.add_argument("--modes", nargs="+", default=["RGB", "RGBA", "L", "I;16"], help="Modes for encode/decode")
+        parser.add_argument("--operation-modes", nargs="+", default=["RGB", "L"], help="Native modes the end to end operations run on")
+        parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case, fewer above 12 MP")
+        parser.add_argument("--reference-max-mp", type=float, default=0.25, help="Largest size checked against the references")
+        parser.add_argument("--output", help="Write the JSON results to this file")
+        parser.add_argument("--baseline", help="Earlier JSON results to compare the throughput against")
+        parser.add_argument("--max-regression", type=float, default=0.10, help="Throughput drop against the baseline that fails the run")
+
+
+    def handle(self, *args, **options):
+
+        results = []
+        equivalence = []
+
+        for megapixels in options["sizes"]:
+
+            self.stdout.write(f"{megapixels} MP")
+
+            repeat = options["repeat"] if megapixels <= 12 else 1
+
+            images = {mode: synthetic_image(megapixels, mode) for mode in {"RGB", "L", *options["modes"], *options["operation_modes"]}}
+
+            for name, (mode, fast, reference, tolerance) in KERNELS.items():
+
+                img = images[mode]
+                arr = np.array(img)
+
+                results.append(self.measure("kernel", name, mode, img.width * img.height, repeat, lambda: fast(img, arr)))
+
+                if reference is not None and megapixels <= options["reference_max_mp"]:
+                    equivalence.append(self.check_reference(name, mode, megapixels, fast, reference, img, arr, tolerance))
+
+            for mode in options["operation_modes"]:
+
+                for name, params in OPERATION_PARAMS.items():
+
+                    img = images[mode]
+
+                    results.append(self.measure(
+                        "operation", name, mode, img.width * img.height, repeat,
+                        lambda: render_result(OPERATIONS[name].compute(img, params)),
+                    ))
+
+            for mode in options["modes"]:
+
+                img = images[mode]
+                encoded = image_to_base64(img)
+
+                results.append(self.measure("codec", "image_to_base64", mode, img.width * img.height, repeat, lambda: image_to_base64(img)))
+                results.append(self.measure("codec", "base64_to_image", mode, img.width * img.height, repeat, lambda: base64_to_image(encoded).load()))
+
+                if megapixels <= options["reference_max_mp"]:
+
+                    difference = int(np.abs(as_array(base64_to_image(encoded)) - as_array(img)).max())
+
+                    equivalence.append({
+                        "kernel": "png_round_trip", "mode": mode, "megapixels": megapixels,
+                        "max_abs_diff": difference, "tolerance": 0, "ok": difference == 0,
+                    })
+
+        report = {
+            "meta": {
+                "python": sys.version.split()[0],
+                "numpy": np.__version__,
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            "results": results,
+            "equivalence": equivalence,
+            "cost_coefficients": self.cost_coefficients(results),
+        }
+
+        self.print_report(report)
+
+        if options["output"]:
+
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+
+            self.stdout.write(f"Results written to {options['output']}")
+
+        failures = [
+            f"{check['kernel']} ({check['mode']}, {check['megapixels']} MP) differs from its reference by "
+            f"{check['max_abs_diff']}, the tolerance is {check['tolerance']}"
+            for check in equivalence if not check["ok"]
+        ]
+
+        if options["baseline"]:
+            failures += self.compare(results, options["baseline"], options["max_regression"])
+
+        if failures:
+            raise CommandError("\n".join(failures))
+
+
+    def measure(self, group, name, mode, pixels, repeat, fn):
+
+        timings = []
+
+        for _ in range(repeat):
+
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+
+        # A separate run for the memory, tracing slows the timed ones down. Counts NumPy's
+        # allocations, PIL allocates its image buffers outside of the Python allocator
+        tracemalloc.start()
+
+        try:
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        seconds = statistics.median(timings)
+
+        return {
+            "group": group,
+            "name": name,
+            "mode": mode,
+            "megapixels": round(pixels / 1_000_000, 3),
+            "seconds": round(seconds, 5),
+            "seconds_min": round(min(timings), 5),
+            "mp_per_s": round(pixels / 1_000_000 / seconds, 2),
+            "peak_bytes": peak,
+            "bytes_per_pixel": round(peak / pixels, 2),
+        }
+
+
+    def check_reference(self, name, mode, megapixels, fast, reference, img, arr, tolerance):
+
+        # Bands small enough that the check crosses band boundaries even on a small image
+        with override_settings(IMAGE_STRIPS={"MIN_PIXELS": 0, "MIN_ROWS": 8, "BAND_PIXELS": 16 * 1024, "THREADS": 4}):
+            fast_result = as_array(fast(img, arr))
+
+        reference_result = as_array(reference(img, arr))
+
+        if fast_result.shape != reference_result.shape:
+            difference = 255
+        else:
+            difference = int(np.abs(fast_result - reference_result).max())
+
+        return {
+            "kernel": name,
+            "mode": mode,
+            "megapixels": megapixels,
+            "max_abs_diff": difference,
+            "tolerance": tolerance,
+            "ok": difference <= tolerance,
+        }
+
+
+    def cost_coefficients(self, results):
+
+        """
+        Least Squares Fit of seconds = FIXED_SECONDS + SECONDS_PER_MEGAPIXEL * megapixels Per
+        Operation, in The Format of settings.IMAGE_COST["KERNELS"]. Fitted on RGB, api/cost.py
+        Scales Them For The Other Modes
+        """
+
+        coefficients = {}
+
+        rows = [row for row in results if row["mode"] == "RGB" and (row["group"] == "operation" or row["name"] == "base64_to_image")]
+
+        for name in {row["name"] for row in rows}:
+
+            samples = [row for row in rows if row["name"] == name]
+
+            x = np.array([row["megapixels"] for row in samples])
+            y = np.array([row["seconds"] for row in samples])
+
+            if len(samples) > 1 and np.ptp(x) > 0:
+                slope, intercept = np.polyfit(x, y, 1)
+            else:
+                slope, intercept = y[0] / x[0], 0.0
+
+            coefficients["decode" if name == "base64_to_image" else name] = {
+                "FIXED_SECONDS": round(max(float(intercept), 0.0), 4),
+                "SECONDS_PER_MEGAPIXEL": round(float(slope), 4),
+                "BYTES_PER_PIXEL": round(max(row["bytes_per_pixel"] for row in samples), 1),
+            }
+
+        return coefficients
+
+
+    def compare(self, results, baseline_path, max_regression):
+
+        with open(baseline_path) as f:
+            baseline = {
+                (row["group"], row["name"], row["mode"], row["megapixels"]): row
+                for row in json.load(f)["results"]
+            }
+
+        failures = []
+
+        for row in results:
+
+            before = baseline.get((row["group"], row["name"], row["mode"], row["megapixels"]))
+
+            if before is None:
+                continue
+
+            change = row["mp_per_s"] / before["mp_per_s"] - 1
+
+            if change < -max_regression:
+                failures.append(
+                    f"{row['name']} ({row['mode']}, {row['megapixels']} MP) dropped to {row['mp_per_s']} MP/s "
+                    f"from {before['mp_per_s']} MP/s ({change:+.0%})"
+                )
+
+        return failures
+
+
+    def print_report(self, report):
+
+        self.stdout.write("")
+        self.stdout.write(f"{'group':<10} {'name':<22} {'mode':<5} {'MP':>7} {'seconds':>9} {'MP/s':>9} {'B/px':>7}")
+
+        for row in report["results"]:
+            self.stdout.write(
+                f"{row['group']:<10} {row['name']:<22} {row['mode']:<5} {row['megapixels']:>7} "
+                f"{row['seconds']:>9} {row['mp_per_s']:>9} {row['bytes_per_pixel']:>7}"
+            )
+
+        self.stdout.write("")
+
+        for check in report["equivalence"]:
+
+            status = self.style.SUCCESS("ok") if check["ok"] else self.style.ERROR("FAILED")
+
+            self.stdout.write(
+                f"{check['kernel']:<22} {check['mode']:<5} {check['megapixels']:>5} MP  "
+                f"max diff {check['max_abs_diff']} (tolerance {check['tolerance']})  {status}"
+            )
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.warmup import warmup_config
+
+
+# Runs in a fresh interpreter, the boot of a server worker: settings and apps, the middleware
+# chain of the WSGI handler and the URLconf with every view module behind it
+PROBE = """
+import json, sys, time
+
+started = time.perf_counter()
+
+import django
+django.setup()
+
+setup_done = time.perf_counter()
+
+from django.core.wsgi import get_wsgi_application
+from django.urls import get_resolver
+
+get_wsgi_application()
+get_resolver().url_patterns
+
+done = time.perf_counter()
+
+print(json.dumps({
+    "setup_ms": (setup_done - started) * 1000,
+    "urls_ms": (done - setup_done) * 1000,
+    "total_ms": (done - started) * 1000,
+    "modules": sorted(sys.modules),
+}))
+"""
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Measures how long a fresh worker takes to boot (django.setup(), the WSGI handler and the "
+        "URLconf) over several runs and fails when the median is over budget, or when a module "
+        "meant to load lazily is imported during boot"
+    )
+
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to boot")
+        parser.add_argument("--budget-ms", type=float, default=500, help="Highest median boot time allowed")
+        parser.add_argument("--deferred", nargs="*", help="Modules that must not be imported at boot, WARMUP MODULES and their heavy dependencies by default")
+        parser.add_argument("--imports", type=int, default=15, help="Show the slowest imports of one more run under -X importtime, 0 for none")
+
+
+    def handle(self, *args, **options):
+
+        deferred = options["deferred"]
+
+        if deferred is None:
+            deferred = [*warmup_config()["MODULES"], "matplotlib", "lxml", "cssutils"]
+
+        runs = [self.boot() for _ in range(options["runs"])]
+
+        self.stdout.write(f"{'run':>4} {'setup ms':>10} {'urls ms':>10} {'total ms':>10}")
+
+        for index, run in enumerate(runs, 1):
+            self.stdout.write(f"{index:>4} {run['setup_ms']:>10.1f} {run['urls_ms']:>10.1f} {run['total_ms']:>10.1f}")
+
+        median = statistics.median(run["total_ms"] for run in runs)
+
+        self.stdout.write(f"\nmedian {median:.1f} ms, budget {options['budget_ms']:.0f} ms")
+
+        if options["imports"]:
+            self.print_imports(options["imports"])
+
+        failures = []
+
+        if median > options["budget_ms"]:
+            failures.append(f"Boot took {median:.1f} ms, over the {options['budget_ms']:.0f} ms budget")
+
+        loaded = runs[0]["modules"]
+
+        for name in deferred:
+            if name in loaded:
+                failures.append(f"{name} is imported at boot, it should load on first use or in the warmup")
+
+        if failures:
+            raise CommandError("\n".join(failures))
+
+        self.stdout.write(self.style.SUCCESS("Boot within budget, deferred modules not imported"))
+
+
+    def boot(self, *flags):
+
+        result = subprocess.run(
+            [sys.executable, *flags, "-c", PROBE],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", "image_processing.settings")},
+            capture_output=True,
+            text=True,
+        )
+
+        if result.returncode != 0:
+            raise CommandError(f"The worker failed to boot:\n{result.stderr}")
+
+        # Anything the settings or apps print comes before the report
+        return {**json.loads(result.stdout.strip().splitlines()[-1]), "stderr": result.stderr}
+
+
+    def print_imports(self, count):
+
+        """
+        The Modules Slowest to Import by Themselves, Without The Modules They Import
+        """
+
+        rows = []
+
+        for line in self.boot("-X", "importtime")["stderr"].splitlines():
+
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+
+            own, cumulative, name = line[len("import time:"):].split("|")
+
+            rows.append((int(own), int(cumulative), name.strip()))
+
+        self.stdout.write(f"\n{'self ms':>9} {'cumulative ms':>14}  module")
+
+        for own, cumulative, name in sorted(rows, reverse=True)[:count]:
+            self.stdout.write(f"{own / 1000:>9.1f} {cumulative / 1000:>14.1f}  {name}")
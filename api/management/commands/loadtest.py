@@ -0,0 +1,140 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.loadtest import LOADTEST_PASSWORD, Replay, compare, loadtest_email, read_sessions, synthesize_sessions, write_sessions
+from authentication.models import User
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Load tests the image and auth endpoints of a running server. `synthesize` writes sessions "
+        "to JSONL, `seed` creates the users they log in as, `replay` runs them concurrently and "
+        "reports latency percentiles, error rates and throughput per endpoint"
+    )
+
+
+    def add_arguments(self, parser):
+
+        actions = parser.add_subparsers(dest="action", required=True)
+
+        synthesize = actions.add_parser("synthesize", help="Write synthetic sessions to a JSONL file")
+        synthesize.add_argument("output", help="Sessions file, e.g. loadtest/sessions.jsonl")
+        synthesize.add_argument("--sessions", type=int, default=200)
+        synthesize.add_argument("--seed", type=int, default=0)
+        synthesize.add_argument("--megapixels", nargs="+", type=float, default=[0.25, 1, 4], help="Upload sizes picked from")
+        synthesize.add_argument("--login-ratio", type=float, default=0.3, help="Share of sessions that log in first")
+        synthesize.add_argument("--users", type=int, default=50, help="Seeded users the logins pick from")
+        synthesize.add_argument("--prefix", default="/api/", help="/api/ or /api/async/")
+
+        seed = actions.add_parser("seed", help="Create the active users the synthetic logins use")
+        seed.add_argument("--users", type=int, default=50)
+
+        replay = actions.add_parser("replay", help="Replay sessions against a server and report")
+        replay.add_argument("sessions", help="Sessions file")
+        replay.add_argument("--url", default="http://127.0.0.1:8000", help="Server to load")
+        replay.add_argument("--concurrency", type=int, default=16, help="Virtual users at a time")
+        replay.add_argument("--think-scale", type=float, default=1.0, help="Multiplier for think times, 0 for none")
+        replay.add_argument("--timeout", type=float, default=60, help="Seconds per request")
+        replay.add_argument("--output", help="Write the result as JSON, to use as a baseline later")
+        replay.add_argument("--baseline", help="Earlier result to compare against")
+        replay.add_argument("--max-latency-regression", type=float, default=0.2, help="Allowed p50/p99 growth")
+        replay.add_argument("--max-throughput-regression", type=float, default=0.2, help="Allowed throughput drop")
+        replay.add_argument("--max-error-rate-increase", type=float, default=0.01, help="Allowed error rate growth")
+
+
+    def handle(self, *args, **options):
+
+        getattr(self, options["action"])(options)
+
+
+    def synthesize(self, options):
+
+        sessions = synthesize_sessions(
+            options["sessions"],
+            seed=options["seed"],
+            megapixels=options["megapixels"],
+            login_ratio=options["login_ratio"],
+            users=options["users"],
+            prefix=options["prefix"],
+        )
+
+        write_sessions(options["output"], sessions)
+
+        steps = sum(len(session["steps"]) for session in sessions)
+
+        self.stdout.write(f"{len(sessions)} sessions, {steps} requests written to {options['output']}")
+
+
+    def seed(self, options):
+
+        existing = set(User.objects.filter(email__startswith="loadtest").values_list("email", flat=True))
+
+        users = [
+            User(username=f"loadtest{index}", email=loadtest_email(index), is_active=True)
+            for index in range(options["users"]) if loadtest_email(index) not in existing
+        ]
+
+        for user in users:
+            user.set_password(LOADTEST_PASSWORD)
+
+        User.objects.bulk_create(users)
+
+        self.stdout.write(f"{len(users)} users created, {len(existing)} already there")
+
+
+    def replay(self, options):
+
+        replay = Replay(
+            options["url"],
+            read_sessions(options["sessions"]),
+            concurrency=options["concurrency"],
+            think_scale=options["think_scale"],
+            timeout=options["timeout"],
+        )
+
+        self.stdout.write(f"Replaying {len(replay.sessions)} sessions against {options['url']} with {options['concurrency']} users...")
+
+        result = replay.run()
+
+        self.print_result(result)
+
+        if options["output"]:
+
+            with open(options["output"], "w") as f:
+                json.dump(result, f, indent=2)
+
+            self.stdout.write(f"Result written to {options['output']}")
+
+        if options["baseline"]:
+
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+
+            failures = compare(
+                result,
+                baseline,
+                max_latency_regression=options["max_latency_regression"],
+                max_throughput_regression=options["max_throughput_regression"],
+                max_error_rate_increase=options["max_error_rate_increase"],
+            )
+
+            if failures:
+                raise CommandError("Regressions against the baseline:\n" + "\n".join(failures))
+
+            self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
+
+
+    def print_result(self, result):
+
+        self.stdout.write("")
+        self.stdout.write(f"{'endpoint':<20} {'requests':>8} {'req/s':>8} {'errors':>7} {'413/429':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9}")
+
+        for name, row in {**result["endpoints"], "overall": result["overall"]}.items():
+            self.stdout.write(
+                f"{name:<20} {row['requests']:>8} {row['throughput']:>8.1f} {row['error_rate']:>7.1%} "
+                f"{row['rejected_rate']:>8.1%} {row['p50']:>9.1f} {row['p90']:>9.1f} {row['p99']:>9.1f}"
+            )
+
+        self.stdout.write(f"\n{result['elapsed']} s")
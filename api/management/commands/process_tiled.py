@@ -0,0 +1,84 @@
+import json
+import resource
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.memory import memory_ledger
+from api.operations import OPERATIONS, InvalidParameters
+from api.tiles import TILED_OPERATIONS, TiledImage, run_tiled
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Runs an image operation tile by tile on a file too large for memory and streams the "
+        "result to a .png, .pgm/.ppm or .npy file. .npy and binary PGM/PPM inputs are memory-mapped, "
+        "other formats are decoded once into a temporary file"
+    )
+
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("input", help="Image to process")
+        parser.add_argument("output", help="Where to write the result, .png, .pgm, .ppm or .npy")
+        parser.add_argument("--operation", required=True, choices=sorted(TILED_OPERATIONS))
+        parser.add_argument("--params", default="{}", help='Parameters as JSON, as the endpoint takes them, e.g. \'{"resize_scale": 0.5}\'')
+        parser.add_argument("--tile-size", type=int, help="Pixels per side of a tile, IMAGE_TILES['TILE_SIZE'] by default")
+        parser.add_argument("--directory", help="Where the temporary images go, IMAGE_TILES['DIRECTORY'] by default")
+
+
+    def handle(self, *args, **options):
+
+        name = options["operation"]
+
+        try:
+            params = OPERATIONS[name].parse(json.loads(options["params"]))
+        except (ValueError, AttributeError) as e:
+            # InvalidParameters, malformed JSON, or JSON that isn't an object
+            raise CommandError(f"Invalid parameters: {e}" if isinstance(e, InvalidParameters) else f"--params must be a JSON object: {e}")
+
+        started = time.perf_counter()
+
+        try:
+            src = TiledImage.open(options["input"], directory=options["directory"])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(f"{options['input']}: {src.width}x{src.height} {src.mode}, {src.width * src.height / 1_000_000:.1f} MP")
+
+        last = [0]
+
+        def progress(fraction):
+
+            percent = int(fraction * 100)
+
+            if percent >= last[0] + 10:
+                last[0] = percent
+                self.stdout.write(f"  {percent}%")
+
+        with src:
+
+            with run_tiled(name, src, params, progress=progress, tile_size=options["tile_size"], directory=options["directory"]) as result:
+
+                computed = time.perf_counter()
+                described = f"{result.width}x{result.height} {result.mode}"
+
+                try:
+                    result.save(options["output"])
+                except ValueError as e:
+                    raise CommandError(str(e))
+
+        finished = time.perf_counter()
+
+        # ru_maxrss is in KB on Linux, and counts the pages of the mapped files that were resident
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+        self.stdout.write(
+            f"{options['output']}: {described}, computed in {computed - started:.2f} s, "
+            f"written in {finished - computed:.2f} s"
+        )
+        self.stdout.write(
+            f"Peak reserved {memory_ledger.stats()['peak_reserved_bytes'] / 1024 / 1024:.1f} MB, "
+            f"peak resident {peak_rss / 1024 / 1024:.1f} MB (mapped file pages included)"
+        )
@@ -0,0 +1,279 @@
+# memory.py
+import contextvars
+import threading
+
+from django.conf import settings
+
+from .metrics import metrics
+
+
+# Memory accounting for the image kernels.
+#
+# Kernels declare what they are about to allocate before allocating it: the full-size
+# buffers they can't do without, and the scratch bytes per pixel a band of rows needs.
+# Declarations are reserved against one budget for the whole process, so concurrent
+# requests on large images see each other. When the budget runs low, run_strips gets
+# fewer bands in flight and smaller bands instead of the usual ones, and a kernel with an
+# optional full-size buffer (the Sobel magnitudes) recomputes instead of keeping it.
+# Every operation records the peak of what it reserved, per operation name.
+
+
+DEFAULT_IMAGE_MEMORY = {
+    "BUDGET_BYTES": 2 * 1024 * 1024 * 1024,   # Shared by every kernel running in the process
+    "SYSTEM_FRACTION": 0.8,                   # Never plan past this share of the memory the OS reports available
+}
+
+
+def memory_config():
+
+    try:
+        configured = getattr(settings, "IMAGE_MEMORY", {})
+    except Exception:
+        # Kernels also run in worker processes and benchmarks without Django configured
+        configured = {}
+
+    return {**DEFAULT_IMAGE_MEMORY, **configured}
+
+
+
+def system_available_bytes():
+
+    """
+    MemAvailable From /proc/meminfo, or None Where There Is No Such File
+    """
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+    return None
+
+
+
+
+class Reservation:
+
+    """
+    Bytes Granted by The Ledger, Given Back When The with Block Ends
+    """
+
+    __slots__ = ("ledger", "nbytes", "account")
+
+    def __init__(self, ledger, nbytes, account):
+
+        self.ledger = ledger
+        self.nbytes = nbytes
+        self.account = account
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *exc_info):
+
+        self.release()
+
+
+    def release(self):
+
+        if self.nbytes:
+            self.ledger._release(self.nbytes, self.account)
+            self.nbytes = 0
+
+
+
+
+class OperationAccount:
+
+    """
+    What One Operation Has Reserved, Now and at Its Peak
+    """
+
+    __slots__ = ("name", "current", "peak", "degraded")
+
+    def __init__(self, name):
+
+        self.name = name
+        self.current = 0
+        self.peak = 0
+        self.degraded = False
+
+
+
+
+class MemoryLedger:
+
+    def __init__(self, budget_bytes, system_fraction):
+
+        self.budget_bytes = budget_bytes
+        self.system_fraction = system_fraction
+
+        self.reserved = 0
+        self.peak_reserved = 0
+        self.degraded = 0
+        self.overcommitted = 0
+        self.operations = {}
+
+        self.current = contextvars.ContextVar("memory_account", default=None)
+        self._lock = threading.Lock()
+
+
+    def available(self, system=None):
+
+        """
+        Bytes That May Still Be Reserved
+        """
+
+        free = self.budget_bytes - self.reserved
+
+        if system is not None:
+            free = min(free, int(system * self.system_fraction))
+
+        return max(0, free)
+
+
+    def reserve(self, nbytes, minimum=None):
+
+        """
+        Reserves Up To nbytes, at Least minimum (All of It by Default). The minimum Is Granted
+        Even Over Budget, a Kernel Can't Run With Less. Returns a Reservation, Check Its nbytes
+        """
+
+        nbytes = int(nbytes)
+        minimum = nbytes if minimum is None else int(minimum)
+
+        account = self.current.get()
+
+        if nbytes == 0:
+            return Reservation(self, 0, account)
+
+        # Only worth a look at the OS when part of it is optional
+        system = system_available_bytes() if minimum < nbytes else None
+
+        with self._lock:
+
+            granted = nbytes if minimum >= nbytes else max(minimum, min(nbytes, self.available(system)))
+
+            if granted < nbytes:
+                self.degraded += 1
+
+                if account is not None:
+                    account.degraded = True
+
+            if granted > self.budget_bytes - self.reserved:
+                self.overcommitted += 1
+
+            self.reserved += granted
+            self.peak_reserved = max(self.peak_reserved, self.reserved)
+
+        if account is not None:
+            account.current += granted
+            account.peak = max(account.peak, account.current)
+
+        return Reservation(self, granted, account)
+
+
+    def try_reserve(self, nbytes):
+
+        """
+        Reserves nbytes Only if They Fit in The Budget. Returns a Reservation, or None.
+        For memory held past one request, which is refused rather than overcommitted
+        """
+
+        nbytes = int(nbytes)
+
+        with self._lock:
+
+            if nbytes > self.available():
+                return None
+
+            self.reserved += nbytes
+            self.peak_reserved = max(self.peak_reserved, self.reserved)
+
+        return Reservation(self, nbytes, None)
+
+
+    def _release(self, nbytes, account):
+
+        with self._lock:
+            self.reserved -= nbytes
+
+        if account is not None:
+            account.current -= nbytes
+
+
+    def operation(self, name):
+
+        """
+        Context Manager Accounting The Reservations Made Inside It To an Operation
+        """
+
+        return _OperationScope(self, name)
+
+
+    def _record(self, account):
+
+        metrics.operation_peak_bytes.observe((account.name,), account.peak)
+
+        with self._lock:
+
+            record = self.operations.setdefault(account.name, {"count": 0, "max_peak_bytes": 0, "last_peak_bytes": 0, "degraded": 0})
+
+            record["count"] += 1
+            record["max_peak_bytes"] = max(record["max_peak_bytes"], account.peak)
+            record["last_peak_bytes"] = account.peak
+            record["degraded"] += account.degraded
+
+
+    def stats(self):
+
+        with self._lock:
+
+            return {
+                "budget_bytes": self.budget_bytes,
+                "reserved_bytes": self.reserved,
+                "peak_reserved_bytes": self.peak_reserved,
+                "degraded": self.degraded,
+                "overcommitted": self.overcommitted,
+                "operations": {name: dict(record) for name, record in self.operations.items()},
+            }
+
+
+
+class _OperationScope:
+
+    def __init__(self, ledger, name):
+
+        self.ledger = ledger
+        self.account = OperationAccount(name)
+
+
+    def __enter__(self):
+
+        self.token = self.ledger.current.set(self.account)
+
+        return self.account
+
+
+    def __exit__(self, *exc_info):
+
+        self.ledger.current.reset(self.token)
+        self.ledger._record(self.account)
+
+
+
+
+def _build_ledger():
+
+    config = memory_config()
+
+    return MemoryLedger(budget_bytes=config["BUDGET_BYTES"], system_fraction=config["SYSTEM_FRACTION"])
+
+
+memory_ledger = _build_ledger()
@@ -0,0 +1,470 @@
+# metrics.py
+import bisect
+import contextvars
+import hmac
+import threading
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotFound
+from rest_framework.renderers import JSONRenderer
+
+
+# Hot path timing of the image endpoints.
+#
+# Every phase of a request (cache lookup, admission, waiting for a worker, compute, PNG
+# encoding, base64, JSON rendering) runs inside stage("<name>"). The middleware collects
+# the stages of the current request and sends them back in a Server-Timing header, and
+# every stage and request is counted into in-process histograms that /metrics serves in
+# the Prometheus text format, together with the counters of the pools and caches.
+# Each server process keeps its own numbers, scrape every worker. /metrics answers 404 unless
+# the scraper sends "Authorization: Bearer <TOKEN>" or the request comes from a staff user
+# (JWT cookie). Clients aren't trusted by address by default: behind a reverse proxy on the
+# same host every request comes from loopback.
+
+
+DEFAULT_METRICS = {
+    "ENABLED": True,
+    "SERVER_TIMING": True,                      # Per request stage durations in a Server-Timing header
+    "TOKEN": None,                              # Bearer token scrapers send, None allows staff users only
+    "ALLOWED_IPS": [],                          # REMOTE_ADDRs let in without a token, only where that is the real client
+    "BUCKETS": (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),   # Seconds
+}
+
+
+def metrics_config():
+
+    return {**DEFAULT_METRICS, **getattr(settings, "METRICS", {})}
+
+
+
+
+class Histogram:
+
+    """
+    Cumulative Bucket Counts, a Sum and a Count For Every Combination of Label Values
+    """
+
+    def __init__(self, name, help_text, labels, buckets):
+
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+
+        self._series = {}
+        self._lock = threading.Lock()
+
+
+    def observe(self, label_values, value):
+
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+
+            series = self._series.get(label_values)
+
+            if series is None:
+                # One count per bucket plus +Inf, then the sum
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+
+            series[index] += 1
+            series[-1] += value
+
+
+    def exposition(self):
+
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+
+        for label_values, values in sorted(series.items()):
+
+            labels = _labels(zip(self.labels, label_values))
+            cumulative = 0
+
+            for bound, count in zip((*self.buckets, "+Inf"), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+
+            lines.append(f"{_series(self.name + '_sum', labels)} {values[-1]:.6f}")
+            lines.append(f"{_series(self.name + '_count', labels)} {cumulative}")
+
+        return lines
+
+
+    def clear(self):
+
+        with self._lock:
+            self._series.clear()
+
+
+
+
+class Timings:
+
+    """
+    The Stages of One Request, Summed by Name in The Order They First Ran
+    """
+
+    __slots__ = ("stages",)
+
+    def __init__(self):
+
+        self.stages = {}
+
+
+    def add(self, name, seconds):
+
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+
+    def header(self, total):
+
+        parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items()]
+        parts.append(f"total;dur={total * 1000:.2f}")
+
+        return ", ".join(parts)
+
+
+
+
+class Metrics:
+
+    def __init__(self, enabled, server_timing, token, allowed_ips, buckets):
+
+        self.enabled = enabled
+        self.server_timing = server_timing
+        self.token = token
+        self.allowed_ips = set(allowed_ips)
+
+        self.stage_seconds = Histogram(
+            "image_stage_seconds", "Time spent in a stage of the image request path", ("stage",), buckets,
+        )
+        self.request_seconds = Histogram(
+            "http_request_seconds", "Time to answer a request, by route and status", ("route", "method", "status"), buckets,
+        )
+        self.operation_peak_bytes = Histogram(
+            "image_operation_peak_bytes", "Peak memory an image operation reserved, see api/memory.py", ("operation",),
+            [2 ** power for power in range(20, 35)],
+        )
+
+        self.current = contextvars.ContextVar("request_timings", default=None)
+
+
+    def record(self, name, seconds):
+
+        timings = self.current.get()
+
+        if timings is not None:
+            timings.add(name, seconds)
+
+        self.stage_seconds.observe((name,), seconds)
+
+
+    def is_allowed(self, request):
+
+        """
+        Whether The Request May Read /metrics: The Scrape Token, a Staff User, or an ALLOWED_IPS Address
+        """
+
+        from authentication.permissions import is_staff_request
+
+        if self.token:
+
+            scheme, _, credentials = request.META.get("HTTP_AUTHORIZATION", "").partition(" ")
+
+            if scheme.lower() == "bearer" and hmac.compare_digest(credentials.encode(), self.token.encode()):
+                return True
+
+        if request.META.get("REMOTE_ADDR") in self.allowed_ips:
+            return True
+
+        return is_staff_request(request)
+
+
+    def exposition(self):
+
+        lines = self.stage_seconds.exposition() + self.request_seconds.exposition() + self.operation_peak_bytes.exposition()
+
+        for prefix, stats, labels in component_stats():
+
+            for key, value in stats.items():
+
+                # Numbers only, booleans and the nested breakdowns (top_users, lanes) are left out
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+
+                lines.append(f"{_series(f'{prefix}_{key}', _labels(labels.items()))} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+
+
+class _Stage:
+
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+
+        self.name = name
+
+
+    def __enter__(self):
+
+        self.started = time.perf_counter()
+
+
+    def __exit__(self, *exc_info):
+
+        metrics.record(self.name, time.perf_counter() - self.started)
+
+
+
+class _NoStage:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_no_stage = _NoStage()
+
+
+
+def stage(name):
+
+    """
+    Context Manager Timing a Stage of The Current Request. Does Nothing When Metrics Are Disabled
+    """
+
+    if not metrics.enabled:
+        return _no_stage
+
+    return _Stage(name)
+
+
+
+def timed(name):
+
+    """
+    Decorator Timing Every Call of a Function as a Stage
+    """
+
+    def decorator(fn):
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+
+            if not metrics.enabled:
+                return fn(*args, **kwargs)
+
+            with _Stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+
+def carry_timings(fn):
+
+    """
+    Wraps fn So Its Stages Count Towards The Current Request When It Runs On Another Thread,
+    and Records The Time It Waited For That Thread as The "queue" Stage
+    """
+
+    if not metrics.enabled or metrics.current.get() is None:
+        return fn
+
+    timings = metrics.current.get()
+    queued_at = time.perf_counter()
+
+    def run(*args):
+
+        token = metrics.current.set(timings)
+
+        metrics.record("queue", time.perf_counter() - queued_at)
+
+        try:
+            return fn(*args)
+        finally:
+            metrics.current.reset(token)
+
+    return run
+
+
+
+
+class TimedJSONRenderer(JSONRenderer):
+
+    """
+    JSONRenderer Timing The Rendering as The "render" Stage
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+
+        with stage("render"):
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+
+
+class ServerTimingMiddleware:
+
+    """
+    Times Every Request, Adds The Server-Timing Header and Counts The Request Into The Histograms
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+
+        if self.is_async:
+            markcoroutinefunction(self)
+
+
+    def __call__(self, request):
+
+        if self.is_async:
+            return self.__acall__(request)
+
+        if not metrics.enabled:
+            return self.get_response(request)
+
+        timings = Timings()
+        token = metrics.current.set(timings)
+        started = time.perf_counter()
+
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.current.reset(token)
+
+        return self.finish(request, response, timings, time.perf_counter() - started)
+
+
+    async def __acall__(self, request):
+
+        if not metrics.enabled:
+            return await self.get_response(request)
+
+        timings = Timings()
+        token = metrics.current.set(timings)
+        started = time.perf_counter()
+
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.current.reset(token)
+
+        return self.finish(request, response, timings, time.perf_counter() - started)
+
+
+    def finish(self, request, response, timings, total):
+
+        # The route pattern, not the path, so ids don't turn into new series
+        match = getattr(request, "resolver_match", None)
+        route = match.route if match is not None else "unmatched"
+
+        metrics.request_seconds.observe((route, request.method, str(response.status_code)), total)
+
+        if metrics.server_timing:
+            response["Server-Timing"] = timings.header(total)
+
+        return response
+
+
+
+
+def metrics_view(request):
+
+    """
+    Serves The Histograms and Component Counters in The Prometheus Text Format
+    """
+
+    if not metrics.enabled or not metrics.is_allowed(request):
+        return HttpResponseNotFound()
+
+    return HttpResponse(metrics.exposition(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+
+
+def component_stats():
+
+    """
+    Yields (metric prefix, stats dictionary, labels) For Every Pool and Cache With Counters
+    """
+
+    # Imported here, most of them time their own work with this module
+    from authentication.emails import connection_pool
+    from authentication.hashers import hashing_pool
+    from authentication.tasks import background
+
+    from .compute import compute_pool
+    from .image_store import image_store
+    from .memory import memory_ledger
+    from .singleflight import single_flight
+    from .supersede import latest_wins
+
+    pool = compute_pool.stats()
+
+    yield "image_store", image_store.stats(), {}
+    yield "compute_pool", pool, {}
+
+    for lane, lane_stats in pool["lanes"].items():
+        yield "compute_lane", lane_stats, {"lane": lane or "default"}
+
+    memory = memory_ledger.stats()
+
+    yield "image_memory", memory, {}
+
+    for operation, operation_stats in memory["operations"].items():
+        yield "image_memory_operation", operation_stats, {"operation": operation}
+
+    yield "single_flight", single_flight.stats(), {}
+    yield "latest_wins", latest_wins.stats(), {}
+    yield "background_tasks", background.stats(), {}
+    yield "password_hashing", hashing_pool.stats(), {}
+    yield "email_connections", connection_pool.stats(), {}
+
+
+
+def _labels(pairs):
+
+    return ",".join(f'{name}="{value}"' for name, value in pairs)
+
+
+
+def _series(name, labels):
+
+    return f"{name}{{{labels}}}" if labels else name
+
+
+
+def _build_metrics():
+
+    config = metrics_config()
+
+    return Metrics(
+        enabled=config["ENABLED"],
+        server_timing=config["SERVER_TIMING"],
+        token=config["TOKEN"],
+        allowed_ips=config["ALLOWED_IPS"],
+        buckets=config["BUCKETS"],
+    )
+
+
+metrics = _build_metrics()
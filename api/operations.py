@@ -0,0 +1,304 @@
+# operations.py
+import math
+from typing import Callable, NamedTuple
+
+import numpy as np
+from PIL import Image
+
+from .imaging import (
+    GEOMETRY_OPERATIONS,
+    base64_to_image,
+    image_to_base64,
+    apply_adjustments,
+    bl_resize,
+    change_geometry,
+    sobel_edge_detection,
+    channel_splitting,
+    to_8bit,
+    to_native,
+)
+from .memory import memory_ledger
+from .metrics import stage
+
+
+class InvalidParameters(ValueError):
+
+    """
+    Raised by a parser when the request data can't be turned into operation parameters
+    """
+
+
+
+class Operation(NamedTuple):
+
+    parse: Callable      # request data -> params, raises InvalidParameters
+    compute: Callable    # (original image, params, progress=None) -> result dict, may hold PIL Images
+
+
+
+
+# -----------------------------------------------------------------------------
+# Parsers
+
+
+def _float_param(data, name, default):
+
+    try:
+        value = float(data.get(name, default))
+    except (TypeError, ValueError):
+        raise InvalidParameters(f"{name} must be a number")
+
+    if not math.isfinite(value):
+        raise InvalidParameters(f"{name} must be a finite number")
+
+    return value
+
+
+
+def parse_adjustments(data):
+
+    params = {
+        "brightness": _float_param(data, "brightness", 0),
+        "contrast": _float_param(data, "contrast", 0),
+        "saturation": _float_param(data, "saturation", 0),
+        "gamma": _float_param(data, "gamma", 1.0),
+    }
+
+    # The kernel raises pixels to 1 / gamma
+    if params["gamma"] <= 0:
+        raise InvalidParameters("gamma must be positive")
+
+    return params
+
+
+
+def parse_resize(data):
+
+    if not data.get("resize_scale", None):
+        raise InvalidParameters("Resize Scale is required")
+
+    resize_scale = _float_param(data, "resize_scale", None)
+
+    if resize_scale <= 0:
+        raise InvalidParameters("Resize Scale must be positive")
+
+    return {"resize_scale": resize_scale}
+
+
+
+def parse_geometry(data):
+
+    change_to_be_made = data.get("change_to_be_made", None)
+
+    if not change_to_be_made:
+        raise InvalidParameters("change_to_be_made is required")
+
+    if isinstance(change_to_be_made, str):
+        change_to_be_made = [change_to_be_made]
+
+    if any(op not in GEOMETRY_OPERATIONS for op in change_to_be_made):
+        raise InvalidParameters("Invalid geometry operation")
+
+    return {"change_to_be_made": list(change_to_be_made)}
+
+
+
+def parse_nothing(data):
+
+    return {}
+
+
+
+
+# -----------------------------------------------------------------------------
+# Conversions, only at the kernels that need one layout
+
+
+def grayscale_array(img):
+
+    """
+    The Gray Levels of an Image. L and I;16 Images Are Used As They Are, Without a Conversion
+    """
+
+    if img.mode in ("L", "I;16"):
+        return np.asarray(img)
+
+    if img.mode == "LA":
+        return np.asarray(img)[:, :, 0]
+
+    return np.asarray(img.convert("L"))
+
+
+
+def rgb_array(img):
+
+    """
+    The Pixels of an Image as 8-bit RGB, For The Kernels That Work On Three Channels
+    """
+
+    if img.mode == "I;16":
+        # PIL clips 16-bit values when converting, they are scaled down here
+        img = Image.fromarray(to_8bit(np.asarray(img)))
+
+    return np.asarray(img if img.mode == "RGB" else img.convert("RGB"))
+
+
+
+
+# -----------------------------------------------------------------------------
+# Computations, always starting from the ORIGINAL image which is never modified
+
+
+def compute_adjustments(original_img, params, progress=None):
+
+    return {"image": apply_adjustments(original_img, progress=progress, **params)}
+
+
+
+def compute_resize(original_img, params, progress=None):
+
+    original_array = np.asarray(original_img)
+
+    resize_scale = params["resize_scale"]
+
+    new_h = math.ceil(original_array.shape[0] * resize_scale)
+    new_w = math.ceil(original_array.shape[1] * resize_scale)
+
+    resized_array = bl_resize(original_array, new_w=new_w, new_h=new_h, progress=progress)
+
+    return {
+        "image_w": original_array.shape[1],
+        "image_h": original_array.shape[0],
+        "resize_scale": resize_scale,
+        "new_image_w": new_w,
+        "new_image_h": new_h,
+        "image": Image.fromarray(resized_array),
+    }
+
+
+
+def compute_geometry(original_img, params, progress=None):
+
+    array = np.asarray(original_img)
+
+    for op in params["change_to_be_made"]:
+        array = change_geometry(array, op)
+
+    return {"image": Image.fromarray(array)}
+
+
+
+def compute_edges(original_img, params, progress=None):
+
+    return {"image": sobel_edge_detection(grayscale_array(original_img), progress=progress)}
+
+
+
+def compute_channels(original_img, params, progress=None):
+
+    split_result = channel_splitting(rgb_array(original_img))
+
+    red_img, green_img, blue_img = split_result[0]
+    red_contribution, green_contribution, blue_contribution = split_result[1]
+
+    return {
+        "images": {
+            'red_image': red_img,
+            'green_image': green_img,
+            'blue_image': blue_img
+        },
+        "contributions": {
+            'red_contribution': red_contribution,
+            'green_contribution': green_contribution,
+            'blue_contribution': blue_contribution
+        }
+    }
+
+
+
+
+OPERATIONS = {
+    "apply_adjustments": Operation(parse_adjustments, compute_adjustments),
+    "resize_image": Operation(parse_resize, compute_resize),
+    "modify_geometry": Operation(parse_geometry, compute_geometry),
+    "edge_detection": Operation(parse_nothing, compute_edges),
+    "channel_analysis": Operation(parse_nothing, compute_channels),
+}
+
+
+
+def operation_pixels(name, original_img, params):
+
+    """
+    Pixels an Operation Works Through, The Larger of Its Input and Output. Used To Schedule It
+    """
+
+    pixels = original_img.width * original_img.height
+
+    if name == "resize_image":
+
+        resize_scale = params["resize_scale"]
+
+        pixels = max(pixels, math.ceil(original_img.height * resize_scale) * math.ceil(original_img.width * resize_scale))
+
+    return pixels
+
+
+
+def render_result(result):
+
+    """
+    Encodes Every PIL Image In The Result Dictionary as a Base64 Data URL
+    """
+
+    return {
+        key: image_to_base64(value) if isinstance(value, Image.Image) else value
+        for key, value in result.items()
+    }
+
+
+
+def compute_operation(name, original_img, params, progress=None):
+
+    """
+    Computes an Operation Without Rendering It. Module level so it can run in a worker process
+    """
+
+    # The peak of what the kernels reserved is recorded per operation, see api/memory.py
+    with stage("compute"), memory_ledger.operation(name):
+        return OPERATIONS[name].compute(original_img, params, progress=progress)
+
+
+
+def run_operation(name, original_img, params, progress=None):
+
+    """
+    Computes and Renders an Operation. Module level so it can run in a worker process
+    """
+
+    return render_result(compute_operation(name, original_img, params, progress=progress))
+
+
+
+def decode_upload(image_base64, size=None):
+
+    """
+    Decodes an Uploaded Base64 Image Into a Loaded PIL Image in Its Native Mode (L, LA, RGB, RGBA
+    or I;16, see imaging.NATIVE_MODES), Raises ValueError.
+    With a (width, height) size, the image is scaled down to fit it, a JPEG already while decoding
+    """
+
+    with stage("decode"):
+
+        img = base64_to_image(image_base64)
+
+        if size is not None:
+            img.draft(None, size)
+
+        img.load()
+        img = to_native(img)
+
+        if size is not None:
+            img.thumbnail(size)
+
+    return img
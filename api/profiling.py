@@ -0,0 +1,544 @@
+# profiling.py
+import cProfile
+import contextvars
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+
+from authentication.permissions import is_staff_request
+
+from .cost import probe_base64
+from .image_store import image_store
+from .metrics import metrics
+
+
+# On-demand profiling of single requests.
+#
+# A staff user sends "X-Profile: sample" (or cprofile, or both) with a request, and that
+# one request runs under the sampling profiler, cProfile or both. The request thread (under
+# ASGI the event loop thread and the thread running the request's sync middleware and view)
+# and any compute pool thread working for it are profiled, and the results are written to
+# PROFILING["DIRECTORY"] as <id>.collapsed (one "frame;frame;frame count" line per stack,
+# ready for flamegraph.pl or speedscope), <id>.prof (pstats, for snakeviz or
+# `python -m pstats`) and <id>.json with what the request was about: the image size,
+# the operation parameters and the stage timings. The profile id comes back in the
+# X-Profile-Id response header. Requests without the header only pay for a dict lookup.
+
+
+SAMPLE = "sample"
+CPROFILE = "cprofile"
+BOTH = "both"
+
+MODES = (SAMPLE, CPROFILE, BOTH)
+
+
+# Before 3.12 cProfile hooks the thread that enables it, so every thread of a request gets
+# its own. From 3.12 it is a single sys.monitoring tool that sees every thread, and enabling
+# a second one while it runs raises ValueError, so the request thread's profile is the only one
+PER_THREAD_CPROFILE = sys.version_info < (3, 12)
+
+
+DEFAULT_PROFILING = {
+    "ENABLED": True,
+    "HEADER": "X-Profile",
+    "DIRECTORY": "profiles",
+    "SAMPLE_INTERVAL": 0.001,    # Seconds between stack samples
+    "KEEP": 200,                 # Profiles kept in the directory, the oldest are deleted
+}
+
+
+def profiling_config():
+
+    return {**DEFAULT_PROFILING, **getattr(settings, "PROFILING", {})}
+
+
+
+
+class StackSampler:
+
+    """
+    Samples The Python Stacks of The Registered Threads at a Fixed Interval and Counts Them
+    """
+
+    def __init__(self, interval):
+
+        self.interval = interval
+
+        self.threads = {}
+        self.stacks = Counter()
+        self.samples = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def add_thread(self, ident, name):
+
+        self.threads[ident] = name
+
+
+    def remove_thread(self, ident):
+
+        self.threads.pop(ident, None)
+
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+
+        self._stop.set()
+        self._thread.join()
+
+
+    def _run(self):
+
+        while not self._stop.wait(self.interval):
+
+            frames = sys._current_frames()
+
+            for ident, name in list(self.threads.items()):
+
+                frame = frames.get(ident)
+
+                if frame is not None:
+                    self.stacks[collapse(frame, name)] += 1
+                    self.samples += 1
+
+
+    def collapsed(self):
+
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+
+def collapse(frame, root):
+
+    """
+    Turns a Frame Into a Collapsed Stack, Outermost Frame First, Under a Root Frame
+    """
+
+    names = []
+
+    while frame is not None:
+
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+
+        frame = frame.f_back
+
+    names.append(root)
+
+    return ";".join(reversed(names))
+
+
+
+
+class ProfileSession:
+
+    """
+    One Profiled Request. Every Thread Working For It Enters and Leaves The Session
+    """
+
+    def __init__(self, mode, sample_interval):
+
+        self.mode = mode
+        self.sample_interval = sample_interval
+        self.sampler = StackSampler(sample_interval) if mode in (SAMPLE, BOTH) else None
+        self.profiles = []
+        self.enabled_profiles = 0
+        self.cprofile_unavailable = False
+
+        self._lock = threading.Lock()
+
+
+    def start(self):
+
+        if self.sampler is not None:
+            self.sampler.start()
+
+
+    def stop(self):
+
+        if self.sampler is not None:
+            self.sampler.stop()
+
+
+    def enter(self):
+
+        ident = threading.get_ident()
+        profile = None
+
+        with self._lock:
+
+            if self.mode in (CPROFILE, BOTH) and (PER_THREAD_CPROFILE or not self.enabled_profiles):
+                profile = self._enable_profile()
+
+            if self.sampler is not None:
+                self.sampler.add_thread(ident, threading.current_thread().name)
+
+        return ident, profile
+
+
+    def leave(self, state):
+
+        ident, profile = state
+
+        with self._lock:
+
+            if profile is not None:
+                profile.disable()
+                self.profiles.append(profile)
+                self.enabled_profiles -= 1
+
+            if self.sampler is not None:
+                self.sampler.remove_thread(ident)
+
+
+    def _enable_profile(self):
+
+        profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler, debugger or coverage tool holds the hook, the request is sampled instead
+            self.cprofile_unavailable = True
+
+            if self.sampler is None:
+                self.sampler = StackSampler(self.sample_interval)
+                self.sampler.start()
+
+            return None
+
+        self.enabled_profiles += 1
+
+        return profile
+
+
+    def write(self, directory, profile_id, metadata):
+
+        os.makedirs(directory, exist_ok=True)
+
+        base = os.path.join(directory, profile_id)
+
+        if self.profiles:
+            pstats.Stats(*self.profiles).dump_stats(f"{base}.prof")
+
+        if self.cprofile_unavailable:
+            metadata["cprofile"] = "unavailable, another profiling tool was active, sampled instead"
+
+        if self.sampler is not None:
+
+            metadata["samples"] = self.sampler.samples
+
+            with open(f"{base}.collapsed", "w") as f:
+                f.write(self.sampler.collapsed())
+
+        with open(f"{base}.json", "w") as f:
+            json.dump(metadata, f, indent=2, default=str)
+
+
+
+
+class Profiler:
+
+    def __init__(self, enabled, header, directory, sample_interval, keep):
+
+        self.enabled = enabled
+        self.meta_key = "HTTP_" + header.upper().replace("-", "_")
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.keep = keep
+
+        self.current = contextvars.ContextVar("profile_session", default=None)
+
+        # cProfile and the sampler are process wide, one profiled request at a time
+        self._busy = threading.Lock()
+
+
+    def requested_mode(self, request):
+
+        """
+        Returns The Mode Asked For in The Header, or None. The Only Cost of Requests Without It
+        """
+
+        if not self.enabled:
+            return None
+
+        value = request.META.get(self.meta_key)
+
+        if value is None:
+            return None
+
+        value = value.strip().lower()
+
+        return value if value in MODES else SAMPLE
+
+
+    def begin(self, mode):
+
+        """
+        Starts a Session, or Returns None When Another Request Is Being Profiled
+        """
+
+        if not self._busy.acquire(blocking=False):
+            return None
+
+        session = ProfileSession(mode, self.sample_interval)
+        session.start()
+
+        return session
+
+
+    def end(self, session, metadata):
+
+        try:
+            session.stop()
+
+            profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+            session.write(self.directory, profile_id, metadata)
+
+        finally:
+            self._busy.release()
+
+        self.prune()
+
+        return profile_id
+
+
+    def prune(self):
+
+        try:
+            names = sorted(name[:-len(".json")] for name in os.listdir(self.directory) if name.endswith(".json"))
+        except FileNotFoundError:
+            return
+
+        # The ids start with the time, so sorting them sorts the profiles by age
+        for profile_id in names[:max(0, len(names) - self.keep)]:
+
+            for extension in (".json", ".prof", ".collapsed"):
+
+                try:
+                    os.remove(os.path.join(self.directory, f"{profile_id}{extension}"))
+                except FileNotFoundError:
+                    pass
+
+
+
+
+def profiled(fn):
+
+    """
+    Wraps fn So That It Is Profiled With The Current Request When It Runs On Another Thread
+    """
+
+    session = profiler.current.get()
+
+    if session is None:
+        return fn
+
+    def run(*args):
+
+        state = session.enter()
+
+        try:
+            return fn(*args)
+        finally:
+            session.leave(state)
+
+    return run
+
+
+
+
+def request_metadata(request):
+
+    """
+    What The Request Was About: Route, Operation Parameters and The Size of The Image
+    """
+
+    metadata = {
+        "method": request.method,
+        "path": request.path,
+        "query": request.GET.dict(),
+        "body_bytes": int(request.META.get("CONTENT_LENGTH") or 0),
+    }
+
+    try:
+        body = request.body
+    except RequestDataTooBig:
+        # Over DATA_UPLOAD_MAX_MEMORY_SIZE, left for the view to answer as it would unprofiled
+        return metadata
+
+    metadata["body_bytes"] = len(body)
+
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        data = None
+
+    if not isinstance(data, dict):
+        return metadata
+
+    # The upload itself is far too big to keep, its header says enough
+    metadata["params"] = {key: value for key, value in data.items() if key != "image_base64"}
+
+    image_base64 = data.get("image_base64")
+    image_id = data.get("image_id")
+
+    if isinstance(image_base64, str):
+
+        try:
+            header = probe_base64(image_base64)
+            metadata["image"] = {"width": header.width, "height": header.height, "mode": header.mode, "format": header.format}
+        except ValueError:
+            metadata["image"] = None
+
+    elif isinstance(image_id, str):
+
+        img = image_store.get(f"original:{image_id}")
+
+        if img is not None:
+            metadata["image"] = {"width": img.width, "height": img.height, "mode": img.mode}
+
+    return metadata
+
+
+
+
+class ProfilingMiddleware:
+
+    """
+    Profiles a Request When a Staff User Asks For It With The Profiling Header
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+
+        if self.is_async:
+            markcoroutinefunction(self)
+
+
+    def __call__(self, request):
+
+        if self.is_async:
+            return self.__acall__(request)
+
+        mode = profiler.requested_mode(request)
+
+        if mode is None or not is_staff_request(request):
+            return self.get_response(request)
+
+        metadata = request_metadata(request)
+
+        session = profiler.begin(mode)
+
+        if session is None:
+            return self.busy(self.get_response(request))
+
+        token = profiler.current.set(session)
+        state = session.enter()
+        started = time.perf_counter()
+
+        try:
+            response = self.get_response(request)
+        finally:
+            session.leave(state)
+            profiler.current.reset(token)
+
+        return self.finish(request, response, session, metadata, mode, time.perf_counter() - started)
+
+
+    async def __acall__(self, request):
+
+        mode = profiler.requested_mode(request)
+
+        if mode is None or not await sync_to_async(is_staff_request)(request):
+            return await self.get_response(request)
+
+        metadata = await sync_to_async(request_metadata)(request)
+
+        session = profiler.begin(mode)
+
+        if session is None:
+            return self.busy(await self.get_response(request))
+
+        # On the event loop thread, whatever else the loop runs meanwhile is in the profile too
+        token = profiler.current.set(session)
+        state = session.enter()
+
+        # Sync middleware and views run on the request's thread sensitive thread, the one
+        # sync_to_async picks here as well
+        sync_state = await sync_to_async(session.enter)()
+        started = time.perf_counter()
+
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(session.leave)(sync_state)
+            session.leave(state)
+            profiler.current.reset(token)
+
+        return await sync_to_async(self.finish)(request, response, session, metadata, mode, time.perf_counter() - started)
+
+
+    def finish(self, request, response, session, metadata, mode, seconds):
+
+        match = getattr(request, "resolver_match", None)
+        timings = metrics.current.get()
+
+        metadata.update({
+            "mode": mode,
+            "route": match.route if match is not None else None,
+            "status": response.status_code,
+            "seconds": round(seconds, 6),
+            "stages": {name: round(value, 6) for name, value in timings.stages.items()} if timings is not None else {},
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        })
+
+        response["X-Profile-Id"] = profiler.end(session, metadata)
+
+        return response
+
+
+    def busy(self, response):
+
+        response["X-Profile-Id"] = "busy"
+
+        return response
+
+
+
+
+def _build_profiler():
+
+    config = profiling_config()
+
+    return Profiler(
+        enabled=config["ENABLED"],
+        header=config["HEADER"],
+        directory=config["DIRECTORY"],
+        sample_interval=config["SAMPLE_INTERVAL"],
+        keep=config["KEEP"],
+    )
+
+
+profiler = _build_profiler()
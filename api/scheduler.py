@@ -0,0 +1,326 @@
+# scheduler.py
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+
+
+# Plan-aware scheduling for the compute pool (api/compute.py).
+#
+# Work is queued in one lane per User.user_plan. Free workers pick the next task with
+# weighted fair queuing across lanes: every dispatch advances its lane's virtual time by
+# the task's cost (megapixels) divided by the lane weight, and the lane furthest behind
+# goes next, so under contention a lane gets throughput in proportion to its weight and
+# an idle lane can't bank credit. A lane can also be capped in concurrent tasks and in
+# megapixels per second. The concurrency cap holds while other lanes have work to
+# dispatch, a worker that would otherwise sit idle takes the capped lane's next task.
+# Inside a lane, interactive work (previews, small outputs) runs before export work
+# (jobs, large outputs).
+
+
+INTERACTIVE = 0
+EXPORT = 1
+
+DEFAULT_IMAGE_SCHEDULER = {
+    "LANES": {
+        # WEIGHT: share under contention, MAX_CONCURRENCY: running tasks while other lanes have work waiting,
+        # MEGAPIXELS_PER_SECOND: pixel throughput. None means no limit
+        "pro": {"WEIGHT": 8, "MAX_CONCURRENCY": None, "MEGAPIXELS_PER_SECOND": None},
+        "free": {"WEIGHT": 2, "MAX_CONCURRENCY": 2, "MEGAPIXELS_PER_SECOND": 40},
+        "": {"WEIGHT": 2, "MAX_CONCURRENCY": 2, "MEGAPIXELS_PER_SECOND": 40},
+        "anonymous": {"WEIGHT": 1, "MAX_CONCURRENCY": 1, "MEGAPIXELS_PER_SECOND": 20},
+    },
+    "DEFAULT_LANE": "",                    # For plans without a lane of their own
+    "INTERACTIVE_MAX_PIXELS": 4_000_000,   # Bigger outputs are scheduled as export work
+    "BURST_SECONDS": 2,                    # Pixel throughput a lane may save up, in seconds of its rate
+    "MIN_COST": 0.05,                      # Megapixels charged for the tiniest task
+}
+
+
+def scheduler_config():
+
+    configured = getattr(settings, "IMAGE_SCHEDULER", {})
+
+    return {
+        **DEFAULT_IMAGE_SCHEDULER,
+        **configured,
+        "LANES": {**DEFAULT_IMAGE_SCHEDULER["LANES"], **configured.get("LANES", {})},
+    }
+
+
+
+def request_plan(user):
+
+    """
+    Returns The Lane Name For a User, Matching The Tiers of PlanRateThrottle
+    """
+
+    if user is None or not user.is_authenticated:
+        return "anonymous"
+
+    return getattr(user, "user_plan", "") or ""
+
+
+
+def classify(pixels, config=None):
+
+    """
+    Interactive For Work Up To INTERACTIVE_MAX_PIXELS, Export Above
+    """
+
+    config = config or scheduler_config()
+
+    return INTERACTIVE if pixels <= config["INTERACTIVE_MAX_PIXELS"] else EXPORT
+
+
+
+def scheduling(user, pixels, priority=None):
+
+    """
+    Returns The plan/priority/pixels Arguments of ComputePool.submit For Work Done For a User
+    """
+
+    return {
+        "plan": request_plan(user),
+        "priority": classify(pixels) if priority is None else priority,
+        "pixels": pixels,
+    }
+
+
+
+
+class Lane:
+
+    def __init__(self, name, weight, max_concurrency, megapixels_per_second, burst_seconds):
+
+        self.name = name
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.rate = megapixels_per_second
+
+        self.capacity = megapixels_per_second * burst_seconds if megapixels_per_second else None
+        self.tokens = self.capacity
+        self.refilled_at = time.monotonic()
+
+        self.virtual_time = 0.0
+        self.running = 0
+        self.queue = []
+
+        self.dispatched = 0
+        self.megapixels = 0.0
+        self.waited = 0.0
+
+
+    def refill(self, now):
+
+        if self.rate is None:
+            return
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+
+    def blocked_for(self, borrowing=False):
+
+        """
+        Seconds Until The Lane May Dispatch Again, 0 When It May Now, None When Only a Finishing Task Can Unblock It.
+        borrowing lets it past its concurrency cap, for a worker no other lane has work for
+        """
+
+        if not borrowing and self.max_concurrency is not None and self.running >= self.max_concurrency:
+            return None
+
+        if self.rate is not None and self.tokens <= 0:
+            return -self.tokens / self.rate
+
+        return 0
+
+
+    def stats(self):
+
+        return {
+            "queued": len(self.queue),
+            "running": self.running,
+            "dispatched": self.dispatched,
+            "megapixels": round(self.megapixels, 2),
+            "mean_wait_ms": round(self.waited / self.dispatched * 1000, 2) if self.dispatched else 0.0,
+        }
+
+
+
+
+class PlanScheduler:
+
+    """
+    Runs Submitted Work On a Fixed Set of Worker Threads, Picking The Next Task by Plan Lane.
+
+    run_task(fn, args) is what a worker calls to execute a task, by default it just calls
+    fn(*args), the compute pool hands it to a process pool when it is configured to.
+    """
+
+    def __init__(self, workers, lanes, default_lane, burst_seconds, min_cost, run_task=None):
+
+        self.workers = workers
+        self.default_lane = default_lane
+        self.min_cost = min_cost
+        self.run_task = run_task or (lambda fn, args: fn(*args))
+
+        self.lanes = {
+            name: Lane(
+                name,
+                weight=lane["WEIGHT"],
+                max_concurrency=lane["MAX_CONCURRENCY"],
+                megapixels_per_second=lane["MEGAPIXELS_PER_SECOND"],
+                burst_seconds=burst_seconds,
+            )
+            for name, lane in lanes.items()
+        }
+
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._started = False
+
+
+    def lane_for(self, plan):
+
+        return self.lanes.get(plan) or self.lanes[self.default_lane]
+
+
+    def submit(self, fn, *args, plan="", priority=INTERACTIVE, pixels=0):
+
+        """
+        Queues fn(*args) in The Lane of The Plan. Returns a concurrent.futures.Future
+        """
+
+        self._start()
+
+        future = Future()
+        cost = max(pixels / 1_000_000, self.min_cost)
+
+        with self._condition:
+
+            lane = self.lane_for(plan)
+
+            # A lane coming back from idle starts level with the busiest lanes, it doesn't bank credit
+            if not lane.queue and not lane.running:
+                active = [other.virtual_time for other in self.lanes.values() if other.queue or other.running]
+                lane.virtual_time = max(lane.virtual_time, min(active, default=lane.virtual_time))
+
+            heapq.heappush(lane.queue, (priority, next(self._sequence), time.monotonic(), cost, fn, args, future))
+
+            self._condition.notify()
+
+        return future
+
+
+    def _pick(self):
+
+        """
+        Pops The Next Task, or Returns (None, seconds to wait). Called With The Condition Held
+        """
+
+        now = time.monotonic()
+
+        best = None
+        wait = None
+
+        # Lanes within their caps first, then lanes at their concurrency cap rather than an idle worker
+        for borrowing in (False, True):
+
+            for lane in self.lanes.values():
+
+                if not lane.queue:
+                    continue
+
+                lane.refill(now)
+
+                blocked_for = lane.blocked_for(borrowing)
+
+                if blocked_for is None:
+                    continue
+
+                if blocked_for > 0:
+                    wait = blocked_for if wait is None else min(wait, blocked_for)
+                    continue
+
+                # Lowest virtual time first, interactive work breaks ties
+                key = (lane.virtual_time, lane.queue[0][0])
+
+                if best is None or key < best[0]:
+                    best = (key, lane)
+
+            if best is not None:
+                break
+
+        if best is None:
+            return None, wait
+
+        lane = best[1]
+
+        _, _, queued_at, cost, fn, args, future = heapq.heappop(lane.queue)
+
+        lane.virtual_time += cost / lane.weight
+        lane.running += 1
+        lane.dispatched += 1
+        lane.megapixels += cost
+        lane.waited += now - queued_at
+
+        if lane.tokens is not None:
+            lane.tokens -= cost
+
+        return (lane, fn, args, future), None
+
+
+    def _work(self):
+
+        while True:
+
+            with self._condition:
+
+                while True:
+
+                    task, wait = self._pick()
+
+                    if task is not None:
+                        break
+
+                    self._condition.wait(wait)
+
+            lane, fn, args, future = task
+
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(self.run_task(fn, args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._condition:
+                    lane.running -= 1
+                    self._condition.notify_all()
+
+
+    def _start(self):
+
+        # Threads start on first use so every server worker process gets its own after forking
+        if self._started:
+            return
+
+        with self._condition:
+
+            if self._started:
+                return
+
+            for index in range(self.workers):
+                threading.Thread(target=self._work, name=f"image-compute-{index}", daemon=True).start()
+
+            self._started = True
+
+
+    def stats(self):
+
+        with self._condition:
+            return {name: lane.stats() for name, lane in self.lanes.items()}
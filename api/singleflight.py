@@ -0,0 +1,250 @@
+# singleflight.py
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .compute import PoolSaturated, ClientSaturated
+
+
+DEFAULT_IMAGE_SINGLE_FLIGHT = {
+    "SHARED_CACHE": None,     # Cache alias shared by all workers, None coalesces within a worker only
+    "LOCK_TIMEOUT": 60,       # Seconds a worker may hold the compute lock of a key
+    "RESULT_TTL": 5,          # Seconds a shared result stays readable for late arrivals
+    "POLL_INTERVAL": 0.05,    # Seconds between checks of the shared cache while waiting
+}
+
+
+# Refusals of the leader's own admission. They say nothing about the computation, so they
+# are not shared: a follower waiting on a refused leader tries again, as the leader if need be
+ADMISSION_ERRORS = (PoolSaturated, ClientSaturated)
+
+
+
+class SingleFlight:
+
+    """
+    Coalesces Identical In-Flight Requests.
+
+    The first request for a key computes the result and every identical request that
+    arrives meanwhile waits on the same future. When a shared cache is configured the
+    key is also locked there, so workers in other processes wait for the result too.
+    Errors of the computation are shared with the waiting requests, ADMISSION_ERRORS are not.
+    """
+
+    def __init__(self, shared_cache, lock_timeout, result_ttl, poll_interval):
+
+        self.shared_cache = shared_cache
+        self.lock_timeout = lock_timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+
+        self._flights = {}
+        self._lock = threading.Lock()
+
+        self.leaders = 0
+        self.coalesced = 0
+        self.shared_hits = 0
+        self.retried = 0
+
+
+    @staticmethod
+    def key(image_id, operation, params):
+
+        """
+        Returns The Key Identifying an Operation On an Image With Normalized Parameters
+        """
+
+        normalized = json.dumps(params, sort_keys=True, separators=(",", ":"))
+        digest = hashlib.sha1(f"{image_id}|{operation}|{normalized}".encode()).hexdigest()
+
+        return f"singleflight:{digest}"
+
+
+    def run(self, key, fn):
+
+        """
+        Returns fn(), Computed Only Once For All Concurrent Callers With The Same Key
+        """
+
+        while True:
+
+            future, leader = self._join(key)
+
+            if leader:
+                break
+
+            try:
+                return future.result()
+            except ADMISSION_ERRORS:
+                self.retried += 1
+
+        try:
+            value = self._run_shared(key, fn)
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+
+        self._finish(key, future, value)
+
+        return value
+
+
+    async def arun(self, key, submit):
+
+        """
+        Async Version of run(). submit() Starts The Work and Returns a concurrent Future
+        """
+
+        while True:
+
+            future, leader = self._join(key)
+
+            if leader:
+                break
+
+            try:
+                return await asyncio.wrap_future(future)
+            except ADMISSION_ERRORS:
+                self.retried += 1
+
+        try:
+            value = await self._arun_shared(key, submit)
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+
+        self._finish(key, future, value)
+
+        return value
+
+
+    def stats(self):
+
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "shared_hits": self.shared_hits,
+            "retried": self.retried,
+            "in_flight": len(self._flights),
+        }
+
+
+    def _join(self, key):
+
+        with self._lock:
+
+            future = self._flights.get(key)
+
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+
+            future = Future()
+            self._flights[key] = future
+            self.leaders += 1
+
+            return future, True
+
+
+    def _finish(self, key, future, value=None, exception=None):
+
+        with self._lock:
+            self._flights.pop(key, None)
+
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(value)
+
+
+    def _cache(self):
+
+        return caches[self.shared_cache] if self.shared_cache else None
+
+
+    def _run_shared(self, key, fn):
+
+        cache = self._cache()
+
+        if cache is None:
+            return fn()
+
+        deadline = time.monotonic() + self.lock_timeout
+
+        while True:
+
+            value = cache.get(f"{key}:result")
+
+            if value is not None:
+                self.shared_hits += 1
+                return value
+
+            if cache.add(f"{key}:lock", 1, timeout=self.lock_timeout):
+
+                try:
+                    value = fn()
+                    cache.set(f"{key}:result", value, timeout=self.result_ttl)
+                    return value
+                finally:
+                    cache.delete(f"{key}:lock")
+
+            # The worker holding the lock took too long, compute it ourselves
+            if time.monotonic() > deadline:
+                return fn()
+
+            time.sleep(self.poll_interval)
+
+
+    async def _arun_shared(self, key, submit):
+
+        cache = self._cache()
+
+        if cache is None:
+            return await asyncio.wrap_future(submit())
+
+        deadline = time.monotonic() + self.lock_timeout
+
+        while True:
+
+            value = await cache.aget(f"{key}:result")
+
+            if value is not None:
+                self.shared_hits += 1
+                return value
+
+            if await cache.aadd(f"{key}:lock", 1, timeout=self.lock_timeout):
+
+                try:
+                    value = await asyncio.wrap_future(submit())
+                    await cache.aset(f"{key}:result", value, timeout=self.result_ttl)
+                    return value
+                finally:
+                    await cache.adelete(f"{key}:lock")
+
+            if time.monotonic() > deadline:
+                return await asyncio.wrap_future(submit())
+
+            await asyncio.sleep(self.poll_interval)
+
+
+
+
+def _build_single_flight():
+
+    config = {**DEFAULT_IMAGE_SINGLE_FLIGHT, **getattr(settings, "IMAGE_SINGLE_FLIGHT", {})}
+
+    return SingleFlight(
+        shared_cache=config["SHARED_CACHE"],
+        lock_timeout=config["LOCK_TIMEOUT"],
+        result_ttl=config["RESULT_TTL"],
+        poll_interval=config["POLL_INTERVAL"],
+    )
+
+
+single_flight = _build_single_flight()
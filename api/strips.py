@@ -0,0 +1,207 @@
+# strips.py
+import os
+import math
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from .memory import memory_ledger
+
+
+DEFAULT_IMAGE_STRIPS = {
+    "THREADS": os.cpu_count() or 1,  # Size of the shared strip pool, 1 disables threading
+    "MIN_PIXELS": 1024 * 1024,       # Images smaller than this run on the calling thread
+    "MIN_ROWS": 32,                  # Fewest rows given to a single strip
+    "BAND_PIXELS": 256 * 1024,       # Pixels per band, keeps kernel temporaries small and cache friendly
+}
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def strips_config():
+
+    try:
+        configured = getattr(settings, "IMAGE_STRIPS", {})
+    except Exception:
+        # Kernels also run in worker processes and benchmarks without Django configured
+        configured = {}
+
+    return {**DEFAULT_IMAGE_STRIPS, **configured}
+
+
+
+def _get_executor(threads):
+
+    global _executor
+
+    if _executor is None:
+
+        with _executor_lock:
+
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="image-strip")
+
+    return _executor
+
+
+
+def split_rows(rows, strips):
+
+    """
+    Splits range(rows) Into At Most `strips` Contiguous (start, stop) Bands
+    """
+
+    strips = max(1, min(strips, rows))
+    step, extra = divmod(rows, strips)
+
+    bands = []
+    start = 0
+
+    for index in range(strips):
+        stop = start + step + (1 if index < extra else 0)
+        bands.append((start, stop))
+        start = stop
+
+    return bands
+
+
+
+def plan_strips(rows, row_pixels, threads=None):
+
+    """
+    Returns The Number of Strips Worth Using For an Image of rows x row_pixels
+    """
+
+    config = strips_config()
+
+    threads = config["THREADS"] if threads is None else threads
+
+    if threads <= 1 or rows * row_pixels < config["MIN_PIXELS"]:
+        return 1
+
+    return max(1, min(threads, rows // config["MIN_ROWS"]))
+
+
+
+def run_strips(fn, rows, row_pixels, threads=None, progress=None, scratch_per_pixel=0):
+
+    """
+    Calls fn(start, stop) For Horizontal Bands Covering range(rows), in Any Order.
+
+    fn writes its band into an output the caller preallocated, so bands never overlap.
+    Stencil kernels read `halo` extra rows around their band themselves. Small images
+    run on the calling thread, large ones on the shared strip pool. The optional progress
+    callback is always called from the calling thread, as bands complete.
+
+    scratch_per_pixel is the memory fn allocates per pixel of its band. It is reserved in
+    api/memory.py for the bands in flight, and when less is granted fewer bands run at
+    once, then smaller ones, down to a single row.
+    """
+
+    config = strips_config()
+
+    strips = plan_strips(rows, row_pixels, threads)
+    band_pixels = config["BAND_PIXELS"]
+
+    with memory_ledger.reserve(
+        min(strips * band_pixels, rows * row_pixels) * scratch_per_pixel,
+        minimum=row_pixels * scratch_per_pixel,
+    ) as reservation:
+
+        if scratch_per_pixel:
+
+            granted_pixels = reservation.nbytes // scratch_per_pixel
+
+            if granted_pixels < strips * band_pixels:
+                strips = max(1, min(strips, granted_pixels // band_pixels))
+                band_pixels = max(row_pixels, min(band_pixels, granted_pixels // strips))
+
+        # Even on one thread, bounded bands keep the temporaries of a kernel small
+        bands = split_rows(rows, max(strips, math.ceil(rows * row_pixels / band_pixels)))
+
+        _run_bands(fn, bands, rows, strips, config, progress)
+
+
+
+def run_tiles(fn, count, tile_pixels, threads=None, progress=None, scratch_per_pixel=0):
+
+    """
+    Calls fn(index) For Every Index in range(count), in Any Order. Used For The Tiles of
+    api/tiles.py, which fn reads and writes itself.
+
+    Up to one tile per thread of the strip pool is in flight. As with run_strips, their
+    scratch memory is reserved first, and fewer run at once when less is granted.
+    """
+
+    config = strips_config()
+
+    threads = config["THREADS"] if threads is None else threads
+    in_flight = max(1, min(threads, count))
+
+    with memory_ledger.reserve(
+        in_flight * tile_pixels * scratch_per_pixel,
+        minimum=tile_pixels * scratch_per_pixel,
+    ) as reservation:
+
+        if scratch_per_pixel:
+            in_flight = max(1, min(in_flight, reservation.nbytes // (tile_pixels * scratch_per_pixel)))
+
+        bands = [(index, index + 1) for index in range(count)]
+
+        _run_bands(lambda start, stop: fn(start), bands, count, in_flight, config, progress)
+
+
+
+def _run_bands(fn, bands, rows, strips, config, progress):
+
+    if strips == 1:
+
+        for start, stop in bands:
+            fn(start, stop)
+            if progress is not None:
+                progress(stop / rows)
+
+        return
+
+    executor = _get_executor(config["THREADS"])
+
+    # At most `strips` bands in flight, their scratch memory is what was reserved
+    pending = iter(bands)
+    futures = {}
+
+    def submit_next():
+        band = next(pending, None)
+        if band is not None:
+            futures[executor.submit(fn, *band)] = band[1] - band[0]
+
+    for _ in range(strips):
+        submit_next()
+
+    done_rows = 0
+
+    try:
+
+        while futures:
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+            for future in done:
+
+                future.result()
+
+                done_rows += futures.pop(future)
+
+                submit_next()
+
+                if progress is not None:
+                    progress(done_rows / rows)
+
+    except BaseException:
+
+        for future in futures:
+            future.cancel()
+
+        raise
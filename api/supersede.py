@@ -0,0 +1,239 @@
+# supersede.py
+import time
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+DEFAULT_IMAGE_LATEST_WINS = {
+    "SHARED_CACHE": None,    # Cache alias shared by all workers, None tracks sequences within a worker only
+    "MAX_SCOPES": 10000,     # Sessions remembered in memory, least recently used are forgotten first
+    "TTL": 60 * 10,          # Seconds a sequence number is kept, in memory and in the shared cache
+    "RESET_GAP": 8,          # A seq this far below the newest one is a restarted client, not a late request
+}
+
+
+
+class Superseded(Exception):
+
+    """
+    Raised When a Newer Request Arrived For The Same Session While This One Was Running
+    """
+
+
+
+class LatestWins:
+
+    """
+    Tracks The Newest Sequence Number Seen Per Session.
+
+    Interactive clients number their requests. A request whose number is lower than the
+    newest one seen for its session is superseded, its result would never be shown, so
+    it is dropped before computing and stopped at the next stage boundary while running.
+
+    A client that starts counting again, after a page reload without a session_id, sends
+    numbers far below the newest one. Those reset the session instead of being dropped,
+    and sessions not heard from for ttl seconds are forgotten. A new session_id is a new
+    session to begin with.
+    """
+
+    def __init__(self, shared_cache, max_scopes, ttl, reset_gap):
+
+        self.shared_cache = shared_cache
+        self.max_scopes = max_scopes
+        self.ttl = ttl
+        self.reset_gap = reset_gap
+
+        # scope -> (seq, monotonic deadline)
+        self._latest = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.dropped = 0
+        self.cancelled = 0
+        self.resets = 0
+
+
+    @staticmethod
+    def scope(image_id, session_id=None):
+
+        return f"latest:{image_id}:{session_id or ''}"
+
+
+    def advance(self, scope, seq):
+
+        """
+        Records seq For The Scope. Returns False if a Newer Request Was Already Seen
+        """
+
+        shared_latest = self._shared_latest(scope)
+
+        with self._lock:
+
+            latest = self._newest(self._local_latest(scope), shared_latest)
+
+            if latest is not None and seq < latest:
+
+                if latest - seq <= self.reset_gap:
+                    self.dropped += 1
+                    return False
+
+                self.resets += 1
+
+            self._latest[scope] = (seq, time.monotonic() + self.ttl)
+            self._latest.move_to_end(scope)
+
+            while len(self._latest) > self.max_scopes:
+                self._latest.popitem(last=False)
+
+        cache = self._cache()
+
+        if cache is not None:
+            cache.set(scope, seq, timeout=self.ttl)
+
+        return True
+
+
+    def is_superseded(self, scope, seq):
+
+        """
+        Returns True if a Newer Request Arrived For The Scope While This One Was Running.
+        After a reset the running requests of the old count are left to finish
+        """
+
+        with self._lock:
+            latest = self._local_latest(scope)
+
+        latest = self._newest(latest, self._shared_latest(scope))
+
+        if latest is not None and latest - self.reset_gap <= seq < latest:
+            self.cancelled += 1
+            return True
+
+        return False
+
+
+    def check(self, scope, seq):
+
+        """
+        Raises Superseded if a Newer Request Arrived For The Scope
+        """
+
+        if self.is_superseded(scope, seq):
+            raise Superseded(f"Request {seq} was superseded")
+
+
+    def guard(self, scope, seq):
+
+        """
+        Returns a Progress Callback That Stops The Kernel Once The Request Is Superseded
+        """
+
+        return SupersededGuard(scope, seq)
+
+
+    def stats(self):
+
+        return {
+            "dropped": self.dropped,
+            "cancelled": self.cancelled,
+            "resets": self.resets,
+            "scopes": len(self._latest),
+        }
+
+
+    def _cache(self):
+
+        return caches[self.shared_cache] if self.shared_cache else None
+
+
+    def _local_latest(self, scope):
+
+        # Called with the lock held
+        entry = self._latest.get(scope)
+
+        if entry is None:
+            return None
+
+        if entry[1] <= time.monotonic():
+            del self._latest[scope]
+            return None
+
+        return entry[0]
+
+
+    def _shared_latest(self, scope):
+
+        cache = self._cache()
+
+        if cache is None:
+            return None
+
+        return cache.get(scope)
+
+
+    @staticmethod
+    def _newest(*seqs):
+
+        return max((seq for seq in seqs if seq is not None), default=None)
+
+
+
+
+class SupersededGuard:
+
+    """
+    Progress Callback Raising Superseded Once a Newer Request Arrived For The Scope.
+
+    Holds only the scope and sequence number and checks the latest_wins of the process it
+    runs in, so it can be pickled to a worker process. There it sees newer requests through
+    the SHARED_CACHE, without one a request is only stopped at the stage boundaries.
+    """
+
+    def __init__(self, scope, seq):
+
+        self.scope = scope
+        self.seq = seq
+
+
+    def __call__(self, fraction=None):
+
+        latest_wins.check(self.scope, self.seq)
+
+
+
+
+def parse_sequence(data, image_id):
+
+    """
+    Returns (scope, seq) When The Request Carries a Sequence Number, Otherwise None
+    """
+
+    seq = data.get("seq", None)
+
+    if seq is None:
+        return None
+
+    try:
+        seq = int(seq)
+    except (TypeError, ValueError):
+        return None
+
+    return LatestWins.scope(image_id, data.get("session_id")), seq
+
+
+
+def _build_latest_wins():
+
+    config = {**DEFAULT_IMAGE_LATEST_WINS, **getattr(settings, "IMAGE_LATEST_WINS", {})}
+
+    return LatestWins(
+        shared_cache=config["SHARED_CACHE"],
+        max_scopes=config["MAX_SCOPES"],
+        ttl=config["TTL"],
+        reset_gap=config["RESET_GAP"],
+    )
+
+
+latest_wins = _build_latest_wins()
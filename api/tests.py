@@ -1,3 +1,1783 @@
-from django.test import TestCase
+import io
+import os
+import importlib
+import time
+import json
+import cProfile
+import pstats
+import tempfile
+import pickle
+import shutil
+import threading
+import base64
+import uuid
+import subprocess
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from asgiref.testing import ApplicationCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.test import TestCase, RequestFactory, override_settings
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from authentication.models import User
+
+from .cost import ImageHeader, probe_base64, admit_upload, admit_operation, estimate, ADMIT, QUEUE, DOWNSCALE, REJECT
+from .compute import ComputePool, ClientSaturated, PoolSaturated, compute_pool
+from .imaging import (
+    GEOMETRY_OPERATIONS,
+    apply_adjustments,
+    apply_adjustments_reference,
+    bl_resize,
+    bl_resize_reference,
+    change_geometry,
+    change_geometry_reference,
+    channel_splitting,
+    channel_splitting_reference,
+    sobel_edge_detection,
+    sobel_edge_detection_reference,
+)
+from .image_store import ImageStore, ImageTooLarge, image_store, image_owner, image_nbytes
+from .memory import MemoryLedger, memory_ledger
+from .metrics import metrics
+from .jobs import JobRunner, job_status
+from .live import live_preview_application, image_pyramid, pyramid_nbytes, sessions as live_sessions
+from .models import ImageJob
+from .operations import OPERATIONS
+from .profiling import profiler
+from .scheduler import PlanScheduler, INTERACTIVE, EXPORT
+from .singleflight import SingleFlight, single_flight
+from .supersede import LatestWins, Superseded, latest_wins, parse_sequence
+from .tiles import TiledImage, run_tiled
+from . import warmup
+
+
+def gray_image(width=10, height=10):
+
+    return Image.new("L", (width, height))
+
+
+
+
+class KernelReferenceTests(TestCase):
+
+    """
+    The Banded Kernels Against Their Reference Implementations, With Bands Small Enough To Cross Boundaries
+    """
+
+    def setUp(self):
+
+        rng = np.random.default_rng(0)
+
+        self.rgb = rng.integers(0, 256, (37, 53, 3), dtype=np.uint8)
+
+        strips = override_settings(IMAGE_STRIPS={"MIN_PIXELS": 0, "MIN_ROWS": 4, "BAND_PIXELS": 256, "THREADS": 3})
+        strips.enable()
+        self.addCleanup(strips.disable)
+
+
+    def test_adjustments(self):
+
+        params = {"brightness": 12, "saturation": 1.3, "gamma": 1.1, "contrast": 1.2}
+
+        img = Image.fromarray(self.rgb)
+
+        np.testing.assert_array_equal(np.asarray(apply_adjustments(img, **params)), np.asarray(apply_adjustments_reference(img, **params)))
+
+
+    def test_resize(self):
+
+        for new_h, new_w in ((20, 30), (74, 106), (37, 1)):
+            np.testing.assert_array_equal(bl_resize(self.rgb, new_h, new_w), bl_resize_reference(self.rgb, new_h, new_w))
+
+
+    def test_geometry(self):
+
+        for change in GEOMETRY_OPERATIONS:
+            np.testing.assert_array_equal(change_geometry(self.rgb, change), change_geometry_reference(self.rgb, change))
+
+
+    def test_edges(self):
+
+        gray = self.rgb[:, :, 0]
+
+        difference = np.abs(
+            np.asarray(sobel_edge_detection(gray), dtype=np.int32) - np.asarray(sobel_edge_detection_reference(gray), dtype=np.int32)
+        )
+
+        # float32 sums in another order can round a pixel the other way
+        self.assertLessEqual(difference.max(), 1)
+
+
+    def test_channel_splitting(self):
+
+        self.assertEqual(channel_splitting(self.rgb), channel_splitting_reference(self.rgb))
+
+
+
+
+class MemoryLedgerTests(TestCase):
+
+    def setUp(self):
+
+        self.ledger = MemoryLedger(budget_bytes=1000, system_fraction=1.0)
+
+
+    def test_reservations_are_given_back(self):
+
+        with self.ledger.reserve(600) as reservation:
+
+            self.assertEqual(reservation.nbytes, 600)
+            self.assertEqual(self.ledger.available(), 400)
+
+        self.assertEqual(self.ledger.available(), 1000)
+        self.assertEqual(self.ledger.stats()["peak_reserved_bytes"], 600)
+
+
+    def test_optional_part_is_cut_to_what_is_left(self):
+
+        with self.ledger.reserve(800):
+
+            with self.ledger.reserve(500, minimum=100) as reservation:
+                self.assertLessEqual(reservation.nbytes, 200)
+                self.assertGreaterEqual(reservation.nbytes, 100)
+
+        self.assertEqual(self.ledger.stats()["degraded"], 1)
+
+
+    def test_minimum_is_granted_over_budget(self):
+
+        with self.ledger.reserve(900):
+
+            with self.ledger.reserve(300) as reservation:
+                self.assertEqual(reservation.nbytes, 300)
+
+        self.assertEqual(self.ledger.stats()["overcommitted"], 1)
+
+
+    def test_operations_record_their_peak(self):
+
+        with self.ledger.operation("resize_image") as account:
+
+            with self.ledger.reserve(300):
+                with self.ledger.reserve(200):
+                    pass
+
+            with self.ledger.reserve(100):
+                pass
+
+        self.assertEqual(account.peak, 500)
+        self.assertEqual(self.ledger.stats()["operations"]["resize_image"]["max_peak_bytes"], 500)
+
+
+    def test_kernels_degrade_to_smaller_bands_with_the_same_result(self):
+
+        rgb = np.random.default_rng(1).integers(0, 256, (64, 48, 3), dtype=np.uint8)
+        img = Image.fromarray(rgb)
+
+        expected = np.asarray(apply_adjustments(img, brightness=20, saturation=1.5))
+
+        strips = override_settings(IMAGE_STRIPS={"MIN_PIXELS": 0, "MIN_ROWS": 4, "BAND_PIXELS": 1024, "THREADS": 4})
+
+        # Barely more than the output buffer, the bands get what is left of it
+        with strips, mock.patch.object(memory_ledger, "budget_bytes", memory_ledger.reserved + rgb.nbytes + 1):
+
+            degraded_before = memory_ledger.stats()["degraded"]
+
+            result = np.asarray(apply_adjustments(img, brightness=20, saturation=1.5))
+
+            self.assertGreater(memory_ledger.stats()["degraded"], degraded_before)
+
+        np.testing.assert_array_equal(result, expected)
+
+
+
+
+class CostAdmissionTests(TestCase):
+
+    def encoded(self, fmt="PNG", size=(40, 30), mode="RGB"):
+
+        buffer = io.BytesIO()
+        Image.new(mode, size).save(buffer, format=fmt)
+
+        return base64.b64encode(buffer.getvalue()).decode()
+
+
+    def test_probe_reads_the_header(self):
+
+        self.assertEqual(probe_base64(self.encoded()), ImageHeader(40, 30, "RGB", "PNG"))
+        self.assertEqual(probe_base64("data:image/jpeg;base64," + self.encoded("JPEG", mode="L")), ImageHeader(40, 30, "L", "JPEG"))
+
+        with self.assertRaises(ValueError):
+            probe_base64(base64.b64encode(b"not an image").decode())
+
+
+    def test_small_upload_is_admitted(self):
+
+        self.assertEqual(admit_upload("anonymous", ImageHeader(4000, 3000, "RGB", "PNG")).action, ADMIT)
+
+
+    def test_upload_over_the_plan_is_rejected_or_downscaled(self):
+
+        header = ImageHeader(6000, 4000, "RGB", "PNG")
+
+        self.assertEqual(admit_upload("anonymous", header).action, REJECT)
+        self.assertEqual(admit_upload("pro", header).action, ADMIT)
+
+        decision = admit_upload("anonymous", header._replace(format="JPEG"))
+
+        self.assertEqual(decision.action, DOWNSCALE)
+        self.assertLessEqual(decision.size[0] * decision.size[1], 12_000_000)
+
+
+    def test_operation_over_the_plan_is_rejected(self):
+
+        original = Image.new("RGB", (2000, 2000))
+
+        self.assertEqual(admit_operation("anonymous", "resize_image", original, {"resize_scale": 4}).action, REJECT)
+        self.assertEqual(admit_operation("anonymous", "resize_image", original, {"resize_scale": 0.5}).action, ADMIT)
+
+
+    def test_long_operation_is_queued_as_a_job(self):
+
+        original = Image.new("RGB", (2000, 2000))
+
+        # 1.6 s per MP, 4 MP is over the 2 s anonymous users may wait for
+        self.assertEqual(admit_operation("anonymous", "channel_analysis", original, {}).action, QUEUE)
+        self.assertEqual(admit_operation("pro", "channel_analysis", original, {}).action, ADMIT)
+
+
+    def test_grayscale_costs_a_third(self):
+
+        rgb = estimate("apply_adjustments", 1_000_000, mode="RGB")
+        gray = estimate("apply_adjustments", 1_000_000, mode="L")
+
+        self.assertAlmostEqual(gray.peak_bytes * 3, rgb.peak_bytes, delta=3)
+
+        # Edges convert to gray whatever the mode
+        self.assertEqual(estimate("edge_detection", 1_000_000, mode="RGB"), estimate("edge_detection", 1_000_000, mode="L"))
+
+
+
+
+class ImageStoreTests(TestCase):
+
+    def setUp(self):
+
+        # Room for three 100 byte images per owner, five overall
+        self.store = ImageStore(ttl=60, max_bytes=500, max_bytes_per_user=300)
+
+
+    def test_counts_bytes_by_mode(self):
+
+        self.assertEqual(image_nbytes(gray_image()), 100)
+        self.assertEqual(image_nbytes(Image.new("RGBA", (10, 10))), 400)
+        self.assertEqual(image_nbytes(Image.new("I;16", (10, 10))), 200)
+
+
+    def test_owner_over_budget_evicts_only_their_own_images(self):
+
+        self.store.set("other", gray_image(), owner="user:2")
+
+        for index in range(4):
+            self.store.set(f"mine:{index}", gray_image(), owner="user:1")
+
+        self.assertIsNone(self.store.get("mine:0"))
+        self.assertIsNotNone(self.store.get("mine:3"))
+        self.assertIsNotNone(self.store.get("other"))
+
+
+    def test_global_budget_evicts_least_recently_used(self):
+
+        for owner in range(5):
+            self.store.set(f"image:{owner}", gray_image(), owner=f"user:{owner}")
+
+        # Touched, so image:1 is now the oldest
+        self.store.get("image:0")
+
+        self.store.set("image:5", gray_image(), owner="user:5")
+
+        self.assertIsNone(self.store.get("image:1"))
+        self.assertIsNotNone(self.store.get("image:0"))
+
+
+    def test_image_larger_than_the_budget_is_refused(self):
+
+        with self.assertRaises(ImageTooLarge):
+            self.store.set("huge", gray_image(20, 20), owner="user:1")
+
+
+    def test_expired_images_are_gone(self):
+
+        store = ImageStore(ttl=0, max_bytes=500, max_bytes_per_user=300)
+
+        store.set("image", gray_image(), owner="user:1")
+
+        self.assertIsNone(store.get("image"))
+        self.assertEqual(store.stats()["expirations"], 1)
+
+
+    def test_anonymous_clients_have_their_own_quota(self):
+
+        factory = RequestFactory()
+
+        heavy = factory.post("/", REMOTE_ADDR="10.0.0.1")
+        other = factory.post("/", REMOTE_ADDR="10.0.0.2")
+
+        heavy.user = other.user = AnonymousUser()
+
+        self.assertNotEqual(image_owner(heavy), image_owner(other))
+
+        self.store.set("other", gray_image(), owner=image_owner(other))
+
+        for index in range(4):
+            self.store.set(f"heavy:{index}", gray_image(), owner=image_owner(heavy))
+
+        self.assertIsNotNone(self.store.get("other"))
+
+
+
+
+class SingleFlightTests(TestCase):
+
+    def setUp(self):
+
+        self.flight = SingleFlight(shared_cache=None, lock_timeout=5, result_ttl=5, poll_interval=0.01)
+
+
+    def follow(self, key, fn, results):
+
+        """
+        Joins The Flight of key From Another Thread Once The Leader Is Running
+        """
+
+        def follower():
+
+            try:
+                results.append(self.flight.run(key, fn))
+            except Exception as e:
+                results.append(e)
+
+        thread = threading.Thread(target=follower)
+        thread.start()
+
+        # Until the follower is waiting on the leader's future
+        while self.flight.stats()["coalesced"] == 0:
+            threading.Event().wait(0.001)
+
+        return thread
+
+
+    def test_identical_requests_compute_once(self):
+
+        calls = []
+        results = []
+
+        def leader_fn():
+            calls.append("leader")
+            self.thread = self.follow("key", lambda: calls.append("follower"), results)
+            return "value"
+
+        self.assertEqual(self.flight.run("key", leader_fn), "value")
+
+        self.thread.join()
+
+        self.assertEqual(results, ["value"])
+        self.assertEqual(calls, ["leader"])
+
+
+
+    def test_computation_errors_are_shared(self):
+
+        results = []
+
+        def leader_fn():
+            self.thread = self.follow("key", lambda: "not computed", results)
+            raise ValueError("kernel failed")
+
+        with self.assertRaises(ValueError):
+            self.flight.run("key", leader_fn)
+
+        self.thread.join()
+
+        self.assertIsInstance(results[0], ValueError)
+
+
+    def test_admission_errors_are_not_shared(self):
+
+        results = []
+
+        def leader_fn():
+            self.thread = self.follow("key", lambda: "computed by the follower", results)
+            raise ClientSaturated("Too many image requests in progress")
+
+        with self.assertRaises(ClientSaturated):
+            self.flight.run("key", leader_fn)
+
+        self.thread.join()
+
+        self.assertEqual(results, ["computed by the follower"])
+        self.assertEqual(self.flight.stats()["retried"], 1)
+        self.assertEqual(self.flight.stats()["in_flight"], 0)
+
+
+
+
+class LatestWinsTests(TestCase):
+
+    def setUp(self):
+
+        self.latest = LatestWins(shared_cache=None, max_scopes=2, ttl=60, reset_gap=8)
+
+
+    def test_older_sequence_is_refused(self):
+
+        self.assertTrue(self.latest.advance("scope", 2))
+        self.assertFalse(self.latest.advance("scope", 1))
+        self.assertTrue(self.latest.advance("scope", 3))
+        self.assertEqual(self.latest.stats()["dropped"], 1)
+
+
+    def test_running_request_is_superseded_by_a_newer_one(self):
+
+        self.latest.advance("scope", 1)
+
+        self.assertFalse(self.latest.is_superseded("scope", 1))
+
+        self.latest.advance("scope", 2)
+
+        with self.assertRaises(Superseded):
+            self.latest.check("scope", 1)
+
+
+    def test_forgets_least_recently_used_scopes(self):
+
+        for scope in ("a", "b", "c"):
+            self.latest.advance(scope, 5)
+
+        # "a" was forgotten, so an older request for it is accepted again
+        self.assertTrue(self.latest.advance("a", 1))
+        self.assertFalse(self.latest.advance("c", 1))
+
+
+    def test_restarted_count_resets_the_scope(self):
+
+        self.latest.advance("scope", 40)
+
+        # Late requests of the same count are still dropped
+        self.assertFalse(self.latest.advance("scope", 32))
+
+        # A reloaded page counts from 1 again
+        self.assertTrue(self.latest.advance("scope", 1))
+        self.assertTrue(self.latest.advance("scope", 2))
+        self.assertFalse(self.latest.advance("scope", 1))
+
+        self.assertEqual(self.latest.stats()["resets"], 1)
+
+        # What still runs from before the reset is left to finish
+        self.assertFalse(self.latest.is_superseded("scope", 40))
+        self.assertTrue(self.latest.is_superseded("scope", 1))
+
+
+    def test_sequences_expire_after_the_ttl(self):
+
+        now = time.monotonic()
+
+        with mock.patch("api.supersede.time.monotonic", return_value=now):
+            self.latest.advance("scope", 5)
+
+        with mock.patch("api.supersede.time.monotonic", return_value=now + 59):
+            self.assertFalse(self.latest.advance("scope", 4))
+
+        with mock.patch("api.supersede.time.monotonic", return_value=now + 61):
+            self.assertFalse(self.latest.is_superseded("scope", 4))
+            self.assertTrue(self.latest.advance("scope", 4))
+
+
+    def test_shared_cache_sees_other_workers(self):
+
+        caches["default"].clear()
+
+        workers = [LatestWins(shared_cache="default", max_scopes=10, ttl=60, reset_gap=8) for _ in range(2)]
+
+        workers[0].advance("shared-scope", 5)
+
+        self.assertFalse(workers[1].advance("shared-scope", 4))
+        self.assertTrue(workers[1].advance("shared-scope", 6))
+        self.assertTrue(workers[0].is_superseded("shared-scope", 5))
+
+
+    def test_guard_survives_pickling(self):
+
+        scope = LatestWins.scope("guarded-image", "session")
+
+        latest_wins.advance(scope, 1)
+
+        guard = pickle.loads(pickle.dumps(latest_wins.guard(scope, 1)))
+
+        guard(0.5)
+
+        latest_wins.advance(scope, 2)
+
+        with self.assertRaises(Superseded):
+            guard(0.5)
+
+
+    def test_parse_sequence(self):
+
+        self.assertIsNone(parse_sequence({}, "image"))
+        self.assertIsNone(parse_sequence({"seq": "soon"}, "image"))
+        self.assertEqual(parse_sequence({"seq": "3", "session_id": "tab"}, "image"), ("latest:image:tab", 3))
+
+
+
+
+class LatestWinsEndpointTests(TestCase):
+
+    def setUp(self):
+
+        for cache in caches.all():
+            cache.clear()
+
+        image_store.clear()
+
+        self.client = APIClient()
+
+
+    def upload(self, size=(64, 48), mode="RGB"):
+
+        buffer = io.BytesIO()
+        Image.new(mode, size, "red" if mode == "RGB" else 128).save(buffer, format="PNG")
+
+        response = self.client.post("/api/upload_image", {"image_base64": base64.b64encode(buffer.getvalue()).decode()}, format="json")
+
+        self.assertEqual(response.status_code, 201)
+
+        return response.json()["image_id"]
+
+
+    def test_sequenced_adjustments_run_under_the_process_executor(self):
+
+        pool = ComputePool(executor="process", workers=1, max_queue_depth=4, max_in_flight_per_client=4, retry_after=1)
+
+        image_id = self.upload()
+
+        with mock.patch("api.views.compute_pool", pool):
+            response = self.client.post("/api/apply_adjustments", {"image_id": image_id, "brightness": 10, "seq": 1}, format="json")
+
+        pool._executor.shutdown()
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertIn("image", response.json())
+
+
+    def test_older_sequence_is_dropped(self):
+
+        image_id = self.upload()
+
+        response = self.client.post("/api/apply_adjustments", {"image_id": image_id, "seq": 2}, format="json")
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post("/api/apply_adjustments", {"image_id": image_id, "seq": 1}, format="json")
+        self.assertEqual(response.status_code, 409)
+
+
+    def test_reloaded_page_is_served_again(self):
+
+        image_id = self.upload()
+
+        for seq in (29, 30):
+            self.assertEqual(self.client.post("/api/apply_adjustments", {"image_id": image_id, "seq": seq}, format="json").status_code, 200)
+
+        # Without a session_id the reloaded page counts from 1 in the same scope
+        for seq in (1, 2):
+            self.assertEqual(self.client.post("/api/apply_adjustments", {"image_id": image_id, "seq": seq}, format="json").status_code, 200)
+
+        # With one, a new session starts from nothing
+        self.assertEqual(self.client.post("/api/apply_adjustments", {"image_id": image_id, "seq": 30, "session_id": "tab-1"}, format="json").status_code, 200)
+        self.assertEqual(self.client.post("/api/apply_adjustments", {"image_id": image_id, "seq": 29, "session_id": "tab-2"}, format="json").status_code, 200)
+
+
+    def test_async_request_superseded_while_computing_stops(self):
+
+        image_id = self.upload()
+
+        def compute(name, original_img, params, progress=None):
+
+            # A newer slider move arrives while the kernel runs
+            latest_wins.advance(LatestWins.scope(image_id), 2)
+            progress(0.5)
+
+            self.fail("The kernel ran on after being superseded")
+
+        with mock.patch("api.async_views.compute_operation", compute):
+            response = self.client.post("/api/async/apply_adjustments", {"image_id": image_id, "seq": 1}, format="json")
+
+        self.assertEqual(response.status_code, 409)
+
+
+
+
+class RateLimitEndpointTests(TestCase):
+
+    def setUp(self):
+
+        for cache in caches.all():
+            cache.clear()
+
+        # Mid-window, the limiter counts in windows of the wall clock. The cache expires entries by the same clock
+        clock = mock.patch("authentication.ratelimit.time.time", return_value=time.time() // 3600 * 3600 + 30)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+        image_store.clear()
+
+        self.client = APIClient()
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (16, 16), "red").save(buffer, format="PNG")
+
+        response = self.client.post("/api/upload_image", {"image_base64": base64.b64encode(buffer.getvalue()).decode()}, format="json")
+
+        self.image_id = response.json()["image_id"]
+
+
+    def test_anonymous_slider_moves_are_not_held_to_the_default_rate(self):
+
+        for seq in range(1, 61):
+
+            response = self.client.post("/api/apply_adjustments", {"image_id": self.image_id, "brightness": seq, "seq": seq}, format="json")
+
+            self.assertEqual(response.status_code, 200, f"slider move {seq}")
+
+        response = self.client.post("/api/async/apply_adjustments", {"image_id": self.image_id, "seq": 61}, format="json")
+
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_other_operations_keep_the_default_rate(self):
+
+        # The upload was the first of the 30 anonymous requests a minute
+        statuses = [
+            self.client.post("/api/resize_image", {"image_id": self.image_id, "resize_scale": 0.5}, format="json").status_code
+            for _ in range(30)
+        ]
+
+        self.assertEqual(statuses.count(200), 29)
+        self.assertEqual(statuses[-1], 429)
+
+        response = self.client.post("/api/resize_image", {"image_id": self.image_id, "resize_scale": 0.5}, format="json")
+
+        # 30 s to the next window, then 2 s for the weight of this one to fall under 29 of 30
+        self.assertEqual(response["Retry-After"], "32")
+
+
+
+
+def lane(weight=1, max_concurrency=None, megapixels_per_second=None):
+
+    return {"WEIGHT": weight, "MAX_CONCURRENCY": max_concurrency, "MEGAPIXELS_PER_SECOND": megapixels_per_second}
+
+
+
+
+class ImageOperationEndpointTests(TestCase):
+
+    OPERATIONS = [
+        ("apply_adjustments", {"brightness": 20, "contrast": 10}, "image"),
+        ("resize_image", {"resize_scale": 0.5}, "image"),
+        ("modify_geometry", {"change_to_be_made": ["r", "vf"]}, "image"),
+        ("edge_detection", {}, "image"),
+        ("channel_analysis", {}, "contributions"),
+    ]
+
+    def setUp(self):
+
+        for cache in caches.all():
+            cache.clear()
+
+        image_store.clear()
+
+        self.client = APIClient()
+
+
+    def upload(self, path="/api/upload_image", size=(64, 48)):
+
+        buffer = io.BytesIO()
+        Image.new("RGB", size, "red").save(buffer, format="PNG")
+
+        response = self.client.post(path, {"image_base64": base64.b64encode(buffer.getvalue()).decode()}, format="json")
+
+        self.assertEqual(response.status_code, 201, response.content)
+
+        return response.json()["image_id"]
+
+
+    def test_upload_requires_a_valid_image(self):
+
+        self.assertEqual(self.client.post("/api/upload_image", {}, format="json").status_code, 400)
+        self.assertEqual(self.client.post("/api/upload_image", {"image_base64": "bm90IGFuIGltYWdl"}, format="json").status_code, 400)
+
+
+    def test_every_operation_runs(self):
+
+        image_id = self.upload()
+
+        for prefix in ("/api/", "/api/async/"):
+
+            for name, params, key in self.OPERATIONS:
+
+                with self.subTest(path=prefix + name):
+
+                    response = self.client.post(prefix + name, {"image_id": image_id, **params}, format="json")
+
+                    self.assertEqual(response.status_code, 200, response.content)
+                    self.assertIn(key, response.json())
+
+
+    def test_async_upload_is_served_to_sync_views(self):
+
+        image_id = self.upload("/api/async/upload_image")
+
+        response = self.client.post("/api/resize_image", {"image_id": image_id, "resize_scale": 0.5}, format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json()["new_image_w"], response.json()["new_image_h"]), (32, 24))
+
+
+    def test_missing_or_invalid_parameters_are_rejected(self):
+
+        image_id = self.upload()
+
+        for prefix in ("/api/", "/api/async/"):
+
+            with self.subTest(prefix=prefix):
+
+                self.assertEqual(self.client.post(prefix + "edge_detection", {}, format="json").status_code, 400)
+                self.assertEqual(self.client.post(prefix + "resize_image", {"image_id": image_id}, format="json").status_code, 400)
+                self.assertEqual(self.client.post(prefix + "modify_geometry", {"image_id": image_id, "change_to_be_made": ["spin"]}, format="json").status_code, 400)
+                self.assertEqual(self.client.post(prefix + "apply_adjustments", {"image_id": image_id, "gamma": "bright"}, format="json").status_code, 400)
+                self.assertEqual(self.client.post(prefix + "apply_adjustments", {"image_id": image_id, "gamma": 0}, format="json").status_code, 400)
+                self.assertEqual(self.client.post(prefix + "apply_adjustments", {"image_id": image_id, "contrast": "nan"}, format="json").status_code, 400)
+
+
+    def test_unknown_image_is_not_found(self):
+
+        for prefix in ("/api/", "/api/async/"):
+            self.assertEqual(self.client.post(prefix + "edge_detection", {"image_id": "missing"}, format="json").status_code, 404)
+
+
+    def test_job_mode_runs_in_the_background(self):
+
+        image_id = self.upload()
+
+        class InlineExecutor:
+
+            def submit(self, fn, *args):
+                fn(*args)
+
+        # Both the job thread and the compute pool run inline, the test database is not shared across threads
+        inline = mock.patch.multiple(
+            "api.jobs.job_runner",
+            _get_executor=mock.Mock(return_value=InlineExecutor()),
+            _compute=lambda schedule, fn, *args: fn(*args),
+        )
+
+        with inline:
+            response = self.client.post("/api/edge_detection", {"image_id": image_id, "mode": "job"}, format="json")
+
+        self.assertEqual(response.status_code, 202, response.content)
+
+        status_response = self.client.get(response.json()["status_url"])
+
+        self.assertEqual(status_response.status_code, 200)
+        self.assertEqual(status_response.json()["status"], "done")
+        self.assertIn("image", status_response.json()["result"])
+
+
+    def test_jobs_of_other_users_are_not_found(self):
+
+        owner = User.objects.create_user(username="owner", email="owner@example.com", password="password")
+
+        job = ImageJob.objects.create(user=owner, operation="edge_detection")
+
+        self.assertEqual(self.client.get(f"/api/jobs/{job.pk}").status_code, 404)
+
+        self.client.cookies["access"] = str(AccessToken.for_user(owner))
+
+        self.assertEqual(self.client.get(f"/api/jobs/{job.pk}").status_code, 200)
+
+
+    def test_identical_concurrent_requests_share_one_computation(self):
+
+        image_id = self.upload()
+
+        calls = []
+        release = threading.Event()
+
+        def compute(name, original_img, params, progress=None):
+
+            calls.append(name)
+            release.wait(5)
+
+            return {"image": original_img}
+
+        def post():
+            responses.append(APIClient().post("/api/edge_detection", {"image_id": image_id}, format="json"))
+
+        responses = []
+        coalesced = single_flight.stats()["coalesced"]
+
+        with mock.patch("api.operations.compute_operation", compute):
+
+            threads = [threading.Thread(target=post) for _ in range(3)]
+
+            for thread in threads:
+                thread.start()
+
+            # Let the followers find the leader before it finishes
+            while single_flight.stats()["coalesced"] < coalesced + 2 and all(thread.is_alive() for thread in threads):
+                threading.Event().wait(0.01)
+
+            release.set()
+
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([response.status_code for response in responses], [200, 200, 200])
+        self.assertEqual(calls, ["edge_detection"])
+
+
+
+
+class JobRunnerTests(TestCase):
+
+    class HeldExecutor:
+
+        """
+        Keeps Submitted Jobs Without Running Them, Until run_all()
+        """
+
+        def __init__(self):
+            self.queue = []
+
+        def submit(self, fn, *args):
+            self.queue.append((fn, args))
+
+        def run_all(self):
+            while self.queue:
+                fn, args = self.queue.pop(0)
+                fn(*args)
+
+
+    def setUp(self):
+
+        self.executor = self.HeldExecutor()
+
+        self.runner = JobRunner(workers=1, progress_interval=0, result_ttl=60, max_pending=3, max_pending_per_client=2)
+        self.runner._executor = self.executor
+
+        # The compute pool runs inline, the test database is not shared across threads
+        self.runner._compute = lambda schedule, fn, *args: fn(*args)
+
+        self.image = Image.new("RGB", (16, 12), "red")
+
+
+    def test_submitted_job_runs_to_its_result(self):
+
+        job = self.runner.submit("edge_detection", self.image, {}, client="a")
+
+        self.assertEqual(ImageJob.objects.get(pk=job.pk).status, ImageJob.STATUS_QUEUED)
+        self.assertEqual(self.runner.pending(), 1)
+
+        self.executor.run_all()
+
+        job.refresh_from_db()
+
+        self.assertEqual(job.status, ImageJob.STATUS_DONE)
+        self.assertEqual(job.progress, 1.0)
+        self.assertEqual(job.worker, self.runner.worker_id)
+        self.assertIn("image", job_status(job)["result"])
+        self.assertNotIn("result", job_status(job, include_result=False))
+        self.assertEqual(self.runner.pending(), 0)
+
+
+    def test_failed_job_keeps_its_error(self):
+
+        with mock.patch("api.jobs.run_operation", side_effect=RuntimeError("kernel exploded")):
+
+            job = self.runner.submit("edge_detection", self.image, {}, client="a")
+
+            with self.assertLogs("api.jobs", "ERROR"):
+                self.executor.run_all()
+
+        job.refresh_from_db()
+
+        self.assertEqual((job_status(job)["status"], job_status(job)["error"]), ("failed", "kernel exploded"))
+        self.assertNotIn("result", job_status(job))
+        self.assertEqual(self.runner.pending(), 0)
+
+
+    def test_pending_jobs_are_capped(self):
+
+        self.runner.submit("edge_detection", self.image, {}, client="a")
+        self.runner.submit("edge_detection", self.image, {}, client="a")
+
+        with self.assertRaises(ClientSaturated):
+            self.runner.submit("edge_detection", self.image, {}, client="a")
+
+        self.runner.submit("edge_detection", self.image, {}, client="b")
+
+        with self.assertRaises(PoolSaturated):
+            self.runner.submit("edge_detection", self.image, {}, client="c")
+
+        # Refused jobs never reach the table
+        self.assertEqual(ImageJob.objects.count(), 3)
+
+        self.executor.run_all()
+
+        self.runner.submit("edge_detection", self.image, {}, client="a")
+
+
+    def test_job_mode_answers_429_past_the_client_cap(self):
+
+        client = APIClient()
+
+        buffer = io.BytesIO()
+        self.image.save(buffer, format="PNG")
+
+        image_id = client.post("/api/upload_image", {"image_base64": base64.b64encode(buffer.getvalue()).decode()}, format="json").json()["image_id"]
+
+        with mock.patch("api.views.job_runner", self.runner), mock.patch("api.async_views.job_runner", self.runner):
+
+            for path in ("/api/edge_detection", "/api/async/edge_detection"):
+                self.assertEqual(client.post(path, {"image_id": image_id, "mode": "job"}, format="json").status_code, 202)
+
+            response = client.post("/api/edge_detection", {"image_id": image_id, "mode": "job"}, format="json")
+
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+
+
+    def test_jobs_of_dead_workers_are_failed_once(self):
+
+        hostname = self.runner.worker_id.split(":")[0]
+
+        dead = subprocess.Popen(["true"])
+        dead.wait()
+
+        jobs = {
+            "dead": ImageJob.objects.create(operation="edge_detection", worker=f"{hostname}:{dead.pid}"),
+            "alive": ImageJob.objects.create(operation="edge_detection", worker=f"{hostname}:{os.getppid()}", status=ImageJob.STATUS_RUNNING),
+            "other host": ImageJob.objects.create(operation="edge_detection", worker=f"elsewhere:{dead.pid}"),
+            "previous self": ImageJob.objects.create(operation="edge_detection", worker=self.runner.worker_id),
+            "done": ImageJob.objects.create(operation="edge_detection", worker=f"{hostname}:{dead.pid}", status=ImageJob.STATUS_DONE),
+        }
+
+        ImageJob.objects.filter(pk=jobs["previous self"].pk).update(created_at=timezone.now() - timedelta(days=1))
+
+        with self.assertLogs("api.jobs", "WARNING"):
+            self.runner.recover()
+
+        statuses = {name: ImageJob.objects.get(pk=job.pk).status for name, job in jobs.items()}
+
+        self.assertEqual(statuses, {
+            "dead": "failed",
+            "alive": "running",
+            "other host": "queued",
+            "previous self": "failed",
+            "done": "done",
+        })
+
+        ImageJob.objects.filter(pk=jobs["alive"].pk).update(worker=f"{hostname}:{dead.pid}")
+
+        # Only at startup, later on the runner's own bookkeeping is trusted
+        self.runner.recover()
+
+        self.assertEqual(ImageJob.objects.get(pk=jobs["alive"].pk).status, "running")
+
+
+    def test_finished_jobs_expire_after_the_result_ttl(self):
+
+        expired = ImageJob.objects.create(operation="edge_detection", status=ImageJob.STATUS_DONE)
+        failed = ImageJob.objects.create(operation="edge_detection", status=ImageJob.STATUS_FAILED)
+        fresh = ImageJob.objects.create(operation="edge_detection", status=ImageJob.STATUS_DONE)
+        running = ImageJob.objects.create(operation="edge_detection", status=ImageJob.STATUS_RUNNING)
+
+        ImageJob.objects.filter(pk__in=[expired.pk, failed.pk, running.pk]).update(updated_at=timezone.now() - timedelta(seconds=61))
+
+        self.runner.prune()
+
+        self.assertEqual(set(ImageJob.objects.values_list("pk", flat=True)), {fresh.pk, running.pk})
+
+        response = self.client.get(f"/api/jobs/{expired.pk}")
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get(f"/api/jobs/{fresh.pk}").json()["status"], "done")
+
+
+
+
+class JobEventsTests(TestCase):
+
+    def events(self, response):
+
+        return [chunk.decode() if isinstance(chunk, bytes) else chunk for chunk in response.streaming_content]
+
+
+    def test_finished_job_streams_its_result(self):
+
+        job = ImageJob.objects.create(operation="edge_detection", status=ImageJob.STATUS_DONE, progress=1.0, result={"image": "data"})
+
+        events = self.events(self.client.get(f"/api/jobs/{job.pk}/events"))
+
+        self.assertEqual(len(events), 1)
+        self.assertTrue(events[0].startswith("event: done\n"))
+        self.assertIn('"result": {"image": "data"}', events[0])
+
+
+    @override_settings(IMAGE_JOBS={"EVENTS_POLL_INTERVAL": 0.01, "EVENTS_TIMEOUT": 0.05})
+    def test_running_job_streams_progress_until_timeout(self):
+
+        job = ImageJob.objects.create(operation="edge_detection", status=ImageJob.STATUS_RUNNING, progress=0.5)
+
+        events = self.events(self.client.get(f"/api/jobs/{job.pk}/events"))
+
+        # Progress is only sent again when it changes
+        self.assertEqual([event.split("\n")[0] for event in events], ["event: progress", "event: timeout"])
+
+
+    @override_settings(IMAGE_JOBS={"EVENTS_POLL_INTERVAL": 0.01, "EVENTS_TIMEOUT": 0.05})
+    async def test_asgi_requests_stream_without_a_sync_thread(self):
+
+        job = await ImageJob.objects.acreate(operation="edge_detection", status=ImageJob.STATUS_RUNNING, progress=0.5)
+
+        with mock.patch("api.views.time.sleep", side_effect=AssertionError("Slept on a sync thread")):
+
+            response = await self.async_client.get(f"/api/jobs/{job.pk}/events")
+
+            self.assertTrue(response.is_async)
+
+            events = [chunk.decode() async for chunk in response.streaming_content]
+
+        self.assertEqual([event.split("\n")[0] for event in events], ["event: progress", "event: timeout"])
+
+
+    def test_unknown_job_is_not_found(self):
+
+        self.assertEqual(self.client.get(f"/api/jobs/{uuid.uuid4()}/events").status_code, 404)
+
+
+
+
+class LivePreviewTests(TestCase):
+
+    def setUp(self):
+
+        image_store.clear()
+
+        self.image_id = "live-image"
+        image_store.set(f"original:{self.image_id}", Image.new("RGB", (300, 200), "red"), owner="ip:10.0.0.1")
+
+
+    async def connect(self, image_id=None, headers=()):
+
+        scope = {
+            "type": "websocket",
+            "path": "/api/live",
+            "query_string": f"image_id={image_id or self.image_id}".encode(),
+            "headers": list(headers),
+            "client": ("10.0.0.1", 50000),
+        }
+
+        communicator = ApplicationCommunicator(live_preview_application, scope)
+        await communicator.send_input({"type": "websocket.connect"})
+
+        return communicator
+
+
+    async def accept(self, communicator):
+
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.accept"})
+
+        return json.loads((await communicator.receive_output())["text"])
+
+
+    async def send(self, communicator, data):
+
+        await communicator.send_input({"type": "websocket.receive", "text": json.dumps(data)})
+
+
+    async def receive_json(self, communicator):
+
+        return json.loads((await communicator.receive_output(timeout=5))["text"])
+
+
+    async def close(self, communicator):
+
+        await communicator.send_input({"type": "websocket.disconnect", "code": 1000})
+        await communicator.wait(timeout=5)
+
+
+    async def test_unknown_image_is_refused(self):
+
+        communicator = await self.connect(image_id="missing")
+
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4404})
+
+
+    async def test_invalid_token_is_refused(self):
+
+        communicator = await self.connect(headers=[(b"cookie", b"access=not-a-token")])
+
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4401})
+
+
+    async def test_newest_parameters_are_rendered(self):
+
+        communicator = await self.connect()
+
+        self.assertEqual((await self.accept(communicator))["levels"], [[200, 300], [100, 150]])
+
+        await self.send(communicator, {"seq": 1, "brightness": 10, "max_size": 150})
+
+        header = await self.receive_json(communicator)
+        frame = await communicator.receive_output(timeout=5)
+
+        self.assertEqual(header, {"seq": 1, "width": 150, "height": 100, "format": "jpeg"})
+        self.assertEqual(Image.open(io.BytesIO(frame["bytes"])).size, (150, 100))
+
+        await self.close(communicator)
+
+
+    async def test_invalid_parameters_keep_the_session(self):
+
+        communicator = await self.connect()
+        await self.accept(communicator)
+
+        await self.send(communicator, {"seq": 1, "gamma": 0})
+
+        self.assertEqual(await self.receive_json(communicator), {"seq": 1, "error": "gamma must be positive"})
+
+        await self.send(communicator, {"seq": 2, "gamma": 2})
+
+        self.assertEqual((await self.receive_json(communicator))["seq"], 2)
+        self.assertIn("bytes", await communicator.receive_output(timeout=5))
+
+        await self.close(communicator)
+
+
+    async def test_anonymous_sessions_are_counted_per_ip(self):
+
+        with mock.patch.object(compute_pool, "submit", wraps=compute_pool.submit) as submit:
+
+            first = await self.connect()
+            await self.accept(first)
+
+        # The pyramid is built on the compute pool, as the client's work
+        self.assertIs(submit.call_args.args[0], image_pyramid)
+        self.assertEqual(submit.call_args.kwargs["client"], "ip:10.0.0.1")
+
+        second = await self.connect()
+        await self.accept(second)
+
+        third = await self.connect()
+        self.assertEqual(await third.receive_output(), {"type": "websocket.close", "code": 4429})
+
+        # Behind a proxy, like on the HTTP endpoints
+        other = await self.connect(headers=[(b"x-forwarded-for", b"10.0.0.2, 10.0.0.1")])
+        await self.accept(other)
+
+        self.assertEqual(live_sessions.count("ip:10.0.0.1"), 2)
+
+        for communicator in (first, second, other):
+            await self.close(communicator)
+
+        self.assertEqual(live_sessions.count("ip:10.0.0.1"), 0)
+
+
+    async def test_foreign_origins_are_refused(self):
+
+        communicator = await self.connect(headers=[(b"origin", b"https://evil.example")])
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4403})
+
+        for headers in ([(b"origin", b"http://localhost:5173")], [(b"origin", b"https://images.example"), (b"host", b"images.example")]):
+
+            communicator = await self.connect(headers=headers)
+            await self.accept(communicator)
+            await self.close(communicator)
+
+
+    async def test_pinned_pyramid_is_reserved_in_the_memory_ledger(self):
+
+        reserved = memory_ledger.reserved
+        nbytes = pyramid_nbytes(Image.new("RGB", (300, 200)))
+
+        self.assertGreaterEqual(nbytes, 300 * 200 * 3 + 150 * 100 * 3)
+
+        communicator = await self.connect()
+        await self.accept(communicator)
+
+        self.assertEqual(memory_ledger.reserved, reserved + nbytes)
+
+        with mock.patch.object(memory_ledger, "budget_bytes", memory_ledger.reserved + nbytes - 1):
+
+            refused = await self.connect()
+            self.assertEqual(await refused.receive_output(), {"type": "websocket.close", "code": 4503})
+
+        await self.close(communicator)
+
+        self.assertEqual(memory_ledger.reserved, reserved)
+
+
+    async def test_failed_frame_keeps_the_render_loop(self):
+
+        communicator = await self.connect()
+        await self.accept(communicator)
+
+        with mock.patch("api.live.render_preview", side_effect=[ZeroDivisionError("float division by zero"), (b"frame", 150, 100)]):
+
+            with self.assertLogs("api.live", "ERROR"):
+
+                await self.send(communicator, {"seq": 1})
+
+                self.assertEqual(await self.receive_json(communicator), {"seq": 1, "error": "float division by zero"})
+
+            await self.send(communicator, {"seq": 2})
+
+            self.assertEqual((await self.receive_json(communicator))["seq"], 2)
+            self.assertEqual((await communicator.receive_output(timeout=5))["bytes"], b"frame")
+
+        await self.close(communicator)
+
+
+
+
+class TiledProcessingTests(TestCase):
+
+    MODES = ["L", "LA", "RGB", "RGBA", "I;16"]
+
+    CASES = [
+        ("apply_adjustments", {"brightness": 12, "contrast": 1.2, "saturation": 1.3, "gamma": 0.8}),
+        ("resize_image", {"resize_scale": 0.37}),
+        ("resize_image", {"resize_scale": 1.6}),
+        ("modify_geometry", {"change_to_be_made": ["r", "vf", "hf"]}),
+        ("edge_detection", {}),
+    ]
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.rng = np.random.default_rng(3)
+
+
+    def image(self, mode, size=(251, 203)):
+
+        if mode == "I;16":
+            return Image.fromarray(self.rng.integers(0, 65536, size, dtype=np.uint16))
+
+        channels = {"L": (), "LA": (2,), "RGB": (3,), "RGBA": (4,)}[mode]
+
+        return Image.fromarray(self.rng.integers(0, 256, size + channels, dtype=np.uint8), mode=mode)
+
+
+    def formats(self, result):
+
+        # PGM holds one channel, PPM three, PNG and .npy every mode
+        netpbm = {"L": [".pgm"], "I;16": [".pgm"], "RGB": [".ppm"]}.get(result.mode, [])
+
+        return [".png", ".npy"] + netpbm
+
+
+    def test_tiles_match_the_in_memory_kernels_and_round_trip(self):
+
+        for mode in self.MODES:
+
+            img = self.image(mode)
+
+            for name, params in self.CASES:
+
+                with self.subTest(mode=mode, operation=name, params=params):
+
+                    expected = np.asarray(OPERATIONS[name].compute(img, params)["image"])
+
+                    # An odd tile size, so no tile boundary falls on a halving of the image
+                    with TiledImage.from_image(img, self.directory) as src, run_tiled(name, src, params, tile_size=97, directory=self.directory) as result:
+
+                        np.testing.assert_array_equal(np.asarray(result.array), expected)
+
+                        for extension in self.formats(result):
+
+                            path = os.path.join(self.directory, f"result{extension}")
+                            result.save(path)
+
+                            # PNG is read back by PIL, .npy and PGM/PPM are mapped
+                            with TiledImage.open(path, self.directory) as reloaded:
+                                self.assertEqual(reloaded.mode, result.mode, extension)
+                                np.testing.assert_array_equal(np.asarray(reloaded.array), expected, extension)
+
+                            os.remove(path)
+
+        # Every temporary image was deleted on close
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+    def test_formats_that_cannot_hold_the_mode_are_refused(self):
+
+        with TiledImage.from_image(self.image("RGBA"), self.directory) as src:
+
+            with self.assertRaises(ValueError):
+                src.save(os.path.join(self.directory, "result.ppm"))
+
+            with self.assertRaises(ValueError):
+                src.save(os.path.join(self.directory, "result.tiff"))
+
+
+    def test_command_streams_a_file(self):
+
+        source = os.path.join(self.directory, "source.png")
+        output = os.path.join(self.directory, "output.png")
+
+        img = self.image("RGB")
+        img.save(source)
+
+        call_command("process_tiled", source, output, operation="resize_image", params='{"resize_scale": 0.5}', tile_size=97, stdout=io.StringIO())
+
+        expected = np.asarray(OPERATIONS["resize_image"].compute(img, {"resize_scale": 0.5})["image"])
+
+        with Image.open(output) as written:
+            np.testing.assert_array_equal(np.asarray(written), expected)
+
+
+
+
+class PlanSchedulerTests(TestCase):
+
+    def scheduler(self, lanes, workers=1):
+
+        return PlanScheduler(workers=workers, lanes=lanes, default_lane="", burst_seconds=2, min_cost=0.05)
+
+
+    def hold(self, scheduler, plan="gate"):
+
+        """
+        Occupies a Worker Until The Returned Event Is Set
+        """
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def task():
+            started.set()
+            release.wait(5)
+
+        scheduler.submit(task, plan=plan)
+        started.wait(5)
+
+        return release
+
+
+    def test_lanes_share_the_workers_by_weight(self):
+
+        scheduler = self.scheduler({"": lane(), "gate": lane(), "heavy": lane(weight=3), "light": lane()})
+
+        release = self.hold(scheduler)
+
+        order = []
+        futures = [
+            scheduler.submit(order.append, plan, plan=plan, pixels=1_000_000)
+            for _ in range(8)
+            for plan in ("heavy", "light")
+        ]
+
+        release.set()
+
+        for future in futures:
+            future.result(5)
+
+        self.assertGreaterEqual(order[:8].count("heavy"), 5)
+        self.assertEqual(len(order), 16)
+
+
+    def test_interactive_work_goes_before_export_work(self):
+
+        scheduler = self.scheduler({"": lane()})
+
+        release = self.hold(scheduler, plan="")
+
+        order = []
+        export = scheduler.submit(order.append, "export", priority=EXPORT)
+        interactive = scheduler.submit(order.append, "interactive", priority=INTERACTIVE)
+
+        release.set()
+
+        export.result(5)
+        interactive.result(5)
+
+        self.assertEqual(order, ["interactive", "export"])
+
+
+    def test_capped_lane_borrows_idle_workers(self):
+
+        scheduler = self.scheduler({"": lane(), "capped": lane(max_concurrency=1)}, workers=2)
+
+        first = self.hold(scheduler, plan="capped")
+
+        # Nothing else waits, so the second worker takes the capped lane's next task
+        second = scheduler.submit(lambda: "ran", plan="capped")
+
+        self.assertEqual(second.result(5), "ran")
+
+        first.set()
+
+
+    def test_capped_lane_waits_while_other_lanes_have_work(self):
+
+        scheduler = self.scheduler({"": lane(), "capped": lane(max_concurrency=1), "other": lane()}, workers=2)
+
+        capped = self.hold(scheduler, plan="capped")
+        other = self.hold(scheduler, plan="other")
+
+        order = []
+        futures = [
+            scheduler.submit(order.append, "capped", plan="capped"),
+            scheduler.submit(order.append, "other", plan="other"),
+        ]
+
+        # The worker freed by "other" goes to the lane within its cap first, then it may borrow
+        other.set()
+        futures[1].result(5)
+        futures[0].result(5)
+
+        self.assertEqual(order, ["other", "capped"])
+
+        capped.set()
+
+
+
+
+class ComputePoolTests(TestCase):
+
+    def test_a_capped_lane_backlog_does_not_saturate_other_plans(self):
+
+        pool = ComputePool(executor="thread", workers=1, max_queue_depth=4, max_in_flight_per_client=4, retry_after=1)
+
+        release = threading.Event()
+        admitted = []
+
+        # One worker and one queue place for the anonymous lane, a third request is refused
+        with self.assertRaises(PoolSaturated):
+            for index in range(3):
+                admitted.append(pool.submit(release.wait, 5, client=f"ip:{index}", plan="anonymous"))
+
+        self.assertEqual(len(admitted), 2)
+
+        pro = pool.submit(lambda: "pro", client="user:1", plan="pro")
+
+        release.set()
+
+        self.assertEqual(pro.result(5), "pro")
+
+        for future in admitted:
+            future.result(5)
+
+        self.assertEqual(pool.stats()["lanes"]["anonymous"]["in_flight"], 0)
+
+
+    def test_client_over_its_limit_is_refused(self):
+
+        pool = ComputePool(executor="thread", workers=1, max_queue_depth=32, max_in_flight_per_client=1, retry_after=1)
+
+        release = threading.Event()
+
+        future = pool.submit(release.wait, 5, client="ip:1", plan="pro")
+
+        with self.assertRaises(ClientSaturated):
+            pool.submit(release.wait, 5, client="ip:1", plan="pro")
+
+        release.set()
+        future.result(5)
+
+        self.assertEqual(pool.stats()["in_flight"], 0)
+
+
+
+
+class MetricsAccessTests(TestCase):
+
+    def get(self, **extra):
+
+        return self.client.get("/metrics", REMOTE_ADDR="127.0.0.1", **extra)
+
+
+    def login(self, staff):
+
+        user = User.objects.create_user(email=f"staff-{staff}@example.com", username="metrics", password="password")
+        user.is_active = True
+        user.is_staff_member = staff
+        user.save()
+
+        self.client.cookies["access"] = str(AccessToken.for_user(user))
+
+
+    def test_loopback_is_not_trusted(self):
+
+        self.assertEqual(self.get().status_code, 404)
+
+
+    def test_scrape_token(self):
+
+        with mock.patch.object(metrics, "token", "scrape-secret"):
+
+            self.assertEqual(self.get(HTTP_AUTHORIZATION="Bearer scrape-secret").status_code, 200)
+            self.assertEqual(self.get(HTTP_AUTHORIZATION="Bearer guessed").status_code, 404)
+
+
+    def test_staff_user_from_the_jwt_cookie(self):
+
+        self.login(staff=True)
+
+        response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"image_stage_seconds", response.content)
+
+
+    def test_other_users_are_refused(self):
+
+        self.login(staff=False)
+
+        self.assertEqual(self.get().status_code, 404)
+
+
+
+
+class ExclusiveProfile(cProfile.Profile):
+
+    """
+    cProfile As It Behaves From Python 3.12 On: One Enabled Profile Per Process
+    """
+
+    active = None
+
+    def enable(self, *args, **kwargs):
+
+        if ExclusiveProfile.active is not None:
+            raise ValueError("Another profiling tool is already active")
+
+        super().enable(*args, **kwargs)
+        ExclusiveProfile.active = self
+
+
+    def disable(self):
+
+        # pstats disables it once more when it reads the stats
+        super().disable()
+
+        if ExclusiveProfile.active is self:
+            ExclusiveProfile.active = None
+
+
+
+
+class ProfilingTests(TestCase):
+
+    def setUp(self):
+
+        for cache in caches.all():
+            cache.clear()
+
+        image_store.clear()
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+        patcher = mock.patch.object(profiler, "directory", self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        user = User.objects.create_user(email="staff@example.com", username="staff", password="password")
+        user.is_active = True
+        user.is_staff_member = True
+        user.save()
+
+        self.client = APIClient()
+        self.client.cookies["access"] = str(AccessToken.for_user(user))
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (32, 32), "red").save(buffer, format="PNG")
+
+        response = self.client.post("/api/upload_image", {"image_base64": base64.b64encode(buffer.getvalue()).decode()}, format="json")
+
+        self.image_id = response.json()["image_id"]
+
+
+    def profile(self, mode):
+
+        response = self.client.post(
+            "/api/apply_adjustments", {"image_id": self.image_id, "brightness": 5}, format="json", HTTP_X_PROFILE=mode,
+        )
+
+        self.assertEqual(response.status_code, 200, response.content)
+
+        profile_id = response["X-Profile-Id"]
+
+        with open(os.path.join(self.directory, f"{profile_id}.json")) as f:
+            return profile_id, json.load(f)
+
+
+    def test_one_profile_per_request_when_cprofile_is_process_wide(self):
+
+        with mock.patch("cProfile.Profile", ExclusiveProfile), mock.patch("api.profiling.PER_THREAD_CPROFILE", False):
+
+            for mode in ("cprofile", "both"):
+
+                profile_id, metadata = self.profile(mode)
+
+                self.assertTrue(os.path.exists(os.path.join(self.directory, f"{profile_id}.prof")))
+                self.assertNotIn("cprofile", metadata)
+
+
+    def test_falls_back_to_sampling_when_cprofile_is_taken(self):
+
+        with mock.patch("cProfile.Profile", ExclusiveProfile):
+            profile_id, metadata = self.profile("cprofile")
+
+        self.assertIn("cprofile", metadata)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, f"{profile_id}.collapsed")))
+
+
+    def test_sampled_request(self):
+
+        profile_id, metadata = self.profile("sample")
+
+        self.assertEqual(metadata["image"], {"width": 32, "height": 32, "mode": "RGB"})
+        self.assertTrue(os.path.exists(os.path.join(self.directory, f"{profile_id}.collapsed")))
+
+
+
+    @override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=16)
+    def test_body_over_the_upload_limit_is_left_to_the_view(self):
+
+        profile_id, metadata = self.profile("sample")
+
+        self.assertGreater(metadata["body_bytes"], 16)
+        self.assertNotIn("params", metadata)
+        self.assertNotIn("image", metadata)
+
+
+    async def test_async_request_profiles_the_sync_view_thread(self):
+
+        self.async_client.cookies["access"] = self.client.cookies["access"].value
+
+        response = await self.async_client.post(
+            "/api/apply_adjustments", {"image_id": self.image_id, "brightness": 5},
+            content_type="application/json", headers={"X-Profile": "cprofile"},
+        )
+
+        self.assertEqual(response.status_code, 200, response.content)
+
+        stats = pstats.Stats(os.path.join(self.directory, f"{response['X-Profile-Id']}.prof"))
+
+        # The APIView runs on the sync thread, not on the event loop
+        self.assertTrue(any(
+            filename.endswith(os.path.join("api", "views.py")) and name == "post" for filename, _, name in stats.stats
+        ))
+
+
+
+class WarmupTests(TestCase):
+
+    def setUp(self):
+
+        # A fresh process as far as the warmup knows, with the imports replaced by a stand-in
+        self.finished = threading.Event()
+
+        for patcher in (
+            mock.patch.object(warmup, "_thread", None),
+            mock.patch.object(warmup, "_lock", threading.Lock()),
+            mock.patch.object(warmup, "_run", self.finished.set),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.addCleanup(request_started.disconnect, dispatch_uid="api.warmup")
+
+
+    def test_starts_on_the_first_request_not_at_import(self):
+
+        import image_processing.wsgi
+
+        importlib.reload(image_processing.wsgi)
+
+        self.assertIsNone(warmup._thread)
+
+        self.client.get("/api/image_store_stats")
+
+        self.assertTrue(self.finished.wait(5))
+
+        thread = warmup._thread
+
+        self.client.get("/api/image_store_stats")
+
+        self.assertIs(warmup._thread, thread)
+
+
+    @override_settings(WARMUP={"ENABLED": False})
+    def test_disabled(self):
+
+        warmup.warm_up_on_first_request()
+
+        self.client.get("/api/image_store_stats")
+
+        self.assertIsNone(warmup._thread)
+        self.assertFalse(self.finished.is_set())
+
+
+    @skipUnless(hasattr(os, "fork"), "needs os.fork")
+    def test_forked_worker_warms_up_itself(self):
+
+        warmup.warm_up_on_first_request()
+
+        self.client.get("/api/image_store_stats")
+
+        self.assertTrue(self.finished.wait(5))
+
+        parent_thread = warmup._thread
+        read, write = os.pipe()
+
+        # Forked while some thread holds the lock, as a preforking master might be
+        with warmup._lock:
+            pid = os.fork()
+
+        if pid == 0:
+
+            status = 1
+
+            try:
+                self.finished.clear()
+                self.assertIsNone(warmup._thread)
+
+                request_started.send(sender=None)
+
+                if self.finished.wait(5) and warmup._thread is not parent_thread:
+                    status = 0
+            finally:
+                os.write(write, bytes([status]))
+                os._exit(status)
+
+        os.close(write)
+
+        self.assertEqual(os.read(read, 1), bytes([0]))
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        os.close(read)
@@ -0,0 +1,634 @@
+# tiles.py
+import math
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+
+from .imaging import (
+    ADJUSTMENT_SCRATCH_BYTES,
+    GEOMETRY_OPERATIONS,
+    RESIZE_SCRATCH_BYTES,
+    SOBEL_SCRATCH_BYTES,
+    adjust_pixels,
+    bilinear_axis,
+    bilinear_blend,
+    sobel_magnitude,
+    to_native,
+)
+from .memory import memory_ledger
+from .metrics import stage
+from .strips import run_tiles, strips_config
+
+
+# Out-of-core processing of images larger than memory (scans, stitched panoramas).
+#
+# A TiledImage keeps its pixels in a memory-mapped file, so only the tiles being worked on
+# and whatever the page cache holds are in RAM. The tiled operations read a tile (plus a
+# halo of neighbouring pixels for the Sobel stencil, or the source rows and columns behind
+# an output tile for resize and the geometry changes), run the same per band math as the
+# in-memory kernels of api/imaging.py on it and write it into a memory-mapped output, a
+# few tiles at a time on the strip pool. Results are bit-identical to the in-memory kernels.
+# Outputs are streamed to disk row by row as PNG, binary PGM/PPM or .npy.
+#
+# .npy and binary PGM/PPM inputs are mapped as they are and never read whole. Other
+# formats are decoded by PIL once (within Image.MAX_IMAGE_PIXELS) and copied to a
+# temporary file. `manage.py process_tiled` runs an operation on a file.
+
+
+DEFAULT_IMAGE_TILES = {
+    "TILE_SIZE": 1024,                 # Pixels per side of a tile
+    "DIRECTORY": None,                 # Temporary images go here, the system temporary directory by default
+    "PNG_COMPRESSION": 6,              # zlib level of the streamed PNG output
+    "WRITE_BYTES": 16 * 1024 * 1024,   # Read from the mapping per step while streaming an output
+}
+
+
+def tiles_config():
+
+    try:
+        configured = getattr(settings, "IMAGE_TILES", {})
+    except Exception:
+        # Kernels also run in worker processes and benchmarks without Django configured
+        configured = {}
+
+    return {**DEFAULT_IMAGE_TILES, **configured}
+
+
+
+# Native mode by (channels, bytes per channel)
+MODES = {(1, 1): "L", (2, 1): "LA", (3, 1): "RGB", (4, 1): "RGBA", (1, 2): "I;16"}
+
+# PNG color type by number of channels
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+
+
+
+def tile_boxes(height, width, size):
+
+    """
+    Splits an Image Into (top, bottom, left, right) Tiles of At Most size x size, Row by Row
+    """
+
+    return [
+        (top, min(top + size, height), left, min(left + size, width))
+        for top in range(0, height, size)
+        for left in range(0, width, size)
+    ]
+
+
+
+
+class TiledImage:
+
+    """
+    An Image in a Native Mode (L, LA, RGB, RGBA or I;16) in a Memory-Mapped File, Worked on
+    Tile by Tile
+    """
+
+    def __init__(self, array, path=None, temporary=False):
+
+        self.array = array
+        self.path = path
+        self.temporary = temporary
+
+
+    @classmethod
+    def create(cls, shape, directory=None, dtype=np.uint8):
+
+        """
+        A New Zeroed Image in a Temporary .npy File, Deleted by close()
+        """
+
+        fd, path = tempfile.mkstemp(suffix=".npy", prefix="tiled-", dir=directory or tiles_config()["DIRECTORY"])
+        os.close(fd)
+
+        array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(shape))
+
+        return cls(array, path, temporary=True)
+
+
+    @classmethod
+    def open(cls, path, directory=None):
+
+        """
+        Maps a .npy or Binary PGM/PPM File. Any Other Format Is Decoded by PIL and Copied
+        Into a Temporary File. Raises ValueError
+        """
+
+        extension = os.path.splitext(path)[1].lower()
+
+        if extension == ".npy":
+
+            tiled = cls(np.load(path, mmap_mode="r"), path)
+
+            if tiled.array.dtype.kind != "u" or tiled.array.ndim not in (2, 3) or tiled.layout not in MODES or tiled.array.shape[2:] == (1,):
+                raise ValueError("Only uint8 (H, W), (H, W, 2), (H, W, 3), (H, W, 4) and uint16 (H, W) arrays can be processed")
+
+            return tiled
+
+        if extension in (".pgm", ".ppm", ".pnm"):
+            return cls(map_netpbm(path), path)
+
+        try:
+            img = Image.open(path)
+        except (OSError, Image.DecompressionBombError) as e:
+            raise ValueError(f"Can't open {path}: {e}")
+
+        with img:
+            return cls.from_image(img, directory)
+
+
+    @classmethod
+    def from_image(cls, img, directory=None):
+
+        """
+        Copies a PIL Image Into a Temporary File, in Its Native Mode
+        """
+
+        pixels = np.asarray(to_native(img))
+
+        tiled = cls.create(pixels.shape, directory, pixels.dtype)
+        tiled.array[:] = pixels
+        tiled.array.flush()
+
+        return tiled
+
+
+    @property
+    def height(self):
+
+        return self.array.shape[0]
+
+
+    @property
+    def width(self):
+
+        return self.array.shape[1]
+
+
+    @property
+    def channels(self):
+
+        return self.array.shape[2] if self.array.ndim == 3 else 1
+
+
+    @property
+    def dtype(self):
+
+        """
+        uint8 or uint16 in The Native Byte Order, 16-bit PGM Files Are Mapped Big-Endian
+        """
+
+        return np.dtype(np.uint16) if self.array.dtype.itemsize == 2 else np.dtype(np.uint8)
+
+
+    @property
+    def layout(self):
+
+        return self.channels, self.array.dtype.itemsize
+
+
+    @property
+    def mode(self):
+
+        return MODES[self.layout]
+
+
+    def read(self, box, halo=0):
+
+        """
+        Copies a Tile Out of The Mapping, With halo Pixels Around It. Past The Edges of The
+        Image, The Edge Pixels Are Repeated
+        """
+
+        top, bottom, left, right = box
+
+        region = self.array[max(top - halo, 0):min(bottom + halo, self.height), max(left - halo, 0):min(right + halo, self.width)]
+
+        if not halo:
+            return np.array(region)
+
+        padding = (
+            (max(halo - top, 0), max(bottom + halo - self.height, 0)),
+            (max(halo - left, 0), max(right + halo - self.width, 0)),
+        ) + ((0, 0),) * (region.ndim - 2)
+
+        return np.pad(region, padding, mode="edge")
+
+
+    def write(self, box, pixels):
+
+        top, bottom, left, right = box
+
+        self.array[top:bottom, left:right] = pixels
+
+
+    def rows(self):
+
+        """
+        Yields Consecutive Blocks of Whole Rows, Small Enough To Stream
+        """
+
+        step = max(1, tiles_config()["WRITE_BYTES"] // (self.width * self.channels * self.dtype.itemsize))
+
+        for start in range(0, self.height, step):
+            yield np.asarray(self.array[start:start + step])
+
+
+    def to_image(self):
+
+        """
+        The Whole Image as a PIL Image, Only For Images That Fit in Memory
+        """
+
+        return Image.fromarray(np.array(self.array))
+
+
+    def save(self, path):
+
+        """
+        Streams The Image Into a .png, .pgm/.ppm or .npy File
+        """
+
+        extension = os.path.splitext(path)[1].lower()
+
+        if extension == ".npy":
+
+            out = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=self.array.shape)
+            start = 0
+
+            for block in self.rows():
+                out[start:start + len(block)] = block
+                start += len(block)
+
+            out.flush()
+            return
+
+        writer = {".png": write_png, ".pgm": write_netpbm, ".ppm": write_netpbm, ".pnm": write_netpbm}.get(extension)
+
+        if writer is None:
+            raise ValueError(f"Can't write {extension or 'files without an extension'}, use .png, .pgm, .ppm or .npy")
+
+        with open(path, "wb") as f:
+            writer(self, f)
+
+
+    def close(self):
+
+        """
+        Drops The Mapping, and Deletes The File of a Temporary Image
+        """
+
+        self.array = None
+
+        if self.temporary and self.path is not None:
+
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+            self.path = None
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+
+
+# -----------------------------------------------------------------------------
+# Formats
+
+
+def map_netpbm(path):
+
+    """
+    Maps The Pixels of a Binary 8 or 16-bit PGM (P5) or 8-bit PPM (P6) File. Raises ValueError
+    """
+
+    with open(path, "rb") as f:
+        head = f.read(1024)
+
+    if head[:2] not in (b"P5", b"P6"):
+        raise ValueError("Only binary PGM (P5) and PPM (P6) files can be mapped")
+
+    values = []
+    position = 2
+
+    # Width, height and maxval, separated by whitespace and comments
+    while len(values) < 3:
+
+        while position < len(head) and (head[position:position + 1].isspace() or head[position:position + 1] == b"#"):
+
+            if head[position:position + 1] == b"#":
+                position = head.index(b"\n", position)
+
+            position += 1
+
+        end = position
+
+        while end < len(head) and head[end:end + 1].isdigit():
+            end += 1
+
+        if end == position:
+            raise ValueError("Malformed PGM/PPM header")
+
+        values.append(int(head[position:end]))
+        position = end
+
+    width, height, maxval = values
+
+    if maxval != 255 and not (maxval == 65535 and head[:2] == b"P5"):
+        raise ValueError("Only 8-bit PGM/PPM and 16-bit PGM files can be mapped")
+
+    shape = (height, width) if head[:2] == b"P5" else (height, width, 3)
+
+    # A single whitespace character separates the header from the pixels, 16-bit samples are big-endian
+    return np.memmap(path, dtype=np.uint8 if maxval == 255 else ">u2", mode="r", offset=position + 1, shape=shape)
+
+
+
+def write_netpbm(image, f):
+
+    if image.mode not in ("L", "RGB", "I;16"):
+        raise ValueError("PGM/PPM files hold L, RGB or I;16 images only")
+
+    maxval = np.iinfo(image.dtype).max
+
+    f.write(b"%s\n%d %d\n%d\n" % (b"P5" if image.channels == 1 else b"P6", image.width, image.height, maxval))
+
+    for block in image.rows():
+        f.write(block.astype(">u2" if maxval > 255 else np.uint8, copy=False).tobytes())
+
+
+
+def write_png(image, f):
+
+    """
+    Streams an Image Into a PNG File Block by Block, Every Row "Up" Filtered
+    """
+
+    depth = image.dtype.itemsize * 8
+    row_bytes = image.width * image.channels * image.dtype.itemsize
+
+    f.write(b"\x89PNG\r\n\x1a\n")
+    _png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", image.width, image.height, depth, PNG_COLOR_TYPES[image.channels], 0, 0, 0))
+
+    compressor = zlib.compressobj(tiles_config()["PNG_COMPRESSION"])
+    previous = np.zeros((1, row_bytes), dtype=np.uint8)
+
+    for block in image.rows():
+
+        # 16-bit samples are stored big-endian, the filter works on their bytes
+        block = np.ascontiguousarray(block.astype(">u2", copy=False)).view(np.uint8) if depth == 16 else block
+        block = block.reshape(-1, row_bytes)
+
+        # Filter type 2 in front of every row, then the difference to the row above, modulo 256
+        filtered = np.empty((len(block), row_bytes + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        np.subtract(block, np.concatenate((previous, block[:-1])), out=filtered[:, 1:])
+
+        previous = block[-1:]
+
+        data = compressor.compress(filtered)
+
+        if data:
+            _png_chunk(f, b"IDAT", data)
+
+    _png_chunk(f, b"IDAT", compressor.flush())
+    _png_chunk(f, b"IEND", b"")
+
+
+
+def _png_chunk(f, kind, data):
+
+    f.write(struct.pack(">I", len(data)))
+    f.write(kind)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+
+
+
+# -----------------------------------------------------------------------------
+# Tiled operations, taking the parameters the parsers of api/operations.py return
+
+
+def _span(progress, start, end):
+
+    """
+    Maps The Progress of One Pass Onto Its Share of The Whole Operation
+    """
+
+    if progress is None:
+        return None
+
+    return lambda fraction: progress(start + (end - start) * fraction)
+
+
+
+def _fill(dst, fn, count, tile_pixels, **kwargs):
+
+    """
+    run_tiles() Writing Into dst, Which Is Deleted When a Tile Fails
+    """
+
+    try:
+        run_tiles(fn, count, tile_pixels, **kwargs)
+    except BaseException:
+        dst.close()
+        raise
+
+    return dst
+
+
+
+def tiled_adjustments(src, params, progress=None, tile_size=None, directory=None):
+
+    size = tile_size or tiles_config()["TILE_SIZE"]
+    boxes = tile_boxes(src.height, src.width, size)
+
+    dst = TiledImage.create(src.array.shape, directory, src.dtype)
+
+    band_pixels = min(size * size, strips_config()["BAND_PIXELS"])
+
+    def tile(index):
+
+        pixels = src.read(boxes[index])
+
+        # Bands of a tile, as apply_adjustments does, keep the float32 temporaries in cache
+        rows = max(1, band_pixels // pixels.shape[1])
+
+        for start in range(0, len(pixels), rows):
+            pixels[start:start + rows] = adjust_pixels(pixels[start:start + rows], **params)
+
+        dst.write(boxes[index], pixels)
+
+    return _fill(dst, tile, len(boxes), band_pixels, progress=progress, scratch_per_pixel=ADJUSTMENT_SCRATCH_BYTES * src.channels)
+
+
+
+def tiled_edges(src, params, progress=None, tile_size=None, directory=None):
+
+    """
+    Sobel Edge Detection in Two Passes, One For The Global Maximum and One To Normalize.
+    The Magnitudes of a Tile Are Computed Again in The Second Pass Rather Than Kept
+    """
+
+    size = tile_size or tiles_config()["TILE_SIZE"]
+    boxes = tile_boxes(src.height, src.width, size)
+
+    def magnitude(box):
+
+        block = src.read(box, halo=1)
+
+        # The gray levels, as operations.grayscale_array takes them
+        if src.channels == 2:
+            block = block[:, :, 0]
+        elif src.channels > 2:
+            block = np.asarray(Image.fromarray(block).convert("L"))
+
+        return sobel_magnitude(block.astype(np.float32))
+
+    maxima = [0.0] * len(boxes)
+
+    def measure(index):
+        maxima[index] = magnitude(boxes[index]).max()
+
+    run_tiles(measure, len(boxes), size * size, progress=_span(progress, 0, 0.5), scratch_per_pixel=SOBEL_SCRATCH_BYTES)
+
+    peak = max(maxima, default=0.0)
+
+    dst = TiledImage.create((src.height, src.width), directory)
+
+    # Without any gradient the zeroed output is the result
+    if peak == 0:
+        return dst
+
+    def normalize(index):
+        dst.write(boxes[index], ((magnitude(boxes[index]) / peak) * 255).astype(np.uint8))
+
+    return _fill(dst, normalize, len(boxes), size * size, progress=_span(progress, 0.5, 1), scratch_per_pixel=SOBEL_SCRATCH_BYTES)
+
+
+
+def tiled_resize(src, params, progress=None, tile_size=None, directory=None):
+
+    resize_scale = params["resize_scale"]
+
+    new_h = math.ceil(src.height * resize_scale)
+    new_w = math.ceil(src.width * resize_scale)
+
+    x0, x1, x_fraction = bilinear_axis(src.height, new_h)
+    y0, y1, y_fraction = bilinear_axis(src.width, new_w)
+
+    # Smaller output tiles when shrinking, so the source region behind one stays about a tile
+    size = max(16, int((tile_size or tiles_config()["TILE_SIZE"]) * min(1.0, resize_scale)))
+    boxes = tile_boxes(new_h, new_w, size)
+
+    dst = TiledImage.create((new_h, new_w) + src.array.shape[2:], directory, src.dtype)
+
+    def tile(index):
+
+        top, bottom, left, right = boxes[index]
+
+        # The indices only grow along an axis, the first and last bound the region
+        region_top, region_left = x0[top], y0[left]
+
+        region = src.read((region_top, x1[bottom - 1] + 1, region_left, y1[right - 1] + 1))
+
+        if region.ndim == 2:
+            region = region[:, :, np.newaxis]
+
+        pixels = bilinear_blend(
+            region[x0[top:bottom] - region_top],
+            region[x1[top:bottom] - region_top],
+            y0[left:right] - region_left,
+            y1[left:right] - region_left,
+            y_fraction[np.newaxis, left:right, np.newaxis],
+            x_fraction[top:bottom, np.newaxis, np.newaxis],
+        )
+
+        dst.write(boxes[index], pixels[:, :, 0] if src.array.ndim == 2 else pixels)
+
+    return _fill(dst, tile, len(boxes), size * size, progress=progress, scratch_per_pixel=RESIZE_SCRATCH_BYTES * src.channels)
+
+
+
+# change: (output height and width from the source's, source box behind an output box)
+GEOMETRY_SOURCES = {
+    'r': (lambda h, w: (w, h), lambda h, w, top, bottom, left, right: (left, right, w - bottom, w - top)),
+    '-r': (lambda h, w: (w, h), lambda h, w, top, bottom, left, right: (h - right, h - left, top, bottom)),
+    'vf': (lambda h, w: (h, w), lambda h, w, top, bottom, left, right: (h - bottom, h - top, left, right)),
+    'hf': (lambda h, w: (h, w), lambda h, w, top, bottom, left, right: (top, bottom, w - right, w - left)),
+}
+
+
+
+def tiled_geometry(src, params, progress=None, tile_size=None, directory=None):
+
+    """
+    Applies The Changes One After The Other, Each Output Tile Being The Source Tile Behind It
+    Rotated or Flipped
+    """
+
+    size = tile_size or tiles_config()["TILE_SIZE"]
+    changes = params["change_to_be_made"]
+
+    current = src
+
+    for step, change in enumerate(changes):
+
+        shape, source_box = GEOMETRY_SOURCES[change]
+
+        h, w = current.height, current.width
+        boxes = tile_boxes(*shape(h, w), size)
+
+        dst = TiledImage.create(shape(h, w) + current.array.shape[2:], directory, current.dtype)
+
+        def tile(index):
+            dst.write(boxes[index], GEOMETRY_OPERATIONS[change](current.read(source_box(h, w, *boxes[index]))))
+
+        try:
+            _fill(dst, tile, len(boxes), size * size, progress=_span(progress, step / len(changes), (step + 1) / len(changes)))
+        finally:
+            # The intermediate results are temporary, the source is the caller's
+            if current is not src:
+                current.close()
+
+        current = dst
+
+    return current
+
+
+
+TILED_OPERATIONS = {
+    "apply_adjustments": tiled_adjustments,
+    "resize_image": tiled_resize,
+    "modify_geometry": tiled_geometry,
+    "edge_detection": tiled_edges,
+}
+
+
+
+def run_tiled(name, src, params, progress=None, tile_size=None, directory=None):
+
+    """
+    Runs a Tiled Operation, Accounted Like The In-Memory Ones. Returns a Temporary TiledImage
+    """
+
+    with stage("compute"), memory_ledger.operation(f"tiled_{name}"):
+        return TILED_OPERATIONS[name](src, params, progress=progress, tile_size=tile_size, directory=directory)
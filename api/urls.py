@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import views, async_views
 
 
 urlpatterns = [
@@ -9,4 +9,15 @@ urlpatterns = [
     path('modify_geometry', views.ModifyGeometry.as_view()),
     path('edge_detection', views.EdgeDetectionView.as_view()),
     path('channel_analysis', views.ChannelAnalysisView.as_view()),
+    path('image_store_stats', views.ImageStoreStats.as_view()),
+    path('jobs/<uuid:job_id>', views.ImageJobStatus.as_view()),
+    path('jobs/<uuid:job_id>/events', views.ImageJobEvents.as_view()),
+
+    # Async variants, served best under ASGI (image_processing/asgi.py)
+    path('async/upload_image', async_views.upload_image),
+    path('async/apply_adjustments', async_views.apply_adjustments),
+    path('async/resize_image', async_views.resize_image),
+    path('async/modify_geometry', async_views.modify_geometry),
+    path('async/edge_detection', async_views.edge_detection),
+    path('async/channel_analysis', async_views.channel_analysis),
 ]
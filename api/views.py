@@ -1,23 +1,38 @@
 # views.py
+import json
+import asyncio
+import time
 import uuid
-import base64
-from io import BytesIO
-import numpy as np
-import math
+from functools import partial
 
-from PIL import Image
-from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-import matplotlib.colors as mcolors
+from rest_framework.permissions import IsAdminUser
+from rest_framework.renderers import BrowsableAPIRenderer
 
+from authentication.ratelimit import PlanRateThrottle
 
-CACHE_TIMEOUT = 60 * 10  # 10 minutes
+from .compute import compute_pool, client_key, PoolSaturated, ClientSaturated
+from .cost import probe_base64, admit_upload, admit_operation, REJECT, QUEUE, DOWNSCALE
+from .image_store import image_store, image_owner, ImageTooLarge
+from .metrics import TimedJSONRenderer
+from .operations import OPERATIONS, InvalidParameters, decode_upload, run_operation, compute_operation, render_result, operation_pixels
+from .scheduler import scheduling, request_plan
+from .jobs import job_runner, job_status, jobs_config
+from .models import ImageJob
+from .singleflight import single_flight
+from .supersede import latest_wins, parse_sequence, Superseded
 
 
 class UploadOriginalImage(APIView):
 
+    throttle_classes = [PlanRateThrottle]
+
+    renderer_classes = [TimedJSONRenderer, BrowsableAPIRenderer]
+
     def post(self, request):
 
         image_base64 = request.data.get("image_base64")
@@ -29,8 +44,14 @@ class UploadOriginalImage(APIView):
             )
 
         try:
-            img = base64_to_image(image_base64)
-            img = img.convert("RGB")
+            # Sized from the header before anything is decoded, see api/cost.py
+            decision = admit_upload(request_plan(request.user), probe_base64(image_base64))
+
+            if decision.action == REJECT:
+                return rejected_response(decision)
+
+            img = decode_upload(image_base64, size=decision.size)
+
         except ValueError:
             return Response(
                 {"error": "Invalid base64 image"},
@@ -40,86 +61,72 @@ class UploadOriginalImage(APIView):
         image_id = str(uuid.uuid4())
 
         # Cache original image
-        cache.set(f"original:{image_id}", img, timeout=CACHE_TIMEOUT)
+        try:
+            image_store.set(f"original:{image_id}", img, owner=image_owner(request))
+        except ImageTooLarge:
+            return Response(
+                {"error": "Image is too large to be processed"},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+
+        payload = {"image_id": image_id}
+
+        if decision.action == DOWNSCALE:
+            payload["downscaled_to"] = list(img.size)
 
         return Response(
-            {"image_id": image_id},
+            payload,
             status=status.HTTP_201_CREATED
         )
 
 
 
 
-class ApplyImageAdjustments(APIView):
-
-    def post(self, request):
-
-        image_id = request.data.get("image_id")
+class ImageOperationView(APIView):
 
-        if not image_id:
-            return Response(
-                {"error": "image_id is required"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+    """
+    Runs One of The Operations in api/operations.py on a Cached Original Image.
+    With "mode": "job" in The Request, The Operation Runs in The Background Instead
+    """
 
-        # Load original image from cache
-        original_img = cache.get(f"original:{image_id}")
+    operation = None
 
-        if original_img is None:
-            return Response(
-                {"error": "Image expired or not found"},
-                status=status.HTTP_404_NOT_FOUND
-            )
-
-        # Read adjustment values
-        brightness = float(request.data.get("brightness", 0))
-        contrast = float(request.data.get("contrast", 0))
-        saturation = float(request.data.get("saturation", 0))
-        gamma = float(request.data.get("gamma", 1.0))
-
-        # Always start from ORIGINAL
-        processed_img = original_img.copy()
-        processed_img = apply_adjustments(
-            processed_img,
-            brightness=brightness,
-            contrast=contrast,
-            saturation=saturation,
-            gamma=gamma
-        )
+    throttle_classes = [PlanRateThrottle]
 
-        return Response(
-            {
-                "image": image_to_base64(processed_img)
-            },
-            status=status.HTTP_200_OK
-        )
+    # JSON rendering shows up as the "render" stage of Server-Timing, see api/metrics.py
+    renderer_classes = [TimedJSONRenderer, BrowsableAPIRenderer]
 
+    # Identical concurrent requests share one computation, see api/singleflight.py
+    coalesce = False
 
+    # Requests carrying a "seq" are dropped once a newer one arrives, see api/supersede.py
+    latest_wins = False
 
-
-class ResizeImage(APIView):
+    # "interactive" views are rate limited against RATE_LIMITS["INTERACTIVE_PLANS"]
+    throttle_scope = None
 
     def post(self, request):
 
-        print('Request Received.....')
-
-        image_id = request.data.get("image_id",None)
-        resize_scale = request.data.get("resize_scale",None)
+        image_id = request.data.get("image_id", None)
 
         if not image_id:
             return Response(
                 {"error": "image_id is required"},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        
-        if not resize_scale:
+
+        operation = OPERATIONS[self.operation]
+
+        try:
+            params = operation.parse(request.data)
+        except InvalidParameters as e:
             return Response(
-                {"error": "Resize Scale is required"},
+                {"error": str(e)},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
         # Load original image from cache
-        original_img = cache.get(f"original:{image_id}")
+        original_img = image_store.get(f"original:{image_id}")
 
         if original_img is None:
             return Response(
@@ -127,465 +134,314 @@ class ResizeImage(APIView):
                 status=status.HTTP_404_NOT_FOUND
             )
 
-        # Always start from ORIGINAL
-        processed_img = original_img.copy()
-        processed_img_array = np.array(processed_img)
-
-        new_h = math.ceil(processed_img_array.shape[0] * float(resize_scale))
-        new_w = math.ceil(processed_img_array.shape[1] * float(resize_scale))
-
-        print('Now Resizing The Image.....')
-
-        resized_original_image_array = bl_resize(processed_img_array, new_w=new_w, new_h=new_h)
-
-        return Response(
-            {
-                "image_w": processed_img_array.shape[1],
-                "image_h": processed_img_array.shape[0],
-                "resize_scale": resize_scale,
-                "new_image_w": math.ceil(processed_img_array.shape[1]*resize_scale),
-                "new_image_h": math.ceil(processed_img_array.shape[0]*resize_scale),
-                "image": image_to_base64(Image.fromarray(resized_original_image_array)),
-            },
-            status=status.HTTP_200_OK
-        )
-
-
-
+        # Predicted from the size and parameters before any work, see api/cost.py
+        decision = admit_operation(request_plan(request.user), self.operation, original_img, params)
 
-class ModifyGeometry(APIView):
+        if decision.action == REJECT:
+            return rejected_response(decision)
 
-    def post(self, request):
+        # Work too long to hold the request for runs as a job, like when the client asks for one
+        if request.data.get("mode") == "job" or decision.action == QUEUE:
 
-        print('Request Received.....')
+            user = request.user if request.user.is_authenticated else None
 
-        image_id = request.data.get("image_id",None)
-        change_to_be_made = request.data.get("change_to_be_made",None)
+            try:
+                job = job_runner.submit(self.operation, original_img, params, user=user, client=client_key(request))
+            except PoolSaturated as e:
+                return saturated_response(e, status.HTTP_503_SERVICE_UNAVAILABLE)
+            except ClientSaturated as e:
+                return saturated_response(e, status.HTTP_429_TOO_MANY_REQUESTS)
 
-        if not image_id:
-            return Response(
-                {"error": "image_id is required"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        if not change_to_be_made:
             return Response(
-                {"error": "Resize Scale is required"},
-                status=status.HTTP_400_BAD_REQUEST
+                job_accepted(job, decision),
+                status=status.HTTP_202_ACCEPTED
             )
 
-        print(change_to_be_made,type(change_to_be_made))
+        sequence = parse_sequence(request.data, image_id) if self.latest_wins else None
 
+        pixels = operation_pixels(self.operation, original_img, params)
 
-        # Load original image from cache
-        original_img = cache.get(f"original:{image_id}")
-
-        if original_img is None:
-            return Response(
-                {"error": "Image expired or not found"},
-                status=status.HTTP_404_NOT_FOUND
-            )
+        try:
 
-        # Always start from ORIGINAL
-        to_be_processed_img = original_img.copy()
-        to_be_processed_img_array = np.array(to_be_processed_img)
+            if sequence is not None:
+                return self.run_latest_wins(request, original_img, params, pixels, *sequence)
 
-        for op in change_to_be_made:
-            
-            to_be_processed_img_array = change_geometry(to_be_processed_img_array, op)
+            if self.coalesce:
+                payload = single_flight.run(
+                    single_flight.key(image_id, self.operation, params),
+                    lambda: self.run_in_pool(request, pixels, run_operation, self.operation, original_img, params),
+                )
+            else:
+                payload = self.run_in_pool(request, pixels, run_operation, self.operation, original_img, params)
 
-        if to_be_processed_img_array is None:
-            
-            return Response(
-                {"error": "Invalid geometry operation"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        except PoolSaturated as e:
+            return saturated_response(e, status.HTTP_503_SERVICE_UNAVAILABLE)
+        except ClientSaturated as e:
+            return saturated_response(e, status.HTTP_429_TOO_MANY_REQUESTS)
 
         return Response(
-            {
-                "image": image_to_base64(Image.fromarray(to_be_processed_img_array)),
-            },
+            payload,
             status=status.HTTP_200_OK
         )
 
 
+    def run_in_pool(self, request, pixels, fn, *args):
 
-class EdgeDetectionView(APIView):
-
-    def post(self, request):
+        """
+        Runs fn(*args) On The Compute Pool in The Lane of The User's Plan and Waits For It
+        """
 
-        image_id = request.data.get("image_id",None)
+        return compute_pool.submit(fn, *args, client=client_key(request), **scheduling(request.user, pixels)).result()
 
-        if not image_id:
-            return Response(
-                {"error": "image_id is required"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
 
+    def run_latest_wins(self, request, original_img, params, pixels, scope, seq):
 
-        # Load original image from cache
-        original_img = cache.get(f"original:{image_id}")
+        if not latest_wins.advance(scope, seq):
+            return superseded_response(seq)
 
-        if original_img is None:
-            return Response(
-                {"error": "Image expired or not found"},
-                status=status.HTTP_404_NOT_FOUND
+        try:
+            # The guard is called at every stage boundary of the kernel
+            result = self.run_in_pool(
+                request, pixels, partial(compute_operation, self.operation, progress=latest_wins.guard(scope, seq)), original_img, params,
             )
 
-        # Always start from ORIGINAL
-        to_be_processed_img = original_img.copy().convert('L')
-        to_be_processed_img_array = np.array(to_be_processed_img)
-
-        modified_image = sobel_edge_detection(to_be_processed_img_array)
+            # Nothing newer arrived while computing? Then it is worth encoding
+            latest_wins.check(scope, seq)
 
+        except Superseded:
+            return superseded_response(seq)
 
         return Response(
-            {
-                "image": image_to_base64(modified_image),
-            },
+            render_result(result),
             status=status.HTTP_200_OK
         )
 
 
 
 
-class ChannelAnalysisView(APIView):
+class ApplyImageAdjustments(ImageOperationView):
 
-    def post(self, request):
+    operation = "apply_adjustments"
+    coalesce = True
+    latest_wins = True
+    throttle_scope = "interactive"
 
-        image_id = request.data.get("image_id",None)
 
-        if not image_id:
-            return Response(
-                {"error": "image_id is required"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
 
+class ResizeImage(ImageOperationView):
 
-        # Load original image from cache
-        original_img = cache.get(f"original:{image_id}")
+    operation = "resize_image"
 
-        if original_img is None:
-            return Response(
-                {"error": "Image expired or not found"},
-                status=status.HTTP_404_NOT_FOUND
-            )
 
-        # Always start from ORIGINAL
-        to_be_processed_img_array = np.array(original_img.copy().convert('RGB'))
 
-        split_result = channel_splitting(to_be_processed_img_array)
+class ModifyGeometry(ImageOperationView):
 
-        red_img,green_img,blue_img = split_result[0]
-        red_contribution,green_contribution,blue_contribution = split_result[1]
+    operation = "modify_geometry"
 
 
-        return Response(
-            {
-                "images": {
-                    'red_image':red_img,
-                    'green_image':green_img,
-                    'blue_image':blue_img
-                },
-                "contributions" : {
-                    'red_contribution':red_contribution,
-                    'green_contribution':green_contribution,
-                    'blue_contribution':blue_contribution
-                }
-            },
-            status=status.HTTP_200_OK
-        )
-
 
+class EdgeDetectionView(ImageOperationView):
 
+    operation = "edge_detection"
+    coalesce = True
 
 
 
-def base64_to_image(base64_string):
-    """
-    Convert a base64 string (with data:image/...) into a PIL Image.
-    Raises ValueError if invalid.
-    """
-    if "," in base64_string:
-        _, base64_data = base64_string.split(",", 1)
-    else:
-        base64_data = base64_string
+class ChannelAnalysisView(ImageOperationView):
 
-    try:
+    operation = "channel_analysis"
 
-        decoded = base64.b64decode(base64_data)
 
-    except Exception:
 
-        raise ValueError("Invalid base64 data")
 
-    try:
+def job_accepted(job, decision):
 
-        img = Image.open(BytesIO(decoded))
-        img.verify()   # verify first
-        img = Image.open(BytesIO(decoded))  # re-open after verify()
-        return img
-    
-    except Exception:
+    payload = {
+        **job_status(job),
+        "status_url": f"/api/jobs/{job.pk}",
+        "events_url": f"/api/jobs/{job.pk}/events",
+    }
 
-        raise ValueError("Invalid image file")
+    if decision.action == QUEUE:
+        payload["queued_because"] = decision.reason
 
+    return payload
 
 
-def image_to_base64(pil_image, fmt="PNG"):
-    """
-    Convert a PIL Image to a Base64 data URL.
-    """
-    buffer = BytesIO()
-    pil_image.save(buffer, format=fmt)
-    encoded = base64.b64encode(buffer.getvalue()).decode("utf-8")
 
-    return f"data:image/{fmt.lower()};base64,{encoded}"
+def rejected_response(decision):
 
+    return Response(
+        {"error": decision.reason, "estimate": decision.estimate.as_dict()},
+        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    )
 
 
-def apply_adjustments(img, brightness=0, saturation=1, gamma=1.0, contrast=1):
 
-    arr = np.array(img).astype(np.float32)
+def saturated_response(error, status_code):
 
-    # Brightness
+    response = Response({"error": str(error)}, status=status_code)
+    response["Retry-After"] = str(compute_pool.retry_after)
 
-    if brightness != 0:
-        arr = np.clip(arr + float(brightness), 0, 255)
+    return response
 
-    
-    if contrast != 1:
-        
-        arr = np.clip((arr - 128.0) * contrast + 128.0, 0, 255)
 
-    # Gamma correction
-    if gamma != 1.0:
-        arr = np.clip(255 * ((arr / 255) ** (1 / gamma)), 0, 255)
 
-    # Saturatoin
-    if saturation != 0:
-        
-        hsv_array = mcolors.rgb_to_hsv(arr.astype(np.float32) / 255.0)
-        hsv_array[:,:,1] = np.clip(hsv_array[:,:,1] * saturation, 0, 1)
-        arr = mcolors.hsv_to_rgb(hsv_array)*255
+def superseded_response(seq):
 
-    return Image.fromarray(arr.astype(np.uint8))
+    return Response(
+        {"error": "Superseded by a newer request", "seq": seq},
+        status=status.HTTP_409_CONFLICT
+    )
 
 
 
 
+def get_job_for_request(request, job_id):
 
-def bl_resize(original_img, new_h, new_w):
     """
-    Resize an image using Bilinear Interpolation.
-
-    Parameters:
-        original_img (numpy.ndarray): (H, W, C) image
-        new_h (int): desired height
-        new_w (int): desired width
-
-    Returns:
-        numpy.ndarray: resized image (new_h, new_w, C)
+    Returns The Job if It Exists and Belongs To The Requesting User, Otherwise None
     """
 
-    old_h, old_w, c = original_img.shape
+    # Jobs left behind by a restarted worker are failed before anyone waits on them
+    job_runner.recover()
 
-    if new_h <= 0 or new_w <= 0:
-        raise ValueError("new_h and new_w must be positive integers")
+    job = ImageJob.objects.filter(pk=job_id).first()
 
-    # Create output image
-    resized = np.zeros((new_h, new_w, c), dtype=np.float32)
+    if job is None:
+        return None
 
-    # Scaling factors
-    h_scale = old_h / new_h
-    w_scale = old_w / new_w
+    if job.user_id is not None and job.user_id != getattr(request.user, "pk", None):
+        return None
+
+    return job
 
-    for i in range(new_h):
-        for j in range(new_w):
 
-            # Map pixel centers
-            x = (i + 0.5) * h_scale - 0.5
-            y = (j + 0.5) * w_scale - 0.5
 
-            # Neighbor pixel indices
-            x0 = int(math.floor(x))
-            y0 = int(math.floor(y))
-            x1 = x0 + 1
-            y1 = y0 + 1
 
-            # Clamp indices
-            x0 = max(0, min(x0, old_h - 1))
-            x1 = max(0, min(x1, old_h - 1))
-            y0 = max(0, min(y0, old_w - 1))
-            y1 = max(0, min(y1, old_w - 1))
+class ImageJobStatus(APIView):
 
-            # Distances
-            dx = x - x0
-            dy = y - y0
+    def get(self, request, job_id):
 
-            # Four neighboring pixels
-            p00 = original_img[x0, y0]
-            p01 = original_img[x0, y1]
-            p10 = original_img[x1, y0]
-            p11 = original_img[x1, y1]
+        job = get_job_for_request(request, job_id)
 
-            # Bilinear interpolation
-            top = p00 * (1 - dy) + p01 * dy
-            bottom = p10 * (1 - dy) + p11 * dy
-            pixel = top * (1 - dx) + bottom * dx
+        if job is None:
+            return Response(
+                {"error": "Job expired or not found"},
+                status=status.HTTP_404_NOT_FOUND
+            )
 
-            resized[i, j] = pixel
+        return Response(job_status(job), status=status.HTTP_200_OK)
 
-    # Clip and convert to uint8
-    resized = np.clip(resized, 0, 255)
-    return resized.astype(np.uint8)
 
 
 
+class ImageJobEvents(APIView):
 
-def change_geometry(original_array: np.ndarray, change: str) -> np.ndarray | None:
+    """
+    Streams The Progress of a Job as Server-Sent Events, Ending With The Result
+    """
 
-    operations = {
-        'r': lambda x: np.rot90(x, k=1),
-        '-r': lambda x: np.rot90(x, k=3),
-        'vf': np.flipud,
-        'hf': np.fliplr,
-    }
+    def get(self, request, job_id):
 
-    operation = operations.get(change)
-    if not operation:
-        return None
+        job = get_job_for_request(request, job_id)
 
-    return operation(original_array)
+        if job is None:
+            return Response(
+                {"error": "Job expired or not found"},
+                status=status.HTTP_404_NOT_FOUND
+            )
 
+        # Under ASGI the stream waits on the event loop, a sync generator would hold a sync thread for the whole job
+        if isinstance(request._request, ASGIRequest):
+            events = astream_job_events(job.pk)
+        else:
+            events = stream_job_events(job.pk)
 
+        response = StreamingHttpResponse(events, content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
 
+        return response
 
-def sobel_edge_detection(grayscale_image_array):
 
-    img_array = grayscale_image_array.astype(np.float32)
 
-    # Define Sobel kernels
-    sobel_x = np.array([[-1, 0, 1],
-                        [-2, 0, 2],
-                        [-1, 0, 1]], dtype=np.float32)
+def job_event(job, last_progress):
 
-    sobel_y = np.array([[-1, -2, -1],
-                        [0, 0, 0],
-                        [1, 2, 1]], dtype=np.float32)
+    """
+    Returns The SSE Event For The Current State of a Job, or None When Nothing Changed
+    """
 
-    # Apply convolution
-    # Create padded image to handle borders during convolution
-    padded_img = np.pad(img_array, 1, mode='edge')
-    
-    gradient_x = np.zeros_like(img_array)
-    gradient_y = np.zeros_like(img_array)
+    if job is None:
+        return "event: error\ndata: {\"error\": \"Job expired or not found\"}\n\n"
 
-    for i in range(img_array.shape[0]):
-        for j in range(img_array.shape[1]):
-            # Extract 3x3 window
-            window = padded_img[i:i+3, j:j+3]
-            gradient_x[i, j] = np.sum(window * sobel_x)
-            gradient_y[i, j] = np.sum(window * sobel_y)
+    if job.is_finished:
+        return f"event: {job.status}\ndata: {json.dumps(job_status(job))}\n\n"
 
-    # Calculate magnitude of the gradient
-    magnitude = np.sqrt(gradient_x**2 + gradient_y**2)
+    if job.progress != last_progress:
+        return f"event: progress\ndata: {json.dumps(job_status(job, include_result=False))}\n\n"
 
-    # Normalize to 0-255 and convert to uint8 for saving
-    magnitude = (magnitude / magnitude.max()) * 255
-    edge_image = Image.fromarray(magnitude.astype(np.uint8))
+    return None
 
-    return edge_image
 
 
+def stream_job_events(job_id):
 
+    config = jobs_config()
 
-def sobel_edge_detection_vectorized(grayscale_image_array):
-    # Convert to float
-    img = grayscale_image_array.astype(np.float32)
+    deadline = time.monotonic() + config["EVENTS_TIMEOUT"]
+    last_progress = None
 
-    # Sobel kernels
-    sobel_x = np.array([[-1, 0, 1],
-                        [-2, 0, 2],
-                        [-1, 0, 1]], dtype=np.float32)
+    while time.monotonic() < deadline:
 
-    sobel_y = np.array([[-1, -2, -1],
-                        [ 0,  0,  0],
-                        [ 1,  2,  1]], dtype=np.float32)
+        job = ImageJob.objects.filter(pk=job_id).first()
+        event = job_event(job, last_progress)
 
-    # Pad image
-    padded = np.pad(img, 1, mode="edge")
+        if event is not None:
+            yield event
 
-    # Extract shifted windows (vectorized convolution)
-    gx = (
-        sobel_x[0,0] * padded[:-2, :-2] + sobel_x[0,1] * padded[:-2, 1:-1] + sobel_x[0,2] * padded[:-2, 2:] +
-        sobel_x[1,0] * padded[1:-1, :-2] + sobel_x[1,1] * padded[1:-1, 1:-1] + sobel_x[1,2] * padded[1:-1, 2:] +
-        sobel_x[2,0] * padded[2:, :-2] + sobel_x[2,1] * padded[2:, 1:-1] + sobel_x[2,2] * padded[2:, 2:]
-    )
+        if job is None or job.is_finished:
+            return
 
-    gy = (
-        sobel_y[0,0] * padded[:-2, :-2] + sobel_y[0,1] * padded[:-2, 1:-1] + sobel_y[0,2] * padded[:-2, 2:] +
-        sobel_y[1,0] * padded[1:-1, :-2] + sobel_y[1,1] * padded[1:-1, 1:-1] + sobel_y[1,2] * padded[1:-1, 2:] +
-        sobel_y[2,0] * padded[2:, :-2] + sobel_y[2,1] * padded[2:, 1:-1] + sobel_y[2,2] * padded[2:, 2:]
-    )
+        last_progress = job.progress
 
-    # Gradient magnitude
-    magnitude = np.sqrt(gx**2 + gy**2)
+        time.sleep(config["EVENTS_POLL_INTERVAL"])
 
-    # Normalize
-    magnitude = (magnitude / magnitude.max()) * 255
+    yield "event: timeout\ndata: {}\n\n"
 
-    return Image.fromarray(magnitude.astype(np.uint8))
 
 
+async def astream_job_events(job_id):
 
+    config = jobs_config()
 
-def channel_splitting(original_image_array):
+    deadline = time.monotonic() + config["EVENTS_TIMEOUT"]
+    last_progress = None
 
-    """
-    Takes a numpy array and Returns Red, Green & Blue Only Channel Images and also Returns the Channel Contribution of R,G,B
-    """
+    while time.monotonic() < deadline:
 
-    # Extract the R, G, B Arrays
+        job = await ImageJob.objects.filter(pk=job_id).afirst()
+        event = job_event(job, last_progress)
 
-    R = original_image_array[:,:,0]
-    G = original_image_array[:,:,1]
-    B = original_image_array[:,:,2]
+        if event is not None:
+            yield event
 
-    
-    # Image from Red Channel
-    zeros_original = np.zeros_like(original_image_array) # Creates the New array of same shape as Original Image Array (H,W,C)
-    zeros_original[:,:,0] = R # Fill in the Values for Red Channel and Kepp all others Zero
-    
-    red_only_image = image_to_base64(Image.fromarray(zeros_original)) # Form an Image from Three Channels, but only Red will dominate because all other channels are Zero
+        if job is None or job.is_finished:
+            return
 
-    # Image from Green Channel
-    zeros_original = np.zeros_like(original_image_array) # Creates the New array of same shape as Original Image Array (H,W,C)
-    zeros_original[:,:,1] = G # Fill in the Values for Green Channel and Kepp all others Zero
-    
-    green_only_image = image_to_base64(Image.fromarray(zeros_original)) # Form an Image from Three Channels, but only Red will dominate because all other channels are Zero
+        last_progress = job.progress
 
-    # Image from Blue Channel
-    zeros_original = np.zeros_like(original_image_array) # Creates the New array of same shape as Original Image Array (H,W,C)
-    zeros_original[:,:,2] = B # Fill in the Values for Blue Channel and Kepp all others Zero
-    
-    blue_only_image = image_to_base64(Image.fromarray(zeros_original)) # Form an Image from Three Channels, but only Red will dominate because all other channels are Zero
+        await asyncio.sleep(config["EVENTS_POLL_INTERVAL"])
 
+    yield "event: timeout\ndata: {}\n\n"
 
-    # Now Checking the Contribution of Each Channel
 
-    total_sum = np.sum(original_image_array) # Calculate The Sum of All the Channels of Image
 
-    # Calculate Sum of Individual Channels
-    red_channel_sum = np.sum(R)
-    green_channel_sum = np.sum(G)
-    blue_channel_sum = np.sum(B)
 
-    # Calculate The Ratio And Get the Percentage Contribution of Each Channel
-    red_channel_contribution = ((red_channel_sum / total_sum) * 100).round(2)
-    green_channel_contribution = ((green_channel_sum / total_sum) * 100).round(2)
-    blue_channel_contribution = ((blue_channel_sum / total_sum) * 100).round(2)
+class ImageStoreStats(APIView):
 
+    permission_classes = [IsAdminUser]
 
-    return [(red_only_image,green_only_image,blue_only_image),(red_channel_contribution,green_channel_contribution,blue_channel_contribution)]
+    def get(self, request):
 
+        return Response(image_store.stats(), status=status.HTTP_200_OK)
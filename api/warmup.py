@@ -0,0 +1,151 @@
+# warmup.py
+import os
+import importlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_started
+
+
+logger = logging.getLogger(__name__)
+
+
+# Post-fork warmup of a server worker.
+#
+# The heavy dependencies (matplotlib for the saturation kernel, premailer with lxml and
+# cssutils for the emails) are imported where they are first used, so a worker answers
+# its first requests without paying for them at boot. image_processing/wsgi.py and asgi.py
+# call warm_up_on_first_request() once the application is built, and the first request a
+# process serves starts a daemon thread importing them and compiling the email templates
+# while the worker already answers. The thread isn't started at import: a preforking
+# server (gunicorn --preload) imports the application in its master, which doesn't serve,
+# and its forked workers would neither have the thread nor safely inherit the locks it
+# holds. A request that needs one of the modules before the thread got there waits on the
+# import lock, never on a second import. `manage.py bench_startup` keeps the boot in budget.
+
+
+DEFAULT_WARMUP = {
+    "ENABLED": True,
+    "MODULES": ["matplotlib.colors", "premailer"],    # Imported in the background after boot
+    "EMAIL_TEMPLATES": ["otp.html"],                  # CSS inlined and compiled in the background
+}
+
+
+def warmup_config():
+
+    return {**DEFAULT_WARMUP, **getattr(settings, "WARMUP", {})}
+
+
+
+
+def warm_up():
+
+    """
+    Imports The Deferred Modules and Compiles The Email Templates, Returns What Each Took (Seconds)
+    """
+
+    config = warmup_config()
+
+    timings = {}
+
+    for name in config["MODULES"]:
+
+        started = time.perf_counter()
+
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            # Left to fail where it is used, with the error of the request that needed it
+            logger.exception("Warmup could not import %s", name)
+            continue
+
+        timings[name] = time.perf_counter() - started
+
+    if config["EMAIL_TEMPLATES"]:
+
+        from authentication.emails import templates
+
+        for template_name in config["EMAIL_TEMPLATES"]:
+
+            started = time.perf_counter()
+
+            try:
+                templates.get(template_name)
+            except Exception:
+                logger.exception("Warmup could not compile %s", template_name)
+                continue
+
+            timings[template_name] = time.perf_counter() - started
+
+    return timings
+
+
+
+def warm_up_in_background():
+
+    """
+    Runs warm_up() On a Daemon Thread, Once Per Process. Returns The Thread, or None When Disabled
+    """
+
+    global _thread
+
+    if not warmup_config()["ENABLED"]:
+        return None
+
+    with _lock:
+
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name="warmup", daemon=True)
+            _thread.start()
+
+    return _thread
+
+
+
+def warm_up_on_first_request():
+
+    """
+    Starts warm_up_in_background() When The Process Serves Its First Request, After Any Fork
+    """
+
+    if warmup_config()["ENABLED"]:
+        request_started.connect(_warm_up_on_request, dispatch_uid="api.warmup")
+
+
+
+def _warm_up_on_request(sender, **kwargs):
+
+    # Already started in this process, the common case stays a single check
+    if _thread is None:
+        warm_up_in_background()
+
+
+
+def _run():
+
+    started = time.perf_counter()
+
+    timings = warm_up()
+
+    logger.info(
+        "Warmup done in %.0f ms (%s)", (time.perf_counter() - started) * 1000,
+        ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in timings.items()),
+    )
+
+
+def _forget_parent_thread():
+
+    # A forked child has none of its parent's threads, and a lock one of them held stays held
+    global _thread, _lock
+
+    _thread = None
+    _lock = threading.Lock()
+
+
+_thread = None
+_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_parent_thread)
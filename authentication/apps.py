@@ -4,3 +4,15 @@ from django.apps import AppConfig
 class AuthenticationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'authentication'
+
+    def ready(self):
+
+        # Connects the connection_created receiver applying settings.SQLITE_PROFILE
+        from . import db  # noqa: F401
+
+        # Periodic background work, it only starts running once the executor is first used
+        from .tasks import background, background_config, prune_expired_attempts
+        from .ratelimit import audit_buffer
+
+        background.every(background_config()["SWEEP_INTERVAL"], prune_expired_attempts)
+        background.every(audit_buffer.flush_interval, audit_buffer.flush)
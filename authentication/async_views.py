@@ -0,0 +1,45 @@
+# async_views.py
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from rest_framework import status
+
+from .hashers import hashing_pool, HashingSaturated
+from .views import UserLoginView, UserRegistrationView
+
+
+# Async variants of the endpoints that hash passwords. The whole view runs on the bounded
+# hashing pool (authentication/hashers.py), so a burst of logins waits for a hashing
+# thread instead of occupying the request workers the image endpoints need, and a full
+# pool answers 503 with Retry-After.
+
+
+
+
+def hashing_view(view_class):
+
+    """
+    Builds The Async View Running a DRF View On The Hashing Pool
+    """
+
+    view = view_class.as_view()
+
+    @csrf_exempt
+    @require_POST
+    async def async_view(request):
+
+        try:
+            return await hashing_pool.run(view, request)
+        except HashingSaturated as e:
+            response = JsonResponse({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            response["Retry-After"] = str(hashing_pool.retry_after)
+            return response
+
+    async_view.__name__ = view_class.__name__
+
+    return async_view
+
+
+
+user_login = hashing_view(UserLoginView)
+user_register = hashing_view(UserRegistrationView)
@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+# PRAGMAs applied to every new SQLite connection, picked by settings.SQLITE_PROFILE.
+#
+# "production" switches to write-ahead logging, so readers never block the writer and the
+# writer never blocks readers, syncs on checkpoints instead of every commit, and waits for
+# a busy database instead of failing with "database is locked" straight away.
+# "default" is SQLite's own behaviour, used unless the deployment sets SQLITE_PROFILE=production
+# and kept for comparisons (bench_auth_concurrency)
+
+SQLITE_PROFILES = {
+    "default": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+    },
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,     # Milliseconds
+    },
+}
+
+
+def sqlite_pragmas():
+
+    return SQLITE_PROFILES[getattr(settings, "SQLITE_PROFILE", "default")]
+
+
+
+@receiver(connection_created)
+def apply_sqlite_profile(sender, connection, **kwargs):
+
+    if connection.vendor != "sqlite":
+        return
+
+    with connection.cursor() as cursor:
+
+        for pragma, value in sqlite_pragmas().items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
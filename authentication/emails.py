@@ -0,0 +1,223 @@
+import time
+import queue
+import logging
+import threading
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.template import engines
+from django.template.loader import get_template
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_EMAIL_DELIVERY = {
+    "CONNECTIONS": 2,        # Open connections kept for reuse, matches the background workers
+    "MAX_IDLE": 60,          # Seconds an unused connection is kept before it is closed and reopened
+    "CACHE_TEMPLATES": True, # Inline the CSS of a template once and keep the compiled result
+}
+
+
+def email_delivery_config():
+
+    return {**DEFAULT_EMAIL_DELIVERY, **getattr(settings, "EMAIL_DELIVERY", {})}
+
+
+
+
+class InlinedTemplates:
+
+    """
+    Compiled Email Templates With Their CSS Already Inlined.
+
+    premailer runs on the template source the first time a template is used, and the
+    inlined source is compiled once, so each send only substitutes the variables.
+    """
+
+    def __init__(self, cache=True):
+
+        self.cache = cache
+
+        self._templates = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, template_name):
+
+        template = self._templates.get(template_name)
+
+        if template is None:
+
+            template = self.compile(template_name)
+
+            if self.cache:
+                with self._lock:
+                    self._templates[template_name] = template
+
+        return template
+
+
+    def compile(self, template_name):
+
+        from premailer import transform
+
+        source = get_template(template_name).template.source
+
+        inlined = transform(source)
+
+        return engines["django"].from_string(inlined)
+
+
+    def render(self, template_name, context):
+
+        return self.get(template_name).render(context)
+
+
+    def clear(self):
+
+        with self._lock:
+            self._templates.clear()
+
+
+
+
+class ConnectionPool:
+
+    """
+    Reused Mail Backend Connections.
+
+    Each send borrows an open connection and returns it afterwards, so consecutive emails
+    share one SMTP session instead of connecting and logging in every time. Connections
+    idle for longer than max_idle are closed, since servers drop them anyway.
+    """
+
+    def __init__(self, size, max_idle):
+
+        self.max_idle = max_idle
+
+        self._idle = queue.LifoQueue(maxsize=size)
+
+        self.opened = 0
+        self.reused = 0
+        self.sent = 0
+
+
+    def _borrow(self):
+
+        while True:
+
+            try:
+                connection, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                break
+
+            if time.monotonic() - last_used <= self.max_idle:
+                self.reused += 1
+                return connection
+
+            self._close(connection)
+
+        connection = get_connection()
+        connection.open()
+        self.opened += 1
+
+        return connection
+
+
+    def _give_back(self, connection):
+
+        try:
+            self._idle.put_nowait((connection, time.monotonic()))
+        except queue.Full:
+            self._close(connection)
+
+
+    def _close(self, connection):
+
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+    def send(self, message):
+
+        """
+        Sends The Message on a Pooled Connection, Retrying Once on a Fresh One if a Reused Connection Fails
+        """
+
+        connection = self._borrow()
+
+        try:
+            connection.send_messages([message])
+
+        except Exception:
+
+            logger.warning("Mail connection failed, retrying on a new one", exc_info=True)
+
+            self._close(connection)
+
+            connection = get_connection()
+            connection.open()
+            self.opened += 1
+
+            try:
+                connection.send_messages([message])
+            except Exception:
+                self._close(connection)
+                raise
+
+        self.sent += 1
+
+        self._give_back(connection)
+
+
+    def close(self):
+
+        while True:
+
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+
+            self._close(connection)
+
+
+    def stats(self):
+
+        return {
+            "idle": self._idle.qsize(),
+            "opened": self.opened,
+            "reused": self.reused,
+            "sent": self.sent,
+        }
+
+
+
+
+def send_templated_email(user_email : str, subject : str, template_name : str, context : dict):
+
+    """
+    Renders an Email Template With Inlined CSS and Sends It as HTML on a Pooled Connection
+    """
+
+    email = EmailMessage(subject, templates.render(template_name, context), settings.EMAIL_HOST_USER, [user_email])
+    email.content_subtype = "html"
+
+    connection_pool.send(email)
+
+
+
+def _build_delivery():
+
+    config = email_delivery_config()
+
+    return (
+        InlinedTemplates(cache=config["CACHE_TEMPLATES"]),
+        ConnectionPool(size=config["CONNECTIONS"], max_idle=config["MAX_IDLE"]),
+    )
+
+
+templates, connection_pool = _build_delivery()
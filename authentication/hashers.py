@@ -0,0 +1,165 @@
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import Argon2PasswordHasher
+from django.db import close_old_connections
+
+
+DEFAULT_PASSWORD_HASHING = {
+    "ARGON2": {                      # Django's defaults, see the calibrate_password_hasher command
+        "TIME_COST": 2,
+        "MEMORY_COST": 102400,       # KiB
+        "PARALLELISM": 8,
+    },
+    "WORKERS": min(4, os.cpu_count() or 1),  # Concurrent hashes, each one holds MEMORY_COST
+    "MAX_QUEUE": 64,                 # Logins waiting for a worker before we answer 503
+    "RETRY_AFTER": 1,                # Seconds, sent back in the Retry-After header
+}
+
+
+def password_hashing_config():
+
+    configured = getattr(settings, "PASSWORD_HASHING", {})
+
+    return {
+        **DEFAULT_PASSWORD_HASHING,
+        **configured,
+        "ARGON2": {**DEFAULT_PASSWORD_HASHING["ARGON2"], **configured.get("ARGON2", {})},
+    }
+
+
+
+
+class TunedArgon2PasswordHasher(Argon2PasswordHasher):
+
+    """
+    Argon2 With The Cost Parameters Taken From settings.PASSWORD_HASHING["ARGON2"].
+
+    The algorithm name stays "argon2", so existing hashes keep verifying, and must_update
+    compares a hash's parameters against these, so a user whose hash was made with other
+    costs is rehashed on their next successful login.
+    """
+
+    def __init__(self):
+
+        params = password_hashing_config()["ARGON2"]
+
+        self.time_cost = params["TIME_COST"]
+        self.memory_cost = params["MEMORY_COST"]
+        self.parallelism = params["PARALLELISM"]
+
+
+
+
+class HashingSaturated(Exception):
+
+    """
+    Raised when the hashing pool queue is full. Maps to 503
+    """
+
+
+
+class HashingPool:
+
+    """
+    Bounded Thread Pool For Password Hashing.
+
+    argon2 releases the GIL while it hashes, so a few threads hash in parallel without
+    holding up the request workers. The pool counts work that is queued or running and
+    refuses new work past max_queue instead of letting a login spike pile up.
+    """
+
+    def __init__(self, workers, max_queue, retry_after):
+
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+
+        self._executor = None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+        self.completed = 0
+        self.rejected = 0
+
+
+    @property
+    def executor(self):
+
+        if self._executor is None:
+
+            with self._lock:
+
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hashing")
+
+        return self._executor
+
+
+    def submit(self, fn, *args, **kwargs):
+
+        """
+        Submits fn(*args, **kwargs) and Returns a concurrent.futures.Future
+        """
+
+        with self._lock:
+
+            if self._in_flight >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise HashingSaturated("Too many logins in progress")
+
+            self._in_flight += 1
+
+        future = self.executor.submit(self._run, fn, args, kwargs)
+        future.add_done_callback(self._release)
+
+        return future
+
+
+    async def run(self, fn, *args, **kwargs):
+
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+
+    def _run(self, fn, args, kwargs):
+
+        # The work may touch the database, the pool threads manage their own connections
+        close_old_connections()
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+
+    def _release(self, future):
+
+        with self._lock:
+            self._in_flight -= 1
+            self.completed += 1
+
+
+    def stats(self):
+
+        return {
+            "workers": self.workers,
+            "in_flight": self._in_flight,
+            "max_queue": self.max_queue,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+
+
+def _build_hashing_pool():
+
+    config = password_hashing_config()
+
+    return HashingPool(workers=config["WORKERS"], max_queue=config["MAX_QUEUE"], retry_after=config["RETRY_AFTER"])
+
+
+hashing_pool = _build_hashing_pool()
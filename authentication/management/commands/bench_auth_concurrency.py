@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import time
+import logging
+import random
+import subprocess
+import tempfile
+import statistics
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import override_settings, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+
+from authentication.db import SQLITE_PROFILES
+from authentication.models import User
+from authentication.ratelimit import audit_buffer, login_ip_limiter, login_account_limiter, otp_ip_limiter
+from authentication.tasks import background
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Hammers the auth endpoints from parallel clients against a throwaway file-backed SQLite "
+        "database, once per SQLite profile, and reports throughput, latency and failed requests"
+    )
+
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("--threads", type=int, default=16, help="Parallel clients")
+        parser.add_argument("--requests", type=int, default=200, help="Requests per client")
+        parser.add_argument("--users", type=int, default=100, help="Active users seeded for the logins")
+        parser.add_argument("--profiles", nargs="+", default=list(SQLITE_PROFILES), choices=list(SQLITE_PROFILES))
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+
+    def handle(self, *args, **options):
+
+        if connection.vendor != "sqlite":
+            raise CommandError("This benchmark is about SQLite locking, the default database isn't SQLite")
+
+        if options["profiles"] == [settings.SQLITE_PROFILE]:
+            results = {settings.SQLITE_PROFILE: self.bench_profile(settings.SQLITE_PROFILE, options)}
+        else:
+            # Each profile in its own process started with SQLITE_PROFILE, the connection settings
+            # of a profile are read when the settings load, and worker threads keep persistent
+            # connections to the previous database
+            results = {profile: self.bench_in_subprocess(profile, options) for profile in options["profiles"]}
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results))
+            return
+
+        self.stdout.write("")
+        self.stdout.write(f"{'profile':<12} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+
+        for profile, result in results.items():
+            self.stdout.write(
+                f"{profile:<12} {result['throughput']:>8.1f} {result['p50']:>8.2f} {result['p99']:>8.2f} {result['errors']:>7}"
+            )
+
+
+    def bench_in_subprocess(self, profile, options):
+
+        command = [
+            sys.executable, sys.argv[0], "bench_auth_concurrency", "--json", "--profiles", profile,
+            "--threads", str(options["threads"]), "--requests", str(options["requests"]), "--users", str(options["users"]),
+        ]
+
+        output = subprocess.run(command, check=True, capture_output=True, text=True, env={**os.environ, "SQLITE_PROFILE": profile}).stdout
+
+        return json.loads(output.strip().splitlines()[-1])[profile]
+
+
+    def bench_profile(self, profile, options):
+
+        if not options["json"]:
+            self.stdout.write(f"{profile}: {options['threads']} clients x {options['requests']} requests...")
+
+        directory = tempfile.mkdtemp()
+
+        # A real file, the in-memory test database doesn't lock like the deployed one does
+        connection.settings_dict["TEST"]["NAME"] = os.path.join(directory, "bench.sqlite3")
+
+        # The hashing cost would hide the database, MD5 keeps the requests about SQLite
+        overrides = override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+
+        # Every client shares one IP, the failure limits would turn the mix into 429s
+        limiters = (login_ip_limiter, login_account_limiter, otp_ip_limiter)
+        limits = [limiter.limit for limiter in limiters]
+
+        for limiter in limiters:
+            limiter.limit = float("inf")
+
+        # 4xx answers are part of the mix, don't log every one of them
+        request_logger = logging.getLogger("django.request")
+        log_level = request_logger.level
+        request_logger.setLevel(logging.ERROR)
+
+        setup_test_environment()
+        overrides.enable()
+        old_config = setup_databases(verbosity=0, interactive=False)
+
+        try:
+            self.seed(options["users"])
+            connections.close_all()
+
+            timings = []
+            errors = []
+            lock = threading.Lock()
+
+            def client_loop(index):
+
+                client = Client(raise_request_exception=False)
+                local_timings = []
+                local_errors = 0
+
+                for number in range(options["requests"]):
+
+                    start = time.perf_counter()
+                    response = self.request(client, index, number, options["users"])
+                    local_timings.append((time.perf_counter() - start) * 1000)
+
+                    if response.status_code >= 500:
+                        local_errors += 1
+
+                connections.close_all()
+
+                with lock:
+                    timings.extend(local_timings)
+                    errors.append(local_errors)
+
+            threads = [threading.Thread(target=client_loop, args=(index,)) for index in range(options["threads"])]
+
+            start = time.perf_counter()
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            elapsed = time.perf_counter() - start
+
+            # Nothing may still be writing when the database is dropped
+            background.join()
+            audit_buffer.flush()
+
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            overrides.disable()
+            teardown_test_environment()
+
+            request_logger.setLevel(log_level)
+
+            for limiter, limit in zip(limiters, limits):
+                limiter.limit = limit
+
+        timings.sort()
+
+        return {
+            "throughput": len(timings) / elapsed,
+            "p50": statistics.median(timings),
+            "p99": timings[min(len(timings) - 1, int(len(timings) * 0.99))],
+            "errors": sum(errors),
+        }
+
+
+    def seed(self, count):
+
+        users = [User(username=f"bench{index}", email=f"bench{index}@example.com", is_active=True) for index in range(count)]
+
+        for user in users:
+            user.set_password("bench-password")
+
+        User.objects.bulk_create(users)
+
+
+    def request(self, client, index, number, user_count):
+
+        """
+        One Request of The Mix: Logins, Failed Logins, OTP Checks and Registrations
+        """
+
+        kind = random.random()
+
+        if kind < 0.5:
+            email = f"bench{random.randrange(user_count)}@example.com"
+            password = "bench-password" if kind < 0.35 else "wrong-password"
+            return client.post("/authentication/user_login", {"email": email, "password": password}, content_type="application/json")
+
+        if kind < 0.8:
+            data = {"verification_token": f"missing-{index}-{number}", "otp": "0000"}
+            return client.post("/authentication/user_otp_verify", data, content_type="application/json")
+
+        email = f"new-{index}-{number}-{random.getrandbits(32)}@example.com"
+        data = {"username": "new", "email": email, "password": "bench-password", "password2": "bench-password"}
+
+        return client.post("/authentication/user_register", data, content_type="application/json")
@@ -0,0 +1,135 @@
+import time
+import json
+import resource
+import statistics
+import multiprocessing
+
+from argon2 import PasswordHasher
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.hashers import password_hashing_config
+
+
+# KiB, from the OWASP minimum up to a quarter of a GiB
+MEMORY_COSTS = (19456, 47104, 65536, 102400, 262144)
+TIME_COSTS = (1, 2, 3, 4)
+
+
+def measure_peak_memory(time_cost, memory_cost, parallelism):
+
+    """
+    Hashes Once and Returns How Much The Peak RSS of This Process Grew, in KiB.
+    Runs in a fresh child process, so earlier hashes don't hide the growth
+    """
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism).hash("calibration password")
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Measures Argon2 hash latency and memory on this host for a grid of cost parameters, "
+        "and recommends the strongest profile within the latency and memory budgets"
+    )
+
+
+    def add_arguments(self, parser):
+
+        config = password_hashing_config()
+
+        parser.add_argument("--target-ms", type=float, default=50.0, help="Median hash latency budget")
+        parser.add_argument("--memory-budget-mb", type=float, default=512.0, help="Memory all hashing workers may hold at once")
+        parser.add_argument("--workers", type=int, default=config["WORKERS"], help="Concurrent hashes, defaults to PASSWORD_HASHING['WORKERS']")
+        parser.add_argument("--parallelism", type=int, default=1, help="Argon2 lanes per hash, the pool already hashes concurrently")
+        parser.add_argument("--samples", type=int, default=5, help="Hashes timed per profile")
+        parser.add_argument("--json", action="store_true", help="Print the measurements and the recommendation as JSON")
+
+
+    def handle(self, *args, **options):
+
+        memory_budget_kib = options["memory_budget_mb"] * 1024
+
+        results = []
+
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+
+        for memory_cost in MEMORY_COSTS:
+
+            # Not worth timing what the workers couldn't hold at once anyway
+            if memory_cost * options["workers"] > memory_budget_kib:
+                continue
+
+            with context.Pool(1) as pool:
+                peak_kib = pool.apply(measure_peak_memory, (1, memory_cost, options["parallelism"]))
+
+            for time_cost in TIME_COSTS:
+
+                hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=options["parallelism"])
+
+                timings = []
+
+                for _ in range(options["samples"]):
+
+                    start = time.perf_counter()
+                    hasher.hash("calibration password")
+                    timings.append((time.perf_counter() - start) * 1000)
+
+                median_ms = statistics.median(timings)
+
+                results.append({
+                    "time_cost": time_cost,
+                    "memory_cost": memory_cost,
+                    "parallelism": options["parallelism"],
+                    "median_ms": round(median_ms, 2),
+                    "max_ms": round(max(timings), 2),
+                    "peak_rss_kib": peak_kib,
+                    "within_budget": median_ms <= options["target_ms"],
+                })
+
+                # Higher time costs only get slower
+                if median_ms > options["target_ms"]:
+                    break
+
+        candidates = [result for result in results if result["within_budget"]]
+
+        if not candidates:
+            raise CommandError(f"No profile hashes within {options['target_ms']} ms on this host, raise --target-ms")
+
+        # The most work an attacker has to repeat per guess
+        best = max(candidates, key=lambda result: (result["memory_cost"] * result["time_cost"], -result["median_ms"]))
+
+        recommendation = {
+            "ARGON2": {
+                "TIME_COST": best["time_cost"],
+                "MEMORY_COST": best["memory_cost"],
+                "PARALLELISM": best["parallelism"],
+            },
+            "WORKERS": options["workers"],
+        }
+
+        if options["json"]:
+            self.stdout.write(json.dumps({"results": results, "recommendation": recommendation}, indent=2))
+            return
+
+        self.stdout.write(f"{'time':>5} {'memory KiB':>11} {'lanes':>6} {'median ms':>10} {'max ms':>8} {'peak RSS KiB':>13}")
+
+        for result in results:
+
+            marker = " *" if result is best else ""
+
+            self.stdout.write(
+                f"{result['time_cost']:>5} {result['memory_cost']:>11} {result['parallelism']:>6} "
+                f"{result['median_ms']:>10} {result['max_ms']:>8} {result['peak_rss_kib']:>13}{marker}"
+            )
+
+        self.stdout.write("")
+        self.stdout.write(self.style.SUCCESS(
+            f"Recommended for {options['workers']} workers within {options['target_ms']} ms "
+            f"and {options['memory_budget_mb']} MB, merge into settings.PASSWORD_HASHING:"
+        ))
+        self.stdout.write(json.dumps(recommendation, indent=4))
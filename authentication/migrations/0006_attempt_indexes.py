@@ -0,0 +1,29 @@
+# Generated by Django 5.2.9 on 2026-10-19 17:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0005_user_is_staff_member_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='loginattempt',
+            index=models.Index(fields=['ip_address', 'success', 'timestamp'], name='loginattempt_ip_success_ts'),
+        ),
+        migrations.AddIndex(
+            model_name='loginattempt',
+            index=models.Index(fields=['timestamp'], name='loginattempt_timestamp'),
+        ),
+        migrations.AddIndex(
+            model_name='otpverifyattempt',
+            index=models.Index(fields=['ip_address', 'success', 'timestamp'], name='otpattempt_ip_success_ts'),
+        ),
+        migrations.AddIndex(
+            model_name='otpverifyattempt',
+            index=models.Index(fields=['timestamp'], name='otpattempt_timestamp'),
+        ),
+    ]
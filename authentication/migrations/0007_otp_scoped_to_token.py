@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-19 17:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0006_attempt_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='otp',
+            field=models.CharField(blank=True, max_length=4, null=True),
+        ),
+    ]
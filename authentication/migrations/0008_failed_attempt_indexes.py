@@ -0,0 +1,29 @@
+# Generated by Django 5.2.9 on 2026-10-19 18:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0007_otp_scoped_to_token'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='loginattempt',
+            name='loginattempt_ip_success_ts',
+        ),
+        migrations.RemoveIndex(
+            model_name='otpverifyattempt',
+            name='otpattempt_ip_success_ts',
+        ),
+        migrations.AddIndex(
+            model_name='loginattempt',
+            index=models.Index(condition=models.Q(('success', False)), fields=['ip_address', 'timestamp'], name='loginattempt_ip_failed_ts'),
+        ),
+        migrations.AddIndex(
+            model_name='otpverifyattempt',
+            index=models.Index(condition=models.Q(('success', False)), fields=['ip_address', 'timestamp'], name='otpattempt_ip_failed_ts'),
+        ),
+    ]
@@ -63,7 +63,7 @@ class User(AbstractBaseUser):
     user_profile_image = models.ImageField(upload_to="User Profiles", null=True, blank=True, default=None)
     verification_token = models.CharField(blank=True,null=True,unique=True,max_length=60)
     verification_token_expiry = models.DateTimeField(blank=True,null=True)
-    otp = models.CharField(blank=True,null=True,unique=True,max_length=4)
+    otp = models.CharField(blank=True,null=True,max_length=4)
     otp_expiry = models.DateTimeField(blank=True,null=True)
     is_two_factor_authentication_enabled = models.BooleanField(default=False)
     two_factor_pin = models.CharField(max_length=255, blank=True, null=True)
@@ -116,6 +116,21 @@ class User(AbstractBaseUser):
 
 
 
+@receiver(signals.post_save, sender=User)
+@receiver(signals.post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+
+    """
+    Drops The User From The Authentication Cache Whenever It Changes
+    """
+
+    from .user_cache import user_cache
+
+    user_cache.invalidate(instance.pk)
+
+
+
+
 class LoginAttempt(models.Model):
     
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
@@ -123,6 +138,15 @@ class LoginAttempt(models.Model):
     timestamp = models.DateTimeField(default=timezone.now)
     success = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # Failed attempts of an IP within a time range. Partial, because filter(success=False)
+            # compiles to NOT "success", which SQLite can't seek in an index on success
+            models.Index(fields=["ip_address", "timestamp"], condition=models.Q(success=False), name="loginattempt_ip_failed_ts"),
+            # Pruning of rows past their retention
+            models.Index(fields=["timestamp"], name="loginattempt_timestamp"),
+        ]
+
 
 
 
@@ -133,3 +157,9 @@ class OTPVerifyAttempt(models.Model):
     timestamp = models.DateTimeField(default=timezone.now)
     success = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["ip_address", "timestamp"], condition=models.Q(success=False), name="otpattempt_ip_failed_ts"),
+            models.Index(fields=["timestamp"], name="otpattempt_timestamp"),
+        ]
+
@@ -3,9 +3,11 @@ from rest_framework.exceptions import PermissionDenied
 
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.models import TokenUser
 from rest_framework_simplejwt.tokens import AccessToken
 
 from authentication.models import User
+from authentication.user_cache import user_cache, user_cache_config
 
 
 class CookieJWTAuthentication(BaseAuthentication):
@@ -20,11 +22,39 @@ class CookieJWTAuthentication(BaseAuthentication):
             # Validate the token
             validated_token = AccessToken(access_token)
 
-            user = User.objects.get(id=validated_token['user_id'])
+            if user_cache_config()["STATELESS"]:
+
+                # Trust the claims of the validated token, no database round trip at all
+                user = TokenUser(validated_token)
+
+            else:
+
+                user = user_cache.get(validated_token['user_id'], lambda user_id: User.objects.get(id=user_id))
 
         except Exception as e:
             
             raise AuthenticationFailed(f'Invalid token or expired token {e}')
 
         # Return the user and token
-        return (user, validated_token)  # Adjust user fetching logic as needed
\ No newline at end of file
+        return (user, validated_token)  # Adjust user fetching logic as needed
+
+
+
+def is_staff_request(request):
+
+    """
+    Staff Check Against The Session User or The JWT Cookie, For Code Running Before or Outside The DRF Views
+    """
+
+    user = getattr(request, "user", None)
+
+    if user is None or not user.is_authenticated:
+
+        try:
+            user_auth_tuple = CookieJWTAuthentication().authenticate(request)
+        except AuthenticationFailed:
+            return False
+
+        user = user_auth_tuple[0] if user_auth_tuple is not None else None
+
+    return user is not None and bool(getattr(user, "is_staff", False))
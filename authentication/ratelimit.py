@@ -0,0 +1,367 @@
+import time
+import math
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.throttling import BaseThrottle
+
+from .tasks import background
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_RATE_LIMITS = {
+    "CACHE": "default",
+    "LOGIN_FAILURES": "5/15m",          # Failed logins per IP and per account
+    "OTP_FAILURES": "5/15m",            # Failed OTP verifications per IP
+    "PLANS": {                           # Image endpoint requests, by User.user_plan
+        "anonymous": "30/m",
+        "": "60/m",
+        "free": "60/m",
+        "pro": "600/m",
+    },
+    "INTERACTIVE_PLANS": {               # Views with throttle_scope = "interactive", e.g. one request per slider move
+        "anonymous": "600/m",
+        "": "1200/m",
+        "free": "1200/m",
+        "pro": "3000/m",
+    },
+    "AUDIT": True,                       # Keep writing LoginAttempt/OTPVerifyAttempt rows, in batches
+    "AUDIT_BATCH_SIZE": 100,
+    "AUDIT_FLUSH_INTERVAL": 2,           # Seconds
+}
+
+
+RATE_PERIODS = {"s": 1, "m": 60, "h": 60 * 60, "d": 60 * 60 * 24}
+
+
+def rate_limits_config():
+
+    configured = getattr(settings, "RATE_LIMITS", {})
+
+    return {
+        **DEFAULT_RATE_LIMITS,
+        **configured,
+        "PLANS": {**DEFAULT_RATE_LIMITS["PLANS"], **configured.get("PLANS", {})},
+        "INTERACTIVE_PLANS": {**DEFAULT_RATE_LIMITS["INTERACTIVE_PLANS"], **configured.get("INTERACTIVE_PLANS", {})},
+    }
+
+
+
+def parse_rate(rate):
+
+    """
+    Parses "5/15m" or "60/min" Into (limit, window seconds)
+    """
+
+    limit, period = rate.split("/")
+
+    digits = len(period) - len(period.lstrip("0123456789"))
+
+    count = int(period[:digits] or 1)
+    unit = period[digits:digits + 1]
+
+    return int(limit), count * RATE_PERIODS[unit]
+
+
+
+
+class SlidingWindowLimiter:
+
+    """
+    Approximate Sliding Window Counter Kept in The Cache.
+
+    Hits are counted in fixed windows, and the previous window is weighted by how much
+    of it still overlaps the sliding window. Two cache keys per client, no database.
+    """
+
+    def __init__(self, prefix, limit, window, cache_alias="default"):
+
+        self.prefix = prefix
+        self.limit = limit
+        self.window = window
+        self.cache_alias = cache_alias
+
+
+    @classmethod
+    def from_rate(cls, prefix, rate, cache_alias="default"):
+
+        limit, window = parse_rate(rate)
+
+        return cls(prefix, limit, window, cache_alias)
+
+
+    @property
+    def cache(self):
+
+        return caches[self.cache_alias]
+
+
+    def _keys(self, key, now):
+
+        index = int(now // self.window)
+
+        return f"ratelimit:{self.prefix}:{key}:{index}", f"ratelimit:{self.prefix}:{key}:{index - 1}", now % self.window
+
+
+    def count(self, key, now=None):
+
+        """
+        Returns The Weighted Number of Hits in The Sliding Window
+        """
+
+        now = time.time() if now is None else now
+
+        current_key, previous_key, elapsed = self._keys(key, now)
+
+        values = self.cache.get_many([current_key, previous_key])
+
+        weight = 1 - elapsed / self.window
+
+        return values.get(current_key, 0) + values.get(previous_key, 0) * weight
+
+
+    def consume(self, key, now=None):
+
+        """
+        Counts a Hit For The Key if It Is Still Under The Limit. Returns Whether It Was.
+        The check and the count are one cache incr, concurrent callers can't both take the last hit
+        """
+
+        now = time.time() if now is None else now
+
+        current_key, previous_key, elapsed = self._keys(key, now)
+
+        current = self._incr(current_key)
+        previous = self.cache.get(previous_key, 0)
+
+        if current + previous * (1 - elapsed / self.window) <= self.limit:
+            return True
+
+        # Over the limit, the refused hit doesn't count
+        self.refund(key, now)
+
+        return False
+
+
+    def refund(self, key, now=None):
+
+        """
+        Takes Back a Hit consume() Counted in The Current Window
+        """
+
+        current_key, _, _ = self._keys(key, time.time() if now is None else now)
+
+        try:
+            self.cache.decr(current_key)
+        except ValueError:
+            pass
+
+
+    def hit(self, key, now=None):
+
+        """
+        Counts a Hit For The Key Whatever The Count
+        """
+
+        self._incr(self._keys(key, time.time() if now is None else now)[0])
+
+
+    def _incr(self, current_key):
+
+        # Two windows, the previous one must still be readable while this one is current
+        timeout = self.window * 2
+
+        if self.cache.add(current_key, 1, timeout=timeout):
+            return 1
+
+        try:
+            return self.cache.incr(current_key)
+        except ValueError:
+            # Expired between the add and the incr
+            self.cache.set(current_key, 1, timeout=timeout)
+            return 1
+
+
+    def retry_after(self, key, now=None):
+
+        """
+        Seconds Until The Key May Take One More Hit
+        """
+
+        now = time.time() if now is None else now
+
+        current_key, previous_key, elapsed = self._keys(key, now)
+
+        values = self.cache.get_many([current_key, previous_key])
+
+        current = values.get(current_key, 0)
+        previous = values.get(previous_key, 0)
+
+        room = self.limit - 1
+
+        if current <= room:
+            # The weight of the previous window has to fall until the current one fits
+            if not previous or current + previous * (1 - elapsed / self.window) <= room:
+                return 0
+
+            wait = self.window * (1 - (room - current) / previous) - elapsed
+
+        else:
+            # Not before the next window, where this one is the previous and has to fall in turn
+            wait = self.window - elapsed + self.window * (1 - max(room, 0) / current)
+
+        return max(1, math.ceil(round(wait, 6)))
+
+
+    def reset(self, key):
+
+        now = time.time()
+
+        current_key, previous_key, _ = self._keys(key, now)
+
+        self.cache.delete_many([current_key, previous_key])
+
+
+
+
+class AuditBuffer:
+
+    """
+    Collects Attempt Rows in Memory and Writes Them With bulk_create in Batches.
+    Full batches are flushed on the background executor, and the rest every
+    flush_interval seconds by the periodic task registered in authentication/apps.py
+    """
+
+    def __init__(self, batch_size, flush_interval):
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._rows = []
+        self._lock = threading.Lock()
+
+
+    def add(self, row):
+
+        with self._lock:
+
+            self._rows.append(row)
+
+            full = len(self._rows) == self.batch_size
+
+        if full:
+            background.submit(self.flush)
+        else:
+            background.start()
+
+
+    def flush(self):
+
+        with self._lock:
+            rows, self._rows = self._rows, []
+
+        if not rows:
+            return
+
+        by_model = {}
+
+        for row in rows:
+            by_model.setdefault(type(row), []).append(row)
+
+        try:
+            # One write transaction per flush, however many models the rows are for
+            with transaction.atomic():
+                for model, model_rows in by_model.items():
+                    model.objects.bulk_create(model_rows)
+        except Exception:
+            logger.exception("Failed to write %s audit rows", len(rows))
+
+
+
+
+class PlanRateThrottle(BaseThrottle):
+
+    """
+    DRF Throttle Limiting Requests Per User, With The Rate Tiered by User.user_plan.
+    Anonymous clients are limited per IP. Views with throttle_scope = "interactive" are
+    counted separately, against INTERACTIVE_PLANS
+    """
+
+    def get_limiter(self, request, scope=None):
+
+        config = rate_limits_config()
+
+        plans = config["INTERACTIVE_PLANS"] if scope == "interactive" else config["PLANS"]
+
+        user = getattr(request, "user", None)
+
+        if user is not None and user.is_authenticated:
+            plan = getattr(user, "user_plan", "") or ""
+            key = f"user:{user.pk}"
+        else:
+            plan = "anonymous"
+            key = f"ip:{self.get_ident(request)}"
+
+        rate = plans.get(plan, plans[""])
+
+        prefix = f"{scope}:{plan}" if scope else f"plan:{plan}"
+
+        return SlidingWindowLimiter.from_rate(prefix, rate, config["CACHE"]), key
+
+
+    def allow_request(self, request, view):
+
+        return self.allow(request, getattr(view, "throttle_scope", None))
+
+
+    def allow(self, request, scope=None):
+
+        """
+        allow_request() For Callers Without a DRF View, Like The Async Image Views
+        """
+
+        limiter, key = self.get_limiter(request, scope)
+
+        if not limiter.consume(key):
+            self._wait = limiter.retry_after(key)
+            return False
+
+        return True
+
+
+    def wait(self):
+
+        return getattr(self, "_wait", None)
+
+
+
+
+def record_attempt(row):
+
+    """
+    Queues a LoginAttempt/OTPVerifyAttempt Row For The Next Batch, if Auditing Is On
+    """
+
+    if rate_limits_config()["AUDIT"]:
+        audit_buffer.add(row)
+
+
+
+def _build_limiters():
+
+    config = rate_limits_config()
+
+    return (
+        SlidingWindowLimiter.from_rate("login:ip", config["LOGIN_FAILURES"], config["CACHE"]),
+        SlidingWindowLimiter.from_rate("login:account", config["LOGIN_FAILURES"], config["CACHE"]),
+        SlidingWindowLimiter.from_rate("otp:ip", config["OTP_FAILURES"], config["CACHE"]),
+        AuditBuffer(config["AUDIT_BATCH_SIZE"], config["AUDIT_FLUSH_INTERVAL"]),
+    )
+
+
+login_ip_limiter, login_account_limiter, otp_ip_limiter, audit_buffer = _build_limiters()
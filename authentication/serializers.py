@@ -38,11 +38,12 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
     
     def create(self, validated_data):
         
-        user = User.objects.create(
+        user = User(
             username=validated_data['username'],
             email=validated_data['email']
         )
 
+        # Hashed before the first save, so the user is written with a single INSERT
         user.set_password(validated_data['password'])
 
         user.save()
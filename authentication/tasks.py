@@ -0,0 +1,247 @@
+import time
+import heapq
+import queue
+import logging
+import itertools
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import LoginAttempt, OTPVerifyAttempt
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BACKGROUND_TASKS = {
+    "WORKERS": 2,
+    "MAX_QUEUE": 1000,             # Tasks waiting for a worker, more are rejected
+    "MAX_RETRIES": 3,
+    "RETRY_BACKOFF": 1.0,          # Seconds, doubled on every retry
+    "SWEEP_INTERVAL": 60 * 5,      # Seconds between prunes of old attempt rows
+    "SWEEP_BATCH_SIZE": 1000,      # Rows deleted per statement while pruning
+    "ATTEMPT_RETENTION": 60 * 60 * 24 * 7,  # Seconds attempt rows are kept for auditing
+}
+
+
+def background_config():
+
+    return {**DEFAULT_BACKGROUND_TASKS, **getattr(settings, "BACKGROUND_TASKS", {})}
+
+
+
+
+class BackgroundExecutor:
+
+    """
+    Shared Executor For Work That Shouldn't Hold Up a Request.
+
+    A fixed number of worker threads take tasks from a bounded queue. Workers manage their
+    own database connections, failed tasks are retried with exponential backoff, and a
+    timer thread runs periodic tasks and delayed retries. Threads start on first use.
+    """
+
+    def __init__(self, workers, max_queue, max_retries, retry_backoff):
+
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._timers = []
+        self._timer_sequence = itertools.count()
+        self._timer_wakeup = threading.Condition()
+        self._periodic = []
+        self._started = False
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+
+
+    def submit(self, fn, *args, retries=None, **kwargs):
+
+        """
+        Queues fn(*args, **kwargs). Returns False When The Queue Is Full and The Task Was Dropped
+        """
+
+        self.start()
+
+        task = (fn, args, kwargs, self.max_retries if retries is None else retries, 0)
+
+        try:
+            self._queue.put_nowait(task)
+        except queue.Full:
+            self.rejected += 1
+            logger.warning("Background queue is full, dropped %s", getattr(fn, "__name__", fn))
+            return False
+
+        self.submitted += 1
+
+        return True
+
+
+    def every(self, interval, fn):
+
+        """
+        Registers fn To Run Every `interval` Seconds Once The Executor Has Started
+        """
+
+        with self._lock:
+
+            self._periodic.append((interval, fn))
+
+            if self._started:
+                self._schedule(interval, ("periodic", interval, fn))
+
+
+    def start(self):
+
+        if self._started:
+            return
+
+        with self._lock:
+
+            if self._started:
+                return
+
+            for index in range(self.workers):
+                threading.Thread(target=self._work, name=f"background-{index}", daemon=True).start()
+
+            threading.Thread(target=self._run_timers, name="background-timer", daemon=True).start()
+
+            for interval, fn in self._periodic:
+                self._schedule(interval, ("periodic", interval, fn))
+
+            self._started = True
+
+
+    def join(self):
+
+        """
+        Blocks Until Every Queued Task Has Run, Delayed Retries Excluded
+        """
+
+        self._queue.join()
+
+
+    def stats(self):
+
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self._queue.maxsize,
+            "scheduled": len(self._timers),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "rejected": self.rejected,
+        }
+
+
+    def _work(self):
+
+        while True:
+
+            fn, args, kwargs, retries, attempt = self._queue.get()
+
+            # Every task gets a usable connection and leaves none behind
+            close_old_connections()
+
+            try:
+                fn(*args, **kwargs)
+                self.completed += 1
+
+            except Exception:
+
+                if attempt < retries:
+                    self.retried += 1
+                    delay = self.retry_backoff * (2 ** attempt)
+                    self._schedule(delay, ("task", (fn, args, kwargs, retries, attempt + 1)))
+                else:
+                    self.failed += 1
+                    logger.exception("Background task %s failed after %s attempts", getattr(fn, "__name__", fn), attempt + 1)
+
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+
+    def _schedule(self, delay, entry):
+
+        with self._timer_wakeup:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_sequence), entry))
+            self._timer_wakeup.notify()
+
+
+    def _run_timers(self):
+
+        while True:
+
+            with self._timer_wakeup:
+
+                while not self._timers or self._timers[0][0] > time.monotonic():
+                    timeout = self._timers[0][0] - time.monotonic() if self._timers else None
+                    self._timer_wakeup.wait(timeout)
+
+                _, _, entry = heapq.heappop(self._timers)
+
+            if entry[0] == "periodic":
+
+                _, interval, fn = entry
+
+                self.submit(fn, retries=0)
+                self._schedule(interval, entry)
+
+            else:
+
+                try:
+                    self._queue.put_nowait(entry[1])
+                except queue.Full:
+                    self.rejected += 1
+
+
+
+
+def prune_expired_attempts():
+
+    """
+    Deletes Attempt Rows Older Than The Retention, a Batch of Primary Keys at a Time
+    """
+
+    config = background_config()
+
+    threshold = timezone.now() - timedelta(seconds=config["ATTEMPT_RETENTION"])
+
+    for model in (LoginAttempt, OTPVerifyAttempt):
+
+        while True:
+
+            ids = list(model.objects.filter(timestamp__lt=threshold).values_list("pk", flat=True)[:config["SWEEP_BATCH_SIZE"]])
+
+            if not ids:
+                break
+
+            model.objects.filter(pk__in=ids).delete()
+
+
+
+def _build_executor():
+
+    config = background_config()
+
+    return BackgroundExecutor(
+        workers=config["WORKERS"],
+        max_queue=config["MAX_QUEUE"],
+        max_retries=config["MAX_RETRIES"],
+        retry_backoff=config["RETRY_BACKOFF"],
+    )
+
+
+background = _build_executor()
@@ -1,3 +1,929 @@
-from django.test import TestCase
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.hashers import Argon2PasswordHasher, make_password
+from django.contrib.auth.models import AnonymousUser
+from django.core import mail
+from django.core.cache import caches
+from django.core.mail import EmailMessage
+from django.db import connection, connections
+from django.template.loader import render_to_string
+from django.test import TestCase, RequestFactory, override_settings
+from django.utils import timezone
+from premailer import transform
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .emails import InlinedTemplates, ConnectionPool
+from .hashers import TunedArgon2PasswordHasher, HashingPool, HashingSaturated, hashing_pool
+from .models import User, LoginAttempt, OTPVerifyAttempt
+from .permissions import CookieJWTAuthentication
+from .ratelimit import SlidingWindowLimiter, PlanRateThrottle, parse_rate, login_ip_limiter
+from .tasks import BackgroundExecutor, prune_expired_attempts
+from .user_cache import UserCache, USER_TOKEN_CLAIMS, user_cache
+from .views import generate_user_tokens
+
+
+def freeze_clock(test, offset=30):
+
+    """
+    Stops The Wall Clock The Limiters Count Windows By at offset Seconds Into an Hour, For The Test
+    """
+
+    now = time.time() // 3600 * 3600 + offset
+
+    clock = mock.patch("authentication.ratelimit.time.time", return_value=now)
+    clock.start()
+    test.addCleanup(clock.stop)
+
+    return now
+
+
+
+
+class SlidingWindowLimiterTests(TestCase):
+
+    def setUp(self):
+
+        caches["default"].clear()
+
+        # The cache expires entries by the same clock
+        self.now = freeze_clock(self)
+
+        self.limiter = SlidingWindowLimiter("test", limit=3, window=60)
+
+
+    def test_parse_rate(self):
+
+        self.assertEqual(parse_rate("5/15m"), (5, 15 * 60))
+        self.assertEqual(parse_rate("60/min"), (60, 60))
+        self.assertEqual(parse_rate("1000/d"), (1000, 60 * 60 * 24))
+
+
+    def test_consumes_up_to_the_limit(self):
+
+        self.assertEqual([self.limiter.consume("client") for _ in range(5)], [True, True, True, False, False])
+
+        # Refused hits aren't counted
+        self.assertEqual(self.limiter.count("client"), 3)
+        self.assertTrue(self.limiter.consume("other-client"))
+
+
+    def test_concurrent_consumers_share_the_limit(self):
+
+        results = []
+        start = threading.Barrier(12)
+
+        def consume():
+            start.wait()
+            results.append(self.limiter.consume("client"))
+
+        threads = [threading.Thread(target=consume) for _ in range(12)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count(True), 3)
+
+
+    def test_previous_window_counts_by_its_overlap(self):
+
+        window_start = self.now - 30
+
+        for _ in range(3):
+            self.limiter.hit("client", now=window_start + 59)
+
+        # 15 seconds into the next window, three quarters of the previous one still overlap
+        self.assertAlmostEqual(self.limiter.count("client", now=window_start + 75), 3 * 0.75)
+
+        # Once the window after that starts, the hits are forgotten
+        self.assertEqual(self.limiter.count("client", now=window_start + 121), 0)
+
+
+    def test_retry_after_waits_for_the_previous_window_to_fall(self):
+
+        window_start = self.now - 30
+
+        for _ in range(3):
+            self.limiter.consume("client", now=window_start + 10)
+
+        # 50 s to the next window, then 20 s until 3 hits weigh no more than 2
+        wait = self.limiter.retry_after("client", now=window_start + 10)
+
+        self.assertEqual(wait, 70)
+        self.assertFalse(self.limiter.consume("client", now=window_start + 10 + wait - 1))
+        self.assertTrue(self.limiter.consume("client", now=window_start + 10 + wait))
+
+        # The previous window alone still weighs 3 * 0.75 at 15 s, it falls to 2 at 20 s
+        for _ in range(3):
+            self.limiter.hit("other-client", now=window_start + 59)
+
+        self.assertEqual(self.limiter.retry_after("other-client", now=window_start + 75), 5)
+        self.assertTrue(self.limiter.consume("other-client", now=window_start + 80))
+
+
+    def test_reset(self):
+
+        for _ in range(3):
+            self.limiter.consume("client")
+
+        self.limiter.reset("client")
+
+        self.assertTrue(self.limiter.consume("client"))
+
+
+
+
+class PlanRateThrottleTests(TestCase):
+
+    def setUp(self):
+
+        caches["default"].clear()
+
+        freeze_clock(self)
+
+        self.request = RequestFactory().post("/", REMOTE_ADDR="10.0.0.1")
+        self.request.user = AnonymousUser()
+
+
+    def allowed(self, count, scope=None):
+
+        throttle = PlanRateThrottle()
+
+        return sum(throttle.allow(self.request, scope) for _ in range(count))
+
+
+    def test_anonymous_clients_are_limited_per_ip(self):
+
+        self.assertEqual(self.allowed(40), 30)
+
+        other = RequestFactory().post("/", REMOTE_ADDR="10.0.0.2")
+        other.user = AnonymousUser()
+
+        self.assertTrue(PlanRateThrottle().allow(other))
+
+
+    def test_interactive_scope_has_its_own_budget(self):
+
+        self.assertEqual(self.allowed(30), 30)
+
+        # The default budget is used up, slider moves still go through
+        self.assertEqual(self.allowed(100, "interactive"), 100)
+
+
+
+
+class LoginAttemptLimitTests(TestCase):
+
+    def setUp(self):
+
+        caches["default"].clear()
+        freeze_clock(self)
+
+        self.user = User.objects.create_user(email="limited@example.com", username="limited", password="correct-password")
+        self.user.is_active = True
+        self.user.save()
+
+        audit = mock.patch("authentication.views.record_attempt")
+        audit.start()
+        self.addCleanup(audit.stop)
+
+
+    def login(self, password, ip="10.0.0.1"):
+
+        return self.client.post("/authentication/user_login", {"email": "limited@example.com", "password": password}, REMOTE_ADDR=ip, content_type="application/json")
+
+
+    def test_failures_are_limited_and_a_success_clears_them(self):
+
+        for _ in range(4):
+            self.assertEqual(self.login("wrong").status_code, 400)
+
+        self.assertEqual(self.login("correct-password").status_code, 200)
+
+        # The success cleared the four failures
+        self.assertEqual([self.login("wrong").status_code for _ in range(6)], [400] * 5 + [429])
+
+        self.assertEqual(self.login("correct-password").status_code, 429)
+
+
+    def test_account_is_limited_across_ips(self):
+
+        for index in range(5):
+            self.assertEqual(self.login("wrong", ip=f"10.0.1.{index}").status_code, 400)
+
+        self.assertEqual(self.login("correct-password", ip="10.0.2.1").status_code, 429)
+
+        # The refused attempt wasn't held against the new IP address
+        self.assertEqual(login_ip_limiter.count("10.0.2.1"), 0)
+
+
+
+
+class UserCacheTests(TestCase):
+
+    def setUp(self):
+
+        user_cache.clear()
+
+        self.user = User.objects.create_user(email="cached@example.com", username="cached", password="password")
+
+
+    def authenticate(self, token):
+
+        request = RequestFactory().get("/")
+        request.COOKIES["access"] = str(token)
+
+        return CookieJWTAuthentication().authenticate(request)[0]
+
+
+    def test_hits_return_copies_without_loading(self):
+
+        cache = UserCache(max_users=10, ttl=60)
+        loader = mock.Mock(return_value=self.user)
+
+        first = cache.get(self.user.pk, loader)
+        second = cache.get(self.user.pk, loader)
+
+        loader.assert_called_once_with(self.user.pk)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "users": 1})
+
+        # A view changing request.user doesn't change the cached user
+        first.user_plan = "pro"
+
+        self.assertIsNot(first, second)
+        self.assertEqual(cache.get(self.user.pk, loader).user_plan, self.user.user_plan)
+
+
+    def test_saving_a_user_drops_it_from_the_cache(self):
+
+        token = AccessToken.for_user(self.user)
+
+        self.authenticate(token)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate(token).user_plan, self.user.user_plan)
+
+        self.user.user_plan = "pro"
+        self.user.save()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate(token).user_plan, "pro")
+
+
+    def test_load_racing_with_a_save_is_not_cached(self):
+
+        cache = UserCache(max_users=10, ttl=60)
+
+        def load_then_saved_elsewhere(user_id):
+
+            stale = User.objects.get(pk=user_id)
+
+            # The user is saved while this load is on its way back
+            cache.invalidate(user_id)
+
+            return stale
+
+        cache.get(self.user.pk, load_then_saved_elsewhere)
+
+        loader = mock.Mock(return_value=self.user)
+        cache.get(self.user.pk, loader)
+
+        loader.assert_called_once()
+
+
+    def test_other_processes_see_changes_after_the_ttl(self):
+
+        # The cache of another worker, the receivers never reach it
+        other_worker = UserCache(max_users=10, ttl=0.05)
+        load = lambda user_id: User.objects.get(pk=user_id)
+
+        other_worker.get(self.user.pk, load)
+
+        self.user.user_plan = "pro"
+        self.user.save()
+
+        self.assertNotEqual(other_worker.get(self.user.pk, load).user_plan, "pro")
+
+        time.sleep(0.1)
+
+        self.assertEqual(other_worker.get(self.user.pk, load).user_plan, "pro")
+
+
+    @override_settings(USER_CACHE={"STATELESS": True})
+    def test_stateless_users_carry_their_claims(self):
+
+        self.user.user_plan = "pro"
+        self.user.is_staff_member = True
+        self.user.save()
+
+        access = generate_user_tokens(self.user)["access"]
+
+        with self.assertNumQueries(0):
+            user = self.authenticate(access)
+
+        self.assertIsInstance(user, TokenUser)
+        self.assertEqual(
+            {claim: getattr(user, claim) for claim in USER_TOKEN_CLAIMS},
+            {"username": "cached", "email": "cached@example.com", "user_plan": "pro", "is_staff": True},
+        )
+        self.assertEqual(str(user.pk), str(self.user.pk))
+
+        # Claims are frozen at issue, a demotion shows once the token is replaced
+        self.user.is_staff_member = False
+        self.user.save()
+
+        self.assertTrue(self.authenticate(access).is_staff)
+        self.assertFalse(self.authenticate(generate_user_tokens(self.user)["access"]).is_staff)
+
+
+
+
+class AccountFlowTests(TestCase):
+
+    def setUp(self):
+
+        caches["default"].clear()
+        freeze_clock(self)
+
+        # Emails go out inline instead of on the background workers
+        inline = mock.patch("authentication.views.background.submit", side_effect=lambda fn, *args, **kwargs: fn(*args, **kwargs))
+        inline.start()
+        self.addCleanup(inline.stop)
+
+        audit = mock.patch("authentication.views.record_attempt")
+        audit.start()
+        self.addCleanup(audit.stop)
+
+
+    def post(self, path, data):
+
+        return self.client.post(f"/authentication/{path}", data, content_type="application/json")
+
+
+    def register(self):
+
+        response = self.post("user_register", {"username": "flow", "email": "flow@example.com", "password": "flow-password", "password2": "flow-password"})
+
+        self.assertEqual(response.status_code, 201, response.content)
+
+        return response.json()["verification_token"]
+
+
+    def emailed_otp(self):
+
+        self.assertEqual(mail.outbox[-1].to, ["flow@example.com"])
+
+        # One digit per box in otp.html
+        otp = "".join(re.findall(r">(\d)</span>", mail.outbox[-1].body))
+
+        self.assertEqual(otp, User.objects.get(email="flow@example.com").otp)
+
+        return otp
+
+
+    def wrong(self, otp):
+
+        return "0000" if otp != "0000" else "1111"
+
+
+    def test_register_then_verify(self):
+
+        token = self.register()
+
+        user = User.objects.get(email="flow@example.com")
+
+        self.assertFalse(user.is_active)
+        self.assertEqual(user.verification_token, token)
+        self.assertTrue(user.check_password("flow-password"))
+
+        otp = self.emailed_otp()
+
+        response = self.post("user_otp_verify", {"verification_token": token, "otp": otp})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertIn("access", response.cookies)
+        self.assertIn("refresh", response.cookies)
+
+        user.refresh_from_db()
+
+        self.assertTrue(user.is_active)
+        self.assertEqual((user.otp, user.verification_token), (None, None))
+
+        # The token is spent
+        self.assertEqual(self.post("user_otp_verify", {"verification_token": token, "otp": otp}).status_code, 404)
+
+
+    def test_registration_errors(self):
+
+        response = self.post("user_register", {"username": "flow", "email": "flow@example.com", "password": "short", "password2": "short"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Password Must Have 8 Characters")
+
+        self.register()
+
+        response = self.post("user_register", {"username": "other", "email": "flow@example.com", "password": "flow-password", "password2": "flow-password"})
+
+        self.assertEqual(response.status_code, 400)
+
+
+    def test_wrong_otp_keeps_the_account_inactive(self):
+
+        token = self.register()
+        otp = self.emailed_otp()
+
+        response = self.post("user_otp_verify", {"verification_token": token, "otp": self.wrong(otp)})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn("access", response.cookies)
+        self.assertFalse(User.objects.get(email="flow@example.com").is_active)
+
+        # Still usable with the right OTP
+        self.assertEqual(self.post("user_otp_verify", {"verification_token": token, "otp": otp}).status_code, 200)
+
+
+    def test_expired_otp_and_token_are_refused(self):
+
+        token = self.register()
+        otp = self.emailed_otp()
+
+        User.objects.filter(email="flow@example.com").update(otp_expiry=timezone.now() - timedelta(seconds=1))
+
+        response = self.post("user_otp_verify", {"verification_token": token, "otp": otp})
+
+        self.assertEqual((response.status_code, response.json()["error"]), (400, "Invalid or Expired OTP"))
+
+        User.objects.filter(email="flow@example.com").update(
+            otp_expiry=timezone.now() + timedelta(minutes=5),
+            verification_token_expiry=timezone.now() - timedelta(seconds=1),
+        )
+
+        response = self.post("user_otp_verify", {"verification_token": token, "otp": otp})
+
+        self.assertEqual((response.status_code, response.json()["error"]), (400, "Invalid or Expired Token"))
+        self.assertEqual(self.post("user_otp_verify", {"verification_token": "unknown", "otp": otp}).status_code, 404)
+
+
+    def test_failed_verifications_are_limited(self):
+
+        token = self.register()
+        otp = self.emailed_otp()
+
+        statuses = [self.post("user_otp_verify", {"verification_token": token, "otp": self.wrong(otp)}).status_code for _ in range(6)]
+
+        self.assertEqual(statuses, [400] * 5 + [429])
+        self.assertEqual(self.post("user_otp_verify", {"verification_token": token, "otp": otp}).status_code, 429)
+
+
+    def test_two_factor_login_goes_through_an_emailed_otp(self):
+
+        user = User.objects.create_user(email="flow@example.com", username="flow", password="flow-password")
+        user.is_active = True
+        user.is_two_factor_authentication_enabled = True
+        user.save()
+
+        response = self.post("user_login", {"email": "flow@example.com", "password": "flow-password"})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertTrue(response.json()["is_restricted_account"])
+        self.assertNotIn("access", response.cookies)
+
+        token = response.json()["verification_token"]
+        otp = self.emailed_otp()
+
+        self.assertEqual(self.post("user_otp_verify", {"verification_token": token, "otp": self.wrong(otp)}).status_code, 400)
+
+        response = self.post("user_otp_verify", {"verification_token": token, "otp": otp})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertIn("access", response.cookies)
+
+        # Each login issues a new token and OTP, the one before is no good anymore
+        first = self.post("user_login", {"email": "flow@example.com", "password": "flow-password"}).json()["verification_token"]
+        second = self.post("user_login", {"email": "flow@example.com", "password": "flow-password"}).json()["verification_token"]
+
+        otp = self.emailed_otp()
+
+        self.assertEqual(self.post("user_otp_verify", {"verification_token": first, "otp": otp}).status_code, 404)
+        self.assertEqual(self.post("user_otp_verify", {"verification_token": second, "otp": otp}).status_code, 200)
+
+
+
+
+# Cheap costs, so the tests don't spend 100 MiB and a few hundred ms per hash
+CHEAP_ARGON2 = {"ARGON2": {"TIME_COST": 1, "MEMORY_COST": 1024, "PARALLELISM": 1}}
+
+
+@override_settings(PASSWORD_HASHING=CHEAP_ARGON2, PASSWORD_HASHERS=settings.PASSWORD_HASHERS)
+class PasswordHashingTests(TestCase):
+
+    def setUp(self):
+
+        caches["default"].clear()
+        freeze_clock(self)
+
+        audit = mock.patch("authentication.views.record_attempt")
+        audit.start()
+        self.addCleanup(audit.stop)
+
+        self.user = User.objects.create_user("hash@example.com", "hash", "hash-password")
+        self.user.is_active = True
+        self.user.save()
+
+
+    def share_connection(self):
+
+        """
+        Runs The Hashing Pool On a Thread Using This Test's Connection, Which Holds The Test Data
+        """
+
+        shared = connections["default"]
+        shared.inc_thread_sharing()
+        self.addCleanup(shared.dec_thread_sharing)
+
+        executor = ThreadPoolExecutor(max_workers=1, initializer=connections.__setitem__, initargs=("default", shared))
+        self.addCleanup(executor.shutdown)
+
+        for patcher in (
+            mock.patch.object(hashing_pool, "_executor", executor),
+            # The pool thread would close the shared connection, it's inside the test's transaction
+            mock.patch("authentication.hashers.close_old_connections"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+    def login(self, path="user_login", password="hash-password"):
+
+        return self.client.post(f"/authentication/{path}", {"email": "hash@example.com", "password": password}, content_type="application/json")
+
+
+    def test_hashes_with_the_configured_costs(self):
+
+        hasher = TunedArgon2PasswordHasher()
+        encoded = hasher.encode("hash-password", hasher.salt())
+
+        self.assertEqual((hasher.time_cost, hasher.memory_cost, hasher.parallelism), (1, 1024, 1))
+        self.assertTrue(hasher.verify("hash-password", encoded))
+        self.assertFalse(hasher.must_update(encoded))
+
+        # Django's own argon2 costs are another set of parameters
+        self.assertTrue(hasher.must_update(Argon2PasswordHasher().encode("hash-password", hasher.salt())))
+
+
+    def assert_upgraded_on_login(self, old_hash):
+
+        self.user.password = old_hash
+        self.user.save()
+
+        self.assertEqual(self.login().status_code, 200)
+
+        self.user.refresh_from_db()
+
+        self.assertTrue(self.user.password.startswith("argon2$"))
+        self.assertNotEqual(self.user.password, old_hash)
+        self.assertFalse(TunedArgon2PasswordHasher().must_update(self.user.password))
+        self.assertTrue(self.user.check_password("hash-password"))
+
+
+    def test_pbkdf2_hash_verifies_and_is_upgraded_on_login(self):
+
+        self.assert_upgraded_on_login(make_password("hash-password", hasher="pbkdf2_sha256"))
+
+
+    def test_argon2_hash_with_other_costs_is_upgraded_on_login(self):
+
+        self.assert_upgraded_on_login(Argon2PasswordHasher().encode("hash-password", Argon2PasswordHasher().salt()))
+
+
+    def test_failed_login_is_not_upgraded(self):
+
+        old_hash = make_password("hash-password", hasher="pbkdf2_sha256")
+
+        self.user.password = old_hash
+        self.user.save()
+
+        self.assertEqual(self.login(password="wrong-password").status_code, 400)
+
+        self.user.refresh_from_db()
+
+        self.assertEqual(self.user.password, old_hash)
+
+
+    def test_async_login_runs_on_the_pool(self):
+
+        self.share_connection()
+
+        completed = hashing_pool.completed
+
+        with mock.patch.object(hashing_pool, "submit", wraps=hashing_pool.submit) as submit:
+            response = self.login("async/user_login")
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertIn("access", response.cookies)
+        self.assertEqual(submit.call_count, 1)
+        self.assertEqual(hashing_pool.completed, completed + 1)
+
+
+    def test_failed_async_login_runs_on_the_pool(self):
+
+        self.share_connection()
+
+        completed = hashing_pool.completed
+
+        with mock.patch.object(hashing_pool, "submit", wraps=hashing_pool.submit) as submit:
+            response = self.login("async/user_login", password="wrong-password")
+
+        # A wrong password costs a hash as well, it mustn't be cheaper to get wrong
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(submit.call_count, 1)
+        self.assertEqual(hashing_pool.completed, completed + 1)
+
+
+    def test_saturated_pool_answers_503(self):
+
+        rejected = hashing_pool.rejected
+
+        with mock.patch.object(hashing_pool, "_in_flight", hashing_pool.workers + hashing_pool.max_queue):
+            response = self.login("async/user_login")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], str(hashing_pool.retry_after))
+        self.assertEqual(hashing_pool.rejected, rejected + 1)
+
+
+    def test_pool_refuses_work_past_its_queue(self):
+
+        pool = HashingPool(workers=1, max_queue=1, retry_after=1)
+        self.addCleanup(pool.executor.shutdown)
+
+        release = threading.Event()
+
+        running = pool.submit(release.wait, 5)
+        queued = pool.submit(release.wait, 5)
+
+        with self.assertRaises(HashingSaturated):
+            pool.submit(release.wait, 5)
+
+        self.assertEqual(pool.stats()["in_flight"], 2)
+        self.assertEqual(pool.rejected, 1)
+
+        release.set()
+        running.result(timeout=5)
+        queued.result(timeout=5)
+
+        # Finished work frees its place
+        self.assertTrue(pool.submit(lambda: True).result(timeout=5))
+        self.assertEqual(pool.completed, 3)
+
+
+
+
+def wait_for(condition, timeout=5):
+
+    """
+    Polls condition() Until It Holds, For Work Done On Other Threads
+    """
+
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for the background work")
+
+        time.sleep(0.005)
+
+
+
+
+class BackgroundExecutorTests(TestCase):
+
+    def executor(self, **kwargs):
+
+        return BackgroundExecutor(**{"workers": 1, "max_queue": 1, "max_retries": 2, "retry_backoff": 0.01, **kwargs})
+
+
+    def test_rejects_work_when_the_queue_is_full(self):
+
+        executor = self.executor()
+
+        started, release = threading.Event(), threading.Event()
+        self.addCleanup(release.set)
+
+        def blocker():
+            started.set()
+            release.wait(5)
+
+        # The worker holds the first task, the second fills the queue
+        self.assertTrue(executor.submit(blocker))
+        self.assertTrue(started.wait(5))
+        self.assertTrue(executor.submit(lambda: None))
+
+        with self.assertLogs("authentication.tasks", "WARNING"):
+            self.assertFalse(executor.submit(lambda: None))
+
+        release.set()
+        executor.join()
+
+        self.assertEqual(executor.stats()["submitted"], 2)
+        self.assertEqual(executor.stats()["rejected"], 1)
+        self.assertEqual(executor.stats()["completed"], 2)
+
+
+    def test_retries_then_succeeds(self):
+
+        executor = self.executor()
+        calls = []
+
+        def flaky():
+            calls.append(time.monotonic())
+            if len(calls) < 2:
+                raise ConnectionError("smtp went away")
+
+        executor.submit(flaky)
+
+        wait_for(lambda: executor.completed == 1)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual((executor.retried, executor.failed), (1, 0))
+
+
+    def test_retries_then_gives_up(self):
+
+        executor = self.executor()
+        calls = []
+
+        def broken():
+            calls.append(time.monotonic())
+            raise ConnectionError("smtp is down")
+
+        with self.assertLogs("authentication.tasks", "ERROR") as logs:
+            executor.submit(broken)
+            # failed is counted just before the error is logged
+            wait_for(lambda: logs.output)
+
+        # The first try and max_retries more, each one waiting twice as long as the last
+        self.assertEqual(len(calls), 3)
+        self.assertEqual((executor.retried, executor.completed), (2, 0))
+        self.assertGreaterEqual(calls[2] - calls[1], 0.02)
+        self.assertIn("failed after 3 attempts", logs.output[0])
+
+
+    def test_task_can_opt_out_of_retries(self):
+
+        executor = self.executor()
+        calls = []
+
+        with self.assertLogs("authentication.tasks", "ERROR") as logs:
+            executor.submit(lambda: calls.append(1) or 1 / 0, retries=0)
+            wait_for(lambda: logs.output)
+
+        self.assertEqual((len(calls), executor.retried, executor.failed), (1, 0, 1))
+
+
+
+
+@override_settings(BACKGROUND_TASKS={"ATTEMPT_RETENTION": 60 * 60, "SWEEP_BATCH_SIZE": 2})
+class PruneExpiredAttemptsTests(TestCase):
+
+    def test_deletes_only_rows_past_the_retention(self):
+
+        now = timezone.now()
+        expired, kept = now - timedelta(hours=2), now - timedelta(minutes=59)
+
+        # More expired rows than a batch, so the sweep takes several
+        for model in (LoginAttempt, OTPVerifyAttempt):
+            model.objects.bulk_create([model(ip_address="10.0.0.1", timestamp=expired) for _ in range(5)])
+            model.objects.bulk_create([model(ip_address="10.0.0.1", timestamp=kept, success=True) for _ in range(3)])
+
+        prune_expired_attempts()
+
+        for model in (LoginAttempt, OTPVerifyAttempt):
+            self.assertEqual(model.objects.count(), 3)
+            self.assertFalse(model.objects.filter(timestamp__lt=now - timedelta(hours=1)).exists())
+
+
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class EmailDeliveryTests(TestCase):
+
+    context = {"username": "flow <b>&", "otp": "1234"}
+
+
+    def message(self, subject="Your Login Code"):
+
+        return EmailMessage(subject, "body", settings.EMAIL_HOST_USER, ["flow@example.com"])
+
+
+    def test_cached_template_renders_like_premailer_on_the_rendered_page(self):
+
+        inlined = InlinedTemplates()
+
+        with mock.patch.object(inlined, "compile", wraps=inlined.compile) as compile:
+            first = inlined.render("otp.html", self.context)
+            second = inlined.render("otp.html", {**self.context, "otp": "5678"})
+
+        # Compiled once, and the variables, escaping included, come out as if inlined after rendering
+        self.assertEqual(compile.call_count, 1)
+        self.assertEqual(first, transform(render_to_string("otp.html", self.context)))
+        self.assertEqual(second, transform(render_to_string("otp.html", {**self.context, "otp": "5678"})))
+
+
+    def test_uncached_templates_compile_every_time(self):
+
+        inlined = InlinedTemplates(cache=False)
+
+        with mock.patch.object(inlined, "compile", wraps=inlined.compile) as compile:
+            inlined.render("otp.html", self.context)
+            inlined.render("otp.html", self.context)
+
+        self.assertEqual(compile.call_count, 2)
+
+
+    def test_sends_reuse_one_connection(self):
+
+        pool = ConnectionPool(size=2, max_idle=60)
+
+        pool.send(self.message("first"))
+        pool.send(self.message("second"))
+
+        self.assertEqual([message.subject for message in mail.outbox], ["first", "second"])
+        self.assertEqual(pool.stats(), {"idle": 1, "opened": 1, "reused": 1, "sent": 2})
+
+
+    def test_idle_connection_past_max_idle_is_reopened(self):
+
+        pool = ConnectionPool(size=2, max_idle=60)
+
+        with mock.patch("authentication.emails.time.monotonic", return_value=1000):
+            pool.send(self.message())
+
+        with mock.patch("authentication.emails.time.monotonic", return_value=1061):
+            pool.send(self.message())
+
+        self.assertEqual((pool.opened, pool.reused, pool.sent), (2, 0, 2))
+
+
+    def test_dead_connection_is_retried_once_on_a_new_one(self):
+
+        pool = ConnectionPool(size=2, max_idle=60)
+
+        pool.send(self.message("first"))
+
+        dead, _ = pool._idle.queue[-1]
+
+        with mock.patch.object(dead, "send_messages", side_effect=ConnectionResetError("server went away")), \
+             mock.patch.object(dead, "close", wraps=dead.close) as close, \
+             self.assertLogs("authentication.emails", "WARNING"):
+            pool.send(self.message("second"))
+
+        self.assertEqual([message.subject for message in mail.outbox], ["first", "second"])
+        self.assertEqual(close.call_count, 1)
+        self.assertEqual((pool.opened, pool.reused, pool.sent), (2, 1, 2))
+
+        # The new connection is the one kept
+        self.assertIsNot(pool._idle.queue[-1][0], dead)
+
+
+    def test_gives_up_when_the_new_connection_fails_too(self):
+
+        pool = ConnectionPool(size=2, max_idle=60)
+
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=ConnectionRefusedError), \
+             self.assertLogs("authentication.emails", "WARNING"):
+
+            with self.assertRaises(ConnectionRefusedError):
+                pool.send(self.message())
+
+        self.assertEqual((pool.opened, pool.sent), (2, 0))
+        self.assertEqual(pool.stats()["idle"], 0)
+        self.assertEqual(mail.outbox, [])
+
+
+
+
+class AttemptIndexTests(TestCase):
+
+    def test_failed_attempts_of_an_ip_seek_the_partial_index(self):
+
+        if connection.vendor != "sqlite":
+            self.skipTest("Checks SQLite's plan format")
+
+        threshold = timezone.now() - timedelta(minutes=15)
+
+        for model in (LoginAttempt, OTPVerifyAttempt):
+
+            plan = model.objects.filter(ip_address="203.0.113.7", success=False, timestamp__gte=threshold).explain()
+
+            self.assertIn("(ip_address=? AND timestamp>?)", plan)
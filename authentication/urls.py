@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import views, async_views
 
 
 urlpatterns = [
@@ -8,4 +8,8 @@ urlpatterns = [
     path('user_login', views.UserLoginView.as_view()),
     path('check_user_authentication', views.CheckUserAuthentication.as_view()),
     path('get_user_details', views.GetUserDetails.as_view()),
+
+    # Async variants hashing passwords on the bounded hashing pool, see authentication/hashers.py
+    path('async/user_register', async_views.user_register),
+    path('async/user_login', async_views.user_login),
 ]
@@ -0,0 +1,118 @@
+import copy
+import threading
+
+from cachetools import TTLCache
+from django.conf import settings
+
+
+DEFAULT_USER_CACHE = {
+    "MAX_USERS": 10000,
+    "TTL": None,          # Seconds, None uses the access token lifetime
+    "STATELESS": False,   # Build the user from the token claims without touching the database
+}
+
+
+# Claims copied into the tokens so a stateless user still has the details the views read
+USER_TOKEN_CLAIMS = ("username", "email", "user_plan", "is_staff")
+
+
+def user_cache_config():
+
+    return {**DEFAULT_USER_CACHE, **getattr(settings, "USER_CACHE", {})}
+
+
+
+
+class UserCache:
+
+    """
+    In-Process TTL/LRU Cache of Users Keyed by Their ID.
+
+    Entries live as long as an access token, and are dropped as soon as the user is saved
+    or deleted (see the receivers in authentication/models.py). Every request gets its own
+    shallow copy, so a view changing attributes on request.user never leaks into the cache.
+
+    The receivers only reach the cache of the process the change was saved in. A user
+    deactivated or demoted through another worker keeps their cached access here until the
+    entry's TTL runs out, the access token lifetime by default. With STATELESS there is no
+    cache to drop: the claims are frozen when the token is issued, and hold until it expires.
+    """
+
+    def __init__(self, max_users, ttl):
+
+        self.ttl = ttl
+
+        self._users = TTLCache(maxsize=max_users, ttl=ttl)
+        self._lock = threading.Lock()
+
+        # Bumped by every invalidation, so a load racing with a save is never cached
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, user_id, loader):
+
+        """
+        Returns a Copy of The Cached User, Calling loader(user_id) On a Miss
+        """
+
+        key = str(user_id)
+
+        with self._lock:
+            user = self._users.get(key)
+            generation = self._generation
+
+        if user is not None:
+            self.hits += 1
+            return copy.copy(user)
+
+        self.misses += 1
+
+        user = loader(user_id)
+
+        with self._lock:
+            if generation == self._generation:
+                self._users[key] = user
+
+        return copy.copy(user)
+
+
+    def invalidate(self, user_id):
+
+        with self._lock:
+            self._users.pop(str(user_id), None)
+            self._generation += 1
+
+
+    def clear(self):
+
+        with self._lock:
+            self._users.clear()
+
+
+    def stats(self):
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "users": len(self._users),
+        }
+
+
+
+
+def _build_user_cache():
+
+    config = user_cache_config()
+
+    ttl = config["TTL"]
+
+    if ttl is None:
+        ttl = settings.SIMPLE_JWT["ACCESS_TOKEN_LIFETIME"].total_seconds()
+
+    return UserCache(max_users=config["MAX_USERS"], ttl=ttl)
+
+
+user_cache = _build_user_cache()
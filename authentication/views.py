@@ -6,19 +6,17 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework_simplejwt.tokens import RefreshToken, AccessToken
 
 from .serializers import UserRegistrationSerializer
+from .user_cache import USER_TOKEN_CLAIMS
+from .tasks import background
+from .ratelimit import login_ip_limiter, login_account_limiter, otp_ip_limiter, record_attempt
+from .emails import send_templated_email
 
 from django.conf import settings
-from django.core.mail import EmailMessage
-from django.template.loader import render_to_string
-from django.db import IntegrityError, transaction
 from django.utils import timezone
 from django.contrib.auth import authenticate
 
-from premailer import transform
-
-import random, string, secrets
+import string, secrets
 from datetime import datetime, timedelta, timezone as dt_timezone
-from threading import Thread
 
 from .models import User, OTPVerifyAttempt, LoginAttempt
 
@@ -62,13 +60,9 @@ class UserRegistrationView(APIView):
 
             user = serializer.save()
 
-            assign_otp(user=user)
-
-            assign_verification_token(user=user)
+            issue_verification(user=user)
 
-            email_thread = Thread(target=send_stylized_email,args=(user.email, "Verify Your Account", "otp.html", {'username': user.username, 'otp':user.otp}))
-
-            email_thread.start()
+            background.submit(send_stylized_email, user.email, "Verify Your Account", "otp.html", {'username': user.username, 'otp':user.otp})
 
             return Response({'verification_token':user.verification_token},status=status.HTTP_201_CREATED)
         
@@ -92,38 +86,19 @@ class VerifyUserOTP(APIView):
 
         ip_address = get_client_ip(request=request)
 
-        # Delete the Succeccful LoginAttempt of the IP Adress if ever before
-
-        OTPVerifyAttempt.objects.filter(ip_address=ip_address, success=True).delete()
-        
-        # Create a new Failed LoginAttempt of the IP Address
-
-        OTPVerifyAttempt.objects.create(user=user, ip_address=ip_address, success=success)
-
-    
-    def delete_attempts_before_threshold(self, ip_address, duration_minutes):
-
-        time_threshold = timezone.now() - timedelta(minutes=duration_minutes)
+        # Every attempt was counted by too_many_attempts(), a success clears the failures of the IP address
 
-        # Delete the Older Failed Login Attempts becuase they are no more revelant
+        if success:
+            otp_ip_limiter.reset(ip_address)
 
-        OTPVerifyAttempt.objects.filter(ip_address=ip_address, success=False, timestamp__lte=time_threshold).delete()
+        record_attempt(OTPVerifyAttempt(user=user, ip_address=ip_address, success=success))
 
     
-    def too_many_attempts(self, request, duration_minutes=15, max_attempts=5):
-        
-        ip_address = get_client_ip(request)
-
-        time_threshold = timezone.now() - timedelta(minutes=duration_minutes)
+    def too_many_attempts(self, request):
 
-        delete_old_attempts_thred = Thread(target=self.delete_attempts_before_threshold,args=(ip_address,duration_minutes))
-
-        delete_old_attempts_thred.start()
-
-        # Count failed login attempts for the IP in the given duration
-        failed_attempts = OTPVerifyAttempt.objects.filter(ip_address=ip_address, success=False, timestamp__gte=time_threshold).count()
-
-        return failed_attempts >= max_attempts
+        # Counts the attempt as a failure until it succeeds, in the same step as the check,
+        # so concurrent guesses can't all get past it. See RATE_LIMITS["OTP_FAILURES"]
+        return not otp_ip_limiter.consume(get_client_ip(request))
 
 
     def post(self, request):
@@ -143,7 +118,7 @@ class VerifyUserOTP(APIView):
 
                 if user.verification_token_expiry is not None and user.verification_token_expiry > timezone.now():
 
-                    if user.otp_expiry is not None and user.otp_expiry > timezone.now() and user.otp == incoming_otp:
+                    if user.otp_expiry is not None and user.otp_expiry > timezone.now() and otp_matches(user.otp, incoming_otp):
 
                         self.track_verify_attempt(request=request, user=user, success=True)
 
@@ -152,12 +127,8 @@ class VerifyUserOTP(APIView):
                         user.otp_expiry = None
                         user.verification_token = None
                         user.verification_token_expiry = None
-            
-                        clear_failed_attempts_thread = Thread(target=clean_failed_attempts,args=(request, "otp-attempt"))
 
-                        clear_failed_attempts_thread.start()
-
-                        user.save()
+                        user.save(update_fields=["is_active", "otp", "otp_expiry", "verification_token", "verification_token_expiry"])
 
                         tokens = generate_user_tokens(user=user)
 
@@ -195,39 +166,32 @@ class UserLoginView(APIView):
     def track_login_attempt(self, request, user=None, success=False):
 
         ip_address = get_client_ip(request=request)
+        account = get_login_account(request)
 
-        # Delete the Succeccful LoginAttempt of the IP Adress if ever before
+        # Every attempt was counted by too_many_attempts(), a success clears the failures of the IP address and account
 
-        LoginAttempt.objects.filter(ip_address=ip_address, success=True).delete()
-        
-        # Create a new Failed LoginAttempt of the IP Address
+        if success:
+            login_ip_limiter.reset(ip_address)
+            login_account_limiter.reset(account)
 
-        LoginAttempt.objects.create(user=user, ip_address=ip_address, success=success)
+        record_attempt(LoginAttempt(user=user, ip_address=ip_address, success=success))
 
     
-    def delete_attempts_before_threshold(self, ip_address, duration_minutes):
-
-        time_threshold = timezone.now() - timedelta(seconds=duration_minutes)
-
-        # Delete the Older Failed Login Attempts becuase they are no more revelant
+    def too_many_attempts(self, request):
 
-        LoginAttempt.objects.filter(ip_address=ip_address, success=False, timestamp__lte=time_threshold).delete()
-
-    
-    def too_many_attempts(self, request, duration_minutes=15, max_attempts=5):
-        
+        # Counts the attempt as a failure until it succeeds, in the same step as the check,
+        # so concurrent guesses can't all get past it. See RATE_LIMITS["LOGIN_FAILURES"]
         ip_address = get_client_ip(request)
 
-        time_threshold = timezone.now() - timedelta(seconds=duration_minutes)
-
-        delete_old_attempts_thred = Thread(target=self.delete_attempts_before_threshold,args=(ip_address,duration_minutes))
-
-        delete_old_attempts_thred.start()
+        if not login_ip_limiter.consume(ip_address):
+            return True
 
-        # Count failed login attempts for the IP in the given duration
-        failed_attempts = LoginAttempt.objects.filter(ip_address=ip_address, success=False, timestamp__gte=time_threshold).count()
+        if not login_account_limiter.consume(get_login_account(request)):
+            # The attempt is refused, it isn't one against the IP address either
+            login_ip_limiter.refund(ip_address)
+            return True
 
-        return failed_attempts >= max_attempts
+        return False
     
 
     def post(self, request):
@@ -247,16 +211,17 @@ class UserLoginView(APIView):
 
             if user.is_two_factor_authentication_enabled:
 
-                return Response({"is_restricted_account" : user.is_two_factor_authentication_enabled, "email" : user.email})
+                # The tokens are only set once the emailed OTP is verified at user_otp_verify
+                verification_token = issue_verification(user=user)
+
+                background.submit(send_stylized_email, user.email, "Your Login Code", "otp.html", {'username': user.username, 'otp':user.otp})
+
+                return Response({"is_restricted_account" : user.is_two_factor_authentication_enabled, "email" : user.email, "verification_token" : verification_token})
             
             else:
 
                 tokens = generate_user_tokens(user=user)
 
-                clear_failed_attempts_thread = Thread(target=clean_failed_attempts,args=(request, "login-attempt"))
-
-                clear_failed_attempts_thread.start()
-
                 response = Response({"msg":"Login Successful", "store_date" : datetime.now().strftime("%Y-%m-%d"), "store_time" : str(datetime.now().strftime("%H:%M:%S"))},status=status.HTTP_200_OK)
 
                 return set_tokens_and_expiry(response_object=response, tokens=tokens)
@@ -279,83 +244,45 @@ class UserLoginView(APIView):
 
 
 def send_stylized_email(user_email : str , subject : str, template_name : str , arguments_for_template : dict):
-    
-    subject = subject
 
-    message = "Email Failed To Send"
-
-    # Render and transform the HTML email
-    html_message = render_to_string(template_name, arguments_for_template)
-    html_message = transform(html_message)  # Inline CSS
-
-    email = EmailMessage(
-        subject,
-        message,
-        settings.EMAIL_HOST_USER,
-        [user_email]
-    )
-    
-    email.content_subtype = 'html'
-    email.body = html_message
-
-    email.send()
+    # The CSS of the template is inlined once and cached, and the mail goes out on a pooled connection
+    send_templated_email(user_email, subject, template_name, arguments_for_template)
 
 
 
-def assign_otp(user : User):
+def issue_verification(user : User):
 
     """
-    Assigns User A Unique OTP
-    """
-
-    while True:
-
-        generated_otp = "".join(random.choices(population=string.digits,k=4))
-
-        try:
+    Assigns User A Verification Token and an OTP Scoped To It, in a Single Update.
 
-            with transaction.atomic():
-
-                user.otp = generated_otp
+    The OTP is only ever checked together with its token, so it doesn't have to be unique
+    across users, and the 256 bit token doesn't realistically collide, so nothing is retried
+    """
 
-                user.otp_expiry = timezone.now() + timedelta(minutes=5)
+    now = timezone.now()
 
-                user.save()
+    user.verification_token = secrets.token_urlsafe(32)
+    user.verification_token_expiry = now + timedelta(minutes=5)
 
-                break
+    user.otp = "".join(secrets.choice(string.digits) for _ in range(4))
+    user.otp_expiry = now + timedelta(minutes=5)
 
-        except IntegrityError:
+    user.save(update_fields=["verification_token", "verification_token_expiry", "otp", "otp_expiry"])
 
-            continue
+    return user.verification_token
 
 
 
-def assign_verification_token(user : User):
+def otp_matches(expected_otp, incoming_otp):
 
     """
-    Assigns User A Unique Verification Token
+    Compares OTPs in Constant Time
     """
 
-    while True:
-
-        generated_token = secrets.token_urlsafe(32)
-
-        try:
+    if not expected_otp or not isinstance(incoming_otp, str):
+        return False
 
-            with transaction.atomic():
-
-                user.verification_token = generated_token
-
-                user.verification_token_expiry = timezone.now() + timedelta(minutes=5)
-
-                user.save()
-
-                return generated_token
-            
-
-        except IntegrityError:
-
-            continue
+    return secrets.compare_digest(expected_otp.encode(), incoming_otp.encode())
 
 
 def get_client_ip(request):
@@ -378,31 +305,13 @@ def get_client_ip(request):
 
 
 
-def clean_failed_attempts(request, attempt_type : str):
+def get_login_account(request):
 
     """
-    Clears All The Failed Attempts
+    Returns The Normalized Email a Login Request Is For, Used To Limit Attempts Per Account
     """
 
-    client_ip = get_client_ip(request=request)
-
-    match attempt_type :
-
-        case "login-attempt":
-
-            LoginAttempt.objects.filter(ip_address = client_ip, success = False).delete()
-
-            return True
-        
-        case "otp-attempt":
-
-            OTPVerifyAttempt.objects.filter(ip_address = client_ip, success = False).delete()
-
-            return True
-        
-        case _:
-
-            return False
+    return str(request.data.get("email") or "").strip().lower()
 
 
 
@@ -414,6 +323,10 @@ def generate_user_tokens(user : User) -> dict:
 
     tokens = RefreshToken.for_user(user)
 
+    # Copied into the access token too, lets the authentication run stateless
+    for claim in USER_TOKEN_CLAIMS:
+        tokens[claim] = getattr(user, claim)
+
     return {
         'refresh' : str(tokens),
         'access' : str(tokens.access_token),
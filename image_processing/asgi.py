@@ -3,6 +3,9 @@ ASGI config for image_processing project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+HTTP goes to Django. WebSocket connections to the live preview path are served by
+api/live.py, every other WebSocket is refused.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -13,4 +16,26 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'image_processing.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up, it needs the settings and the apps
+from api.live import live_config, live_preview_application  # noqa: E402
+from api.warmup import warm_up_on_first_request  # noqa: E402
+
+# The heavy imports are deferred and load on a thread started by the first request, so it
+# runs in the worker process even when the server imports this module before forking
+warm_up_on_first_request()
+
+
+async def application(scope, receive, send):
+
+    if scope["type"] == "websocket":
+
+        if scope["path"] == live_config()["PATH"]:
+            return await live_preview_application(scope, receive, send)
+
+        await receive()
+        await send({"type": "websocket.close", "code": 4404})
+        return
+
+    return await django_application(scope, receive, send)
@@ -38,12 +38,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'api.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -73,6 +75,14 @@ WSGI_APPLICATION = 'image_processing.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# SQLite tuning, "production" or "default". The production profile switches to WAL, synchronous=NORMAL
+# and a busy timeout (PRAGMAs applied to every connection, see authentication/db.py), keeps connections
+# open between requests and starts transactions IMMEDIATE. WAL rewrites the header of the database file,
+# so all of it is left to deployments to turn on with SQLITE_PROFILE=production, a checkout keeps
+# db.sqlite3 as committed and runs SQLite with Django's defaults
+
+SQLITE_PROFILE = os.getenv('SQLITE_PROFILE', 'default')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
@@ -80,6 +90,19 @@ DATABASES = {
     }
 }
 
+if SQLITE_PROFILE == 'production':
+
+    DATABASES['default'].update({
+        # Persistent connections, each worker thread reuses its connection for this many seconds
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # Writers take the lock when their transaction starts, instead of failing to upgrade a read lock
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 5,
+        },
+    })
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -144,8 +167,173 @@ CSRF_TRUSTED_ORIGINS = [
 AUTH_USER_MODEL = "authentication.User"
 
 
+# Decoded images kept in memory between requests, see api/image_store.py
+
+IMAGE_STORE = {
+    "TTL": 60 * 10,
+    "MAX_BYTES": int(os.getenv('IMAGE_STORE_MAX_BYTES', 1024 * 1024 * 1024)),
+    "MAX_BYTES_PER_USER": int(os.getenv('IMAGE_STORE_MAX_BYTES_PER_USER', 256 * 1024 * 1024)),
+}
+
+
+# Bounded pool every image endpoint hands its CPU work to, see api/compute.py
+
+IMAGE_COMPUTE = {
+    "EXECUTOR": os.getenv('IMAGE_COMPUTE_EXECUTOR', 'thread'),
+    "WORKERS": int(os.getenv('IMAGE_COMPUTE_WORKERS', os.cpu_count() or 1)),
+    "MAX_QUEUE_DEPTH": int(os.getenv('IMAGE_COMPUTE_MAX_QUEUE_DEPTH', 32)),
+    "MAX_IN_FLIGHT_PER_CLIENT": 4,
+    "RETRY_AFTER": 2,
+}
+
+
+# Lanes of the compute pool by User.user_plan, see api/scheduler.py. WEIGHT is the share of the
+# workers and of MAX_QUEUE_DEPTH under contention, MAX_CONCURRENCY caps a lane while other lanes
+# have work waiting and MEGAPIXELS_PER_SECOND caps it always (None for no cap)
+
+IMAGE_SCHEDULER = {
+    "LANES": {
+        "pro": {"WEIGHT": 8, "MAX_CONCURRENCY": None, "MEGAPIXELS_PER_SECOND": None},
+        "free": {"WEIGHT": 2, "MAX_CONCURRENCY": 2, "MEGAPIXELS_PER_SECOND": 40},
+        "": {"WEIGHT": 2, "MAX_CONCURRENCY": 2, "MEGAPIXELS_PER_SECOND": 40},
+        "anonymous": {"WEIGHT": 1, "MAX_CONCURRENCY": 1, "MEGAPIXELS_PER_SECOND": 20},
+    },
+    "DEFAULT_LANE": "",
+    "INTERACTIVE_MAX_PIXELS": 4_000_000,
+    "BURST_SECONDS": 2,
+    "MIN_COST": 0.05,
+}
+
+
+# Admission control from predicted cost, see api/cost.py. KERNELS holds the calibrated coefficients
+# (seconds per megapixel and peak bytes per pixel, `manage.py bench_kernels` measures them), PLANS the
+# budgets per User.user_plan. Requests over a budget get 413, longer than MAX_SYNC_SECONDS run as jobs
+
+# Base64 uploads arrive in the request body, the plain Django (async) views hold it to this size
+DATA_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv('DATA_UPLOAD_MAX_MEMORY_SIZE', 64 * 1024 * 1024))
+
+IMAGE_COST = {
+    "PLANS": {
+        "anonymous": {"MAX_PIXELS": 12_000_000, "MAX_PEAK_BYTES": 256 * 1024 * 1024, "MAX_SYNC_SECONDS": 2},
+        "": {"MAX_PIXELS": 25_000_000, "MAX_PEAK_BYTES": 512 * 1024 * 1024, "MAX_SYNC_SECONDS": 5},
+        "free": {"MAX_PIXELS": 25_000_000, "MAX_PEAK_BYTES": 512 * 1024 * 1024, "MAX_SYNC_SECONDS": 5},
+        "pro": {"MAX_PIXELS": 100_000_000, "MAX_PEAK_BYTES": 2 * 1024 * 1024 * 1024, "MAX_SYNC_SECONDS": 15},
+    },
+    "NODE_MAX_PEAK_BYTES": int(os.getenv('IMAGE_NODE_MAX_PEAK_BYTES', 2 * 1024 * 1024 * 1024)),
+    "DOWNSCALE_UPLOADS": True,
+}
+
+
+# Row striped multi-threading of the image kernels, see api/strips.py
+
+IMAGE_STRIPS = {
+    "THREADS": int(os.getenv('IMAGE_STRIPS_THREADS', os.cpu_count() or 1)),
+    "MIN_PIXELS": 1024 * 1024,
+    "MIN_ROWS": 32,
+    "BAND_PIXELS": 256 * 1024,
+}
+
+
+# Budget the image kernels reserve their buffers against, see api/memory.py. With less free,
+# kernels process fewer and smaller bands at once instead of failing or swapping
+
+IMAGE_MEMORY = {
+    "BUDGET_BYTES": int(os.getenv('IMAGE_MEMORY_BUDGET_BYTES', 2 * 1024 * 1024 * 1024)),
+    "SYSTEM_FRACTION": 0.8,
+}
+
+
+# Out-of-core processing of images larger than memory, tile by tile from memory-mapped files,
+# see api/tiles.py and `manage.py process_tiled`
+
+IMAGE_TILES = {
+    "TILE_SIZE": 1024,
+    "DIRECTORY": os.getenv('IMAGE_TILES_DIRECTORY') or None,
+}
+
+
+# WebSocket live preview sessions served by image_processing/asgi.py, see api/live.py
+
+IMAGE_LIVE_PREVIEW = {
+    "PATH": "/api/live",
+    "MIN_LEVEL_SIDE": 128,
+    "DEFAULT_MAX_SIDE": 1024,
+    "FORMAT": "JPEG",
+    "QUALITY": 80,
+    "MAX_SESSIONS_PER_CLIENT": 2,
+    "ALLOWED_ORIGINS": None,
+}
+
+
+# Background jobs for long running image operations ("mode": "job"), see api/jobs.py
+
+IMAGE_JOBS = {
+    "WORKERS": int(os.getenv('IMAGE_JOBS_WORKERS', 2)),
+    "MAX_PENDING": int(os.getenv('IMAGE_JOBS_MAX_PENDING', 8)),
+    "MAX_PENDING_PER_CLIENT": 2,
+    "PROGRESS_INTERVAL": 0.5,
+    "RESULT_TTL": 60 * 60,
+    "EVENTS_POLL_INTERVAL": 0.5,
+    "EVENTS_TIMEOUT": 60 * 10,
+}
+
+
+# Coalescing of identical in-flight image requests, see api/singleflight.py.
+# Point SHARED_CACHE at a cache alias shared by all workers to coalesce across them
+
+IMAGE_SINGLE_FLIGHT = {
+    "SHARED_CACHE": os.getenv('IMAGE_SINGLE_FLIGHT_CACHE') or None,
+    "LOCK_TIMEOUT": 60,
+    "RESULT_TTL": 5,
+    "POLL_INTERVAL": 0.05,
+}
+
+
+# Latest-wins handling of slider requests carrying a "seq", see api/supersede.py
+
+IMAGE_LATEST_WINS = {
+    "SHARED_CACHE": os.getenv('IMAGE_LATEST_WINS_CACHE') or None,
+    "MAX_SCOPES": 10000,
+    "TTL": 60 * 10,
+    "RESET_GAP": 8,
+}
+
+
+# Stage timers of the image endpoints, sent back in Server-Timing headers and aggregated for
+# GET /metrics (Prometheus text format), see api/metrics.py
+
+METRICS = {
+    "ENABLED": os.getenv('METRICS_ENABLED', 'True') == 'True',
+    "SERVER_TIMING": os.getenv('SERVER_TIMING', 'True') == 'True',
+    # Scrapers send "Authorization: Bearer <METRICS_TOKEN>", staff users may read it without
+    "TOKEN": os.getenv('METRICS_TOKEN') or None,
+    "ALLOWED_IPS": [],
+}
+
+
+# Staff users can profile a single request by sending "X-Profile: sample", "cprofile" or "both".
+# Collapsed stacks, pstats and the request's metadata are written to DIRECTORY, see api/profiling.py
+
+PROFILING = {
+    "ENABLED": os.getenv('PROFILING_ENABLED', 'True') == 'True',
+    "DIRECTORY": os.getenv('PROFILING_DIRECTORY', BASE_DIR / 'profiles'),
+    "SAMPLE_INTERVAL": 0.001,
+    "KEEP": 200,
+}
+
+
+# Heavy modules are imported on first use. Server workers import them and compile the email
+# templates on a background thread started by their first request, see api/warmup.py
+
+WARMUP = {
+    "ENABLED": os.getenv('WARMUP_ENABLED', 'True') == 'True',
+    "MODULES": ["matplotlib.colors", "premailer"],
+    "EMAIL_TEMPLATES": ["otp.html"],
+}
+
+
 PASSWORD_HASHERS = [
-    "django.contrib.auth.hashers.Argon2PasswordHasher",
+    "authentication.hashers.TunedArgon2PasswordHasher",
     "django.contrib.auth.hashers.PBKDF2PasswordHasher",
     "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
     "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
@@ -189,9 +377,84 @@ SIMPLE_JWT = {
 
 
 
+# In-process cache of the users resolved by CookieJWTAuthentication, see authentication/user_cache.py.
+# With STATELESS the user is built from the access token claims instead.
+# Changes to a user only invalidate the cache of the worker that saved them, the other workers
+# see them after TTL seconds (the access token lifetime by default), STATELESS once the token expires
+
+USER_CACHE = {
+    "MAX_USERS": 10000,
+    "TTL": None,
+    "STATELESS": os.getenv('USER_CACHE_STATELESS') == 'True',
+}
+
+
+
+# Sliding window rate limits kept in the cache, see authentication/ratelimit.py.
+# Rates are "<requests>/<window>" with the window in s, m, h or d, e.g. "5/15m"
+
+RATE_LIMITS = {
+    "CACHE": "default",
+    "LOGIN_FAILURES": "5/15m",
+    "OTP_FAILURES": "5/15m",
+    "PLANS": {
+        "anonymous": "30/m",
+        "": "60/m",
+        "free": "60/m",
+        "pro": "600/m",
+    },
+    # apply_adjustments gets a request per slider move, its CPU is bounded by latest-wins and coalescing
+    "INTERACTIVE_PLANS": {
+        "anonymous": "600/m",
+        "": "1200/m",
+        "free": "1200/m",
+        "pro": "3000/m",
+    },
+    "AUDIT": True,
+    "AUDIT_BATCH_SIZE": 100,
+    "AUDIT_FLUSH_INTERVAL": 2,
+}
+
+
+
+# Argon2 costs and the bounded pool the async login/registration views hash on, see
+# authentication/hashers.py. Run `manage.py calibrate_password_hasher` to pick costs for the host,
+# hashes made with other costs are upgraded on the next successful login
+
+PASSWORD_HASHING = {
+    "ARGON2": {
+        "TIME_COST": 2,
+        "MEMORY_COST": 102400,
+        "PARALLELISM": 8,
+    },
+    "WORKERS": 4,
+    "MAX_QUEUE": 64,
+    "RETRY_AFTER": 1,
+}
+
+
+
+# Shared bounded executor for background work (emails, audit rows, sweeps), see authentication/tasks.py
+
+BACKGROUND_TASKS = {
+    "WORKERS": 2,
+    "MAX_QUEUE": 1000,
+    "MAX_RETRIES": 3,
+    "RETRY_BACKOFF": 1.0,
+    "SWEEP_INTERVAL": 60 * 5,
+    "SWEEP_BATCH_SIZE": 1000,
+    "ATTEMPT_RETENTION": 60 * 60 * 24 * 7,
+}
+
+
+
 # EMAIL SERVICE
 
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# EMAIL_BACKEND can be pointed at the locmem or file backend locally, e.g.
+# EMAIL_BACKEND=django.core.mail.backends.filebased.EmailBackend EMAIL_FILE_PATH=/tmp/emails
+
+EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+EMAIL_FILE_PATH = os.getenv('EMAIL_FILE_PATH', BASE_DIR / 'sent_emails')
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = os.getenv('EMAIL_USE_TLS') == 'True'
@@ -199,6 +462,15 @@ EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 
 
+# Inlined template cache and reused connections for outgoing mail, see authentication/emails.py
+
+EMAIL_DELIVERY = {
+    "CONNECTIONS": 2,
+    "MAX_IDLE": 60,
+    "CACHE_TEMPLATES": True,
+}
+
+
 
 REST_FRAMEWORK = {
     
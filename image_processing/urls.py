@@ -1,9 +1,12 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from api.metrics import metrics_view
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('authentication/', include('authentication.urls')),
     path('api/', include('api.urls')),
+    path('metrics', metrics_view),
 ]
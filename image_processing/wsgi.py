@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'image_processing.settings')
 
 application = get_wsgi_application()
+
+# Imported after Django is set up, it needs the settings and the apps
+from api.warmup import warm_up_on_first_request  # noqa: E402
+
+# The heavy imports are deferred and load on a thread started by the first request, so it
+# runs in the worker process even when the server imports this module before forking
+warm_up_on_first_request()